@@ -0,0 +1,109 @@
+import os
+import pickle
+import time
+
+import numpy as np
+from datasets import load_from_disk
+
+from dense_train_utils import WIKI_CONTEXT_ID_PATH
+from negative_refresh import encode_passages, encode_questions, search_topk
+from passage_store import PassageTokenStore
+
+
+class PassageIndex:
+    '''
+    wiki 전체 passage embedding을 들고 있다가, encoder가 max_staleness step보다 많이
+    학습되었을 때만 다시 encode 합니다.
+    '''
+
+    def __init__(self, store, max_context_seq_length, tokenizer, batch_size, device):
+        self.store = store
+        self.max_context_seq_length = max_context_seq_length
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.device = device
+        self.p_embs = None
+        self.encoded_step = None
+
+    def get(self, global_step, p_encoder, max_staleness=0):
+        if self.encoded_step is None or global_step - self.encoded_step > max_staleness:
+            started = time.perf_counter()
+            self.p_embs = encode_passages(
+                p_encoder,
+                self.store,
+                self.max_context_seq_length,
+                self.tokenizer,
+                self.batch_size,
+                self.device,
+            )
+            self.encoded_step = global_step
+            print(
+                f"encoded {len(self.p_embs)} passages for step {global_step} "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+        return self.p_embs
+
+
+class RecallEvaluator:
+    '''
+    validation question의 정답 문서가 wiki 전체에서 dense top k 안에 드는 비율(recall@k)을 잽니다.
+    정답 context와 본문이 같은 wiki 문서를 정답으로 보고, wiki에 없는 question은 제외합니다.
+    '''
+
+    def __init__(
+        self,
+        data_path,
+        passage_store_dir,
+        tokenizer,
+        top_ks,
+        max_context_seq_length=512,
+        max_question_seq_length=64,
+        batch_size=64,
+        device="cpu",
+        max_index_staleness=0,
+    ):
+        with open(WIKI_CONTEXT_ID_PATH, "rb") as f:
+            wiki_context_id = pickle.load(f)
+        dataset = load_from_disk(data_path)
+        gold_doc_ids = [
+            wiki_context_id.get(context, -1) for context in dataset["context"]
+        ]
+        self.questions = [
+            question
+            for question, doc_id in zip(dataset["question"], gold_doc_ids)
+            if doc_id != -1
+        ]
+        self.gold_doc_ids = np.asarray(
+            [doc_id for doc_id in gold_doc_ids if doc_id != -1], dtype=np.int64
+        )
+        if len(self.questions) < len(gold_doc_ids):
+            print(
+                f"{len(gold_doc_ids) - len(self.questions)} validation contexts "
+                "are not in the wiki and are skipped for recall"
+            )
+
+        self.tokenizer = tokenizer
+        self.top_ks = sorted(top_ks)
+        self.max_question_seq_length = max_question_seq_length
+        self.batch_size = batch_size
+        self.device = device
+        self.max_index_staleness = max_index_staleness
+        store = PassageTokenStore(os.path.join(passage_store_dir, "wiki"))
+        self.doc_ids = store.doc_ids
+        self.index = PassageIndex(
+            store, max_context_seq_length, tokenizer, batch_size, device
+        )
+
+    def evaluate(self, global_step, p_encoder, q_encoder):
+        p_embs = self.index.get(global_step, p_encoder, self.max_index_staleness)
+        q_embs = encode_questions(
+            q_encoder,
+            self.tokenizer,
+            self.questions,
+            self.max_question_seq_length,
+            self.batch_size,
+            self.device,
+        )
+        top_doc_ids = self.doc_ids[search_topk(q_embs, p_embs, self.top_ks[-1])]
+        hits = top_doc_ids == self.gold_doc_ids[:, None]
+        return {f"recall@{k}": float(hits[:, :k].any(axis=1).mean()) for k in self.top_ks}
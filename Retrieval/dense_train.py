@@ -1,8 +1,16 @@
 import argparse
 
 from numpy.lib.function_base import gradient
+from dense_eval import RecallEvaluator
 from dense_model import BertEncoder
-from dense_train_utils import InBatchNegativeRandomDatasetNoTitle, seed_everything
+from dense_train_utils import (
+    DenseBatchCollator,
+    InBatchNegativeRandomDatasetNoTitle,
+    seed_everything,
+)
+from grad_cache import grad_cache_step
+from memory_bank import EmbeddingMemoryBank
+from negative_refresh import NegativeRefresher
 from transformers import (
     AutoTokenizer,
     AdamW,
@@ -11,9 +19,10 @@ from transformers import (
 )
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, Subset, TensorDataset
 from tqdm import tqdm
 import random
+import time
 import wandb
 
 
@@ -21,9 +30,34 @@ def to_cuda(batch):
     return tuple(t.cuda() for t in batch)
 
 
+def get_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
 def train_with_negative(
-    args, p_encoder, q_encoder, train_dataset, valid_dataset, num_neg
+    args,
+    p_encoder,
+    q_encoder,
+    train_dataset,
+    valid_dataset,
+    num_neg,
+    grad_cache_chunk_size=0,
+    memory_bank=None,
+    negative_refresher=None,
+    recall_evaluator=None,
+    recall_eval_steps=0,
+    best_recall_k=None,
+    data_collator=None,
 ):
+    '''
+    grad_cache_chunk_size가 0보다 크면 passage / question을 그 크기씩 나눠 encode 하는
+    gradient cache 방식으로 학습합니다. per_device_train_batch_size를 memory보다 크게 잡을 수 있습니다.
+    memory_bank가 있으면 이전 batch의 passage embedding을 추가 negative로 쓰고,
+    negative_refresher가 있으면 학습 중인 encoder로 hard negative를 background에서 다시 mining 합니다.
+    validation은 args.eval_steps 마다, wiki 전체에 대한 recall@k는 recall_eval_steps 마다 잽니다.
+    best_recall_k를 주면 valid loss 대신 recall@best_recall_k가 좋아질 때 저장합니다.
+    args.bf16이면 forward와 loss를 bfloat16 autocast로 계산합니다(CPU도 가능).
+    '''
     wandb.login()
     wandb.init(
         project="retrieval_aug",
@@ -32,15 +66,25 @@ def train_with_negative(
         group="klue-bert",
     )
 
+    device = get_device()
+    # refresh 된 negative가 worker에도 반영되도록, refresh를 쓰면 epoch 마다 worker를 새로 띄웁니다.
+    dataloader_kwargs = {
+        "collate_fn": data_collator,
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": args.dataloader_pin_memory and device.type == "cuda",
+        "persistent_workers": args.dataloader_num_workers > 0
+        and negative_refresher is None,
+    }
     train_sampler = RandomSampler(train_dataset)
     train_dataloader = DataLoader(
         train_dataset,
         sampler=train_sampler,
         batch_size=args.per_device_train_batch_size,
         drop_last=True,
+        **dataloader_kwargs,
     )
     valid_dataloader = DataLoader(
-        valid_dataset, batch_size=args.per_device_eval_batch_size
+        valid_dataset, batch_size=args.per_device_eval_batch_size, **dataloader_kwargs
     )
 
     # Optimizer
@@ -94,16 +138,17 @@ def train_with_negative(
 
     # Start training!
     global_step = 0
-    if torch.cuda.is_available():
-        p_encoder.cuda()
-        q_encoder.cuda()
+    p_encoder.to(device)
+    q_encoder.to(device)
 
     p_encoder.zero_grad()
     q_encoder.zero_grad()
-    torch.cuda.empty_cache()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
 
     best_loss = 9999  # valid_loss를 저장하는 변수
     best_acc = -1 # acc를 저장하는 변수
+    best_recall = -1 # recall@best_recall_k를 저장하는 변수
     num_epoch = 0 
 
     for _ in range(int(args.num_train_epochs)):
@@ -112,60 +157,66 @@ def train_with_negative(
         train_loss = 0
         train_acc = 0
         train_step = 0
+        train_seconds = 0.0
+        step_started = time.perf_counter()
         for batch in epoch_iterator:
             train_step += 1
             q_encoder.train()
             p_encoder.train()
 
-            neg_batch_ids = []
-            neg_batch_att = []
-            neg_batch_tti = []
-            random_sampling_idx = random.randrange(0, num_neg)
-            for batch_in_sample_idx in range(args.per_device_train_batch_size):
-                '''
-                question과 pos passage는 1대1로 매칭이 되지만
-                hard negative sample들은 해당 question에 대해 num_neg의 수만큼 매칭이 되기 때문에
-                매 학습 루프마다 한개를 랜덤하게 뽑아서 pos passage와 concat을 하여 사용하게 됩니다.
-                '''
-                neg_batch_ids.append(
-                    batch[3][:][batch_in_sample_idx][random_sampling_idx].unsqueeze(0)
-                )
-                neg_batch_att.append(
-                    batch[4][:][batch_in_sample_idx][random_sampling_idx].unsqueeze(0)
-                )
-                neg_batch_tti.append(
-                    batch[5][:][batch_in_sample_idx][random_sampling_idx].unsqueeze(0)
-                )
-            neg_batch_ids = torch.cat(neg_batch_ids)
-            neg_batch_att = torch.cat(neg_batch_att)
-            neg_batch_tti = torch.cat(neg_batch_tti)
+            # hard negative는 dataset이 question 마다 하나씩 뽑아서 pos passage 뒤에 붙입니다.
+            batch = tuple(t.to(device, non_blocking=True) for t in batch)
             p_inputs = {
-                "input_ids": torch.cat((batch[0], neg_batch_ids), 0).cuda(),
-                "attention_mask": torch.cat((batch[1], neg_batch_att), 0).cuda(),
-                "token_type_ids": torch.cat((batch[2], neg_batch_tti), 0).cuda(),
+                "input_ids": torch.cat((batch[0], batch[3]), 0),
+                "attention_mask": torch.cat((batch[1], batch[4]), 0),
+                "token_type_ids": torch.cat((batch[2], batch[5]), 0),
             }
 
             q_inputs = {
-                "input_ids": batch[6].cuda(),
-                "attention_mask": batch[7].cuda(),
-                "token_type_ids": batch[8].cuda(),
+                "input_ids": batch[6],
+                "attention_mask": batch[7],
+                "token_type_ids": batch[8],
             }
 
-            p_outputs = p_encoder(**p_inputs)  # (batch_size * 2, emb_dim)
-            q_outputs = q_encoder(**q_inputs)  # (batch_size, emb_dim)
-
-            # Calculate similarity score & loss
-            sim_scores = torch.matmul(
-                q_outputs, torch.transpose(p_outputs, 0, 1)
-            )  # (batch_size, emb_dim) x (emb_dim, batch_size * 2) = (batch_size, batch_size * 2)
-
             # 정답은 대각선의 성분들 -> 0 1 2 ... batch_size - 1
             targets = torch.arange(0, args.per_device_train_batch_size).long()
-            if torch.cuda.is_available():
-                targets = targets.to("cuda")
+            targets = targets.to(device)
 
-            sim_scores = F.log_softmax(sim_scores, dim=1)
-            loss = F.nll_loss(sim_scores, targets)
+            extra_negatives = (
+                memory_bank.get(global_step) if memory_bank is not None else None
+            )
+            with torch.autocast(
+                device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16
+            ):
+                if grad_cache_chunk_size > 0:
+                    # backward까지 끝난 loss가 나옵니다.
+                    loss, sim_scores, p_outputs = grad_cache_step(
+                        p_encoder,
+                        q_encoder,
+                        p_inputs,
+                        q_inputs,
+                        targets,
+                        grad_cache_chunk_size,
+                        extra_negatives=extra_negatives,
+                    )
+                else:
+                    p_outputs = p_encoder(**p_inputs)  # (batch_size * 2, emb_dim)
+                    q_outputs = q_encoder(**q_inputs)  # (batch_size, emb_dim)
+
+                    # memory bank의 embedding은 정답 뒤에 붙으므로 target은 그대로입니다.
+                    candidates = p_outputs
+                    if extra_negatives is not None:
+                        candidates = torch.cat((p_outputs, extra_negatives))
+
+                    # Calculate similarity score & loss
+                    sim_scores = torch.matmul(
+                        q_outputs, torch.transpose(candidates, 0, 1)
+                    )  # (batch_size, emb_dim) x (emb_dim, batch_size * 2 + memory) = (batch_size, batch_size * 2 + memory)
+
+                    sim_scores = F.log_softmax(sim_scores.float(), dim=1)
+                    loss = F.nll_loss(sim_scores, targets)
+            if grad_cache_chunk_size == 0:
+                loss.backward()
             train_loss += loss.item()
 
             _, preds = torch.max(sim_scores, 1)  #
@@ -174,14 +225,21 @@ def train_with_negative(
                 / args.per_device_train_batch_size
             )
 
-            loss.backward()
             optimizer.step()
             scheduler.step()
             q_encoder.zero_grad()
             p_encoder.zero_grad()
             global_step += 1
+            if memory_bank is not None:
+                memory_bank.push(p_outputs, global_step)
+            if negative_refresher is not None:
+                negative_refresher.step(global_step, p_encoder, q_encoder)
+            # dataloader 대기 시간을 포함한 step 시간입니다. validation 시간은 뺍니다.
+            train_seconds += time.perf_counter() - step_started
+            if global_step % args.logging_steps == 0:
+                wandb.log({"train steps/sec": train_step / train_seconds})
             # validation
-            if train_step % 40 == 0:
+            if train_step % args.eval_steps == 0:
                 valid_loss = 0
                 valid_acc = 0
                 v_epoch_iterator = tqdm(valid_dataloader, desc="Iteration")
@@ -192,8 +250,7 @@ def train_with_negative(
 
                         cur_batch_size = batch[0].size()[0]  
                         # 마지막 배치의 drop last를 안하기 때문에 단순 batch_size를 사용하면 에러발생
-                        if torch.cuda.is_available():
-                            batch = tuple(t.cuda() for t in batch)
+                        batch = tuple(t.to(device) for t in batch)
                         p_inputs = {
                             "input_ids": batch[0],
                             "attention_mask": batch[1],
@@ -212,8 +269,7 @@ def train_with_negative(
                             q_outputs, torch.transpose(p_outputs, 0, 1)
                         )
                         targets = torch.arange(0, cur_batch_size).long()
-                        if torch.cuda.is_available():
-                            targets = targets.to("cuda")
+                        targets = targets.to(device)
 
                         sim_scores = F.log_softmax(sim_scores, dim=1)
                         loss = F.nll_loss(sim_scores, targets)
@@ -231,7 +287,7 @@ def train_with_negative(
                 print(f"valid loss: {valid_loss}")
                 print(f"valid acc: {valid_acc}")
                 wandb.log({"valid loss": valid_loss, "valid acc": valid_acc})
-                if best_loss > valid_loss:
+                if best_recall_k is None and best_loss > valid_loss:
                     # valid_loss가 작아질 때만 저장하고 best_loss와 best_acc를 업데이트
                     # acc에 대해서도 가능합니다.
                     print("best model save")
@@ -239,6 +295,19 @@ def train_with_negative(
                     q_encoder.save_pretrained(args.output_dir + "/q_encoder")
                     best_acc = valid_acc
                     best_loss = valid_loss
+            if recall_evaluator is not None and train_step % recall_eval_steps == 0:
+                recalls = recall_evaluator.evaluate(global_step, p_encoder, q_encoder)
+                print(recalls)
+                wandb.log(recalls)
+                if (
+                    best_recall_k is not None
+                    and recalls[f"recall@{best_recall_k}"] > best_recall
+                ):
+                    print("best model save")
+                    p_encoder.save_pretrained(args.output_dir + "/p_encoder")
+                    q_encoder.save_pretrained(args.output_dir + "/q_encoder")
+                    best_recall = recalls[f"recall@{best_recall_k}"]
+            step_started = time.perf_counter()
 
         num_epoch += 1
         train_loss = train_loss / len(train_dataloader)
@@ -246,7 +315,10 @@ def train_with_negative(
 
         print(f"train loss: {train_loss}")
         print(f"train acc: {train_acc}")
+        print(f"train steps/sec: {train_step / train_seconds:.3f}")
 
+    if negative_refresher is not None:
+        negative_refresher.close()
     wandb.finish()
     return p_encoder, q_encoder
 
@@ -262,6 +334,9 @@ def main(args):
         max_question_seq_length=args.max_question_seq_length,
         neg_num=args.num_neg,
         tokenizer=tokenizer,
+        passage_store_dir=args.passage_store_dir,
+        negatives_path=args.train_negatives_path,
+        num_mining_workers=args.num_mining_workers,
     )
     valid_dataset = InBatchNegativeRandomDatasetNoTitle(
         data_path=args.valid_data_path,
@@ -270,6 +345,9 @@ def main(args):
         max_question_seq_length=args.max_question_seq_length,
         neg_num=args.num_neg,
         tokenizer=tokenizer,
+        passage_store_dir=args.passage_store_dir,
+        negatives_path=args.valid_negatives_path,
+        num_mining_workers=args.num_mining_workers,
     )
 
     p_encoder = BertEncoder.from_pretrained(args.model_checkpoint)
@@ -284,10 +362,75 @@ def main(args):
         num_train_epochs=args.num_train_epochs,
         weight_decay=args.weight_decay,
         gradient_accumulation_steps=args.gradient_accumulation_steps,
+        eval_steps=args.eval_steps,
+        logging_steps=args.logging_steps,
+        dataloader_num_workers=args.dataloader_num_workers,
+        dataloader_pin_memory=args.dataloader_pin_memory,
+        bf16=args.bf16,
+        no_cuda=not torch.cuda.is_available(),
+    )
+
+    if args.num_eval_samples and args.num_eval_samples < len(valid_dataset):
+        # 매 validation 마다 같은 질문으로 비교하도록 처음 한번만 뽑습니다.
+        valid_dataset = Subset(
+            valid_dataset,
+            sorted(random.sample(range(len(valid_dataset)), args.num_eval_samples)),
+        )
+    recall_evaluator = (
+        RecallEvaluator(
+            args.valid_data_path,
+            args.passage_store_dir,
+            tokenizer,
+            args.recall_top_k,
+            max_context_seq_length=args.max_context_seq_length,
+            max_question_seq_length=args.max_question_seq_length,
+            batch_size=args.per_device_eval_batch_size,
+            device=get_device(),
+            max_index_staleness=args.recall_index_max_staleness,
+        )
+        if args.recall_eval_steps > 0
+        else None
+    )
+    if args.best_recall_k is not None and args.best_recall_k not in args.recall_top_k:
+        raise ValueError("--best_recall_k must be one of --recall_top_k")
+
+    memory_bank = (
+        EmbeddingMemoryBank(args.memory_bank_size, args.memory_bank_max_staleness)
+        if args.memory_bank_size > 0
+        else None
+    )
+    negative_refresher = (
+        NegativeRefresher(
+            train_dataset,
+            args.negative_refresh_interval,
+            tokenizer_name=args.model_checkpoint,
+            data_path=args.train_data_path,
+            passage_store_dir=args.passage_store_dir,
+            num_neg=args.num_neg,
+            top_k=args.negative_refresh_top_k,
+            max_context_seq_length=args.max_context_seq_length,
+            max_question_seq_length=args.max_question_seq_length,
+            device=args.negative_refresh_device,
+            num_threads=args.negative_refresh_num_threads,
+        )
+        if args.negative_refresh_interval > 0
+        else None
     )
 
     p_encoder, q_encoder = train_with_negative(
-        training_args, p_encoder, q_encoder, train_dataset, valid_dataset, args.num_neg
+        training_args,
+        p_encoder,
+        q_encoder,
+        train_dataset,
+        valid_dataset,
+        args.num_neg,
+        grad_cache_chunk_size=args.grad_cache_chunk_size,
+        memory_bank=memory_bank,
+        negative_refresher=negative_refresher,
+        recall_evaluator=recall_evaluator,
+        recall_eval_steps=args.recall_eval_steps,
+        best_recall_k=args.best_recall_k,
+        data_collator=DenseBatchCollator(tokenizer, args.max_context_seq_length),
     )
 
 
@@ -319,6 +462,16 @@ if __name__ == "__main__":
         type=str,
         default="/opt/ml/data/elastic_valid_1000.bin",
     )  # elastic search로 valid query와 유사도가 높은 wiki의 문서를 dict로 저장한 경로 (query - top k wiki ids)
+    parser.add_argument(
+        "--train_negatives_path", type=str, default=None
+    )  # Retrieval/mine_negatives.py로 만든 question 별 hard negative id 파일, 없으면 mining 후 저장
+    parser.add_argument("--valid_negatives_path", type=str, default=None)
+    parser.add_argument("--num_mining_workers", type=int, default=1)
+    parser.add_argument(
+        "--passage_store_dir",
+        type=str,
+        default="/opt/ml/data/dense_passage_store",
+    )  # hard negative / 정답 context를 tokenize 해서 memory-map으로 저장해두는 경로
     parser.add_argument("--max_context_seq_length", type=int, default=512)
     parser.add_argument("--max_question_seq_length", type=int, default=64)
     parser.add_argument(
@@ -332,6 +485,47 @@ if __name__ == "__main__":
     parser.add_argument("--num_train_epochs", type=int, default=50)
     parser.add_argument("--weight_decay", type=float, default=0.01)
     parser.add_argument("--num_neg", type=int, default=50)
+    parser.add_argument(
+        "--grad_cache_chunk_size", type=int, default=0
+    )  # 0보다 크면 gradient cache로 이 크기씩 encode 해서 per_device_train_batch_size를 memory와 상관없이 키울 수 있습니다
+
+    parser.add_argument(
+        "--memory_bank_size", type=int, default=0
+    )  # 0보다 크면 이전 batch의 passage embedding을 이 갯수까지 추가 negative로 사용
+    parser.add_argument(
+        "--memory_bank_max_staleness", type=int, default=None
+    )  # memory bank에 넣은 뒤 이 step 수가 지난 embedding은 버립니다
+    parser.add_argument(
+        "--negative_refresh_interval", type=int, default=0
+    )  # 0보다 크면 이 step 마다 학습 중인 encoder로 wiki를 다시 encode 해서 hard negative를 background에서 mining
+    parser.add_argument("--negative_refresh_top_k", type=int, default=100)
+    parser.add_argument("--negative_refresh_device", type=str, default="cpu")
+    parser.add_argument(
+        "--negative_refresh_num_threads", type=int, default=1
+    )  # refresh process의 torch thread 수. 학습 step과 CPU를 나눠 쓰도록 작게 줍니다.
+
+    parser.add_argument("--eval_steps", type=int, default=40)
+    parser.add_argument("--logging_steps", type=int, default=10)
+    parser.add_argument("--dataloader_num_workers", type=int, default=0)
+    parser.add_argument(
+        "--dataloader_pin_memory", type=lambda x: x.lower() == "true", default=True
+    )  # GPU로 보낼 batch를 pinned memory에 올립니다. CPU 학습에서는 무시합니다
+    parser.add_argument(
+        "--bf16", action="store_true"
+    )  # bfloat16 autocast로 학습합니다. CPU에서도 동작합니다
+    parser.add_argument(
+        "--num_eval_samples", type=int, default=None
+    )  # validation에 쓸 question 수, 주지 않으면 전체를 씁니다
+    parser.add_argument(
+        "--recall_eval_steps", type=int, default=0
+    )  # 0보다 크면 이 step 마다 validation question의 wiki 전체 recall@k를 잽니다
+    parser.add_argument("--recall_top_k", type=int, nargs="+", default=[1, 5, 20, 100])
+    parser.add_argument(
+        "--recall_index_max_staleness", type=int, default=0
+    )  # wiki embedding을 만든 뒤 이 step 수까지는 다시 encode 하지 않습니다
+    parser.add_argument(
+        "--best_recall_k", type=int, default=None
+    )  # 주면 valid loss 대신 recall@best_recall_k로 best model을 고릅니다
 
     args = parser.parse_args()
     main(args=args)
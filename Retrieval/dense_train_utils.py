@@ -10,6 +10,76 @@ import pandas as pd
 import pickle
 import re
 
+from mine_negatives import load_or_mine_negatives
+from passage_store import PassageTokenStore
+
+
+WIKI_ID_CONTEXT_PATH = (
+    "/opt/ml/mrc-level2-nlp-08/Retrieval/caching/wiki_id_context_pair.bin"
+)
+WIKI_CONTEXT_ID_PATH = (
+    "/opt/ml/mrc-level2-nlp-08/Retrieval/caching/wiki_context_id_pair.bin"
+)
+
+
+def build_passage_inputs(token_ids_list, max_length, tokenizer):
+    '''
+    special token 없이 저장된 passage token id들에 [CLS], [SEP]를 붙이고
+    batch 안에서 가장 긴 길이까지만 padding 한 encoder 입력을 만듭니다.
+    전체 문서를 tokenizer(truncation=True)로 자른 결과와 같습니다.
+    '''
+    token_ids_list = [token_ids[: max_length - 2] for token_ids in token_ids_list]
+    lengths = np.asarray([len(token_ids) for token_ids in token_ids_list])
+    positions = np.arange(lengths.max() + 2)
+    input_ids = np.full(
+        (len(token_ids_list), len(positions)), tokenizer.pad_token_id, dtype=np.int64
+    )
+    input_ids[:, 0] = tokenizer.cls_token_id
+    # 행 순서대로 이어붙인 token을 한번에 본문 위치에 넣습니다.
+    input_ids[(positions >= 1) & (positions <= lengths[:, None])] = np.concatenate(
+        token_ids_list
+    )
+    input_ids[np.arange(len(lengths)), lengths + 1] = tokenizer.sep_token_id
+    attention_mask = (positions < lengths[:, None] + 2).astype(np.int64)
+    return {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(attention_mask),
+        "token_type_ids": torch.zeros(input_ids.shape, dtype=torch.long),
+    }
+
+
+class DenseBatchCollator:
+    '''
+    InBatchNegativeRandomDatasetNoTitle의 item을 batch 안에서 가장 긴 길이까지만 padding 합니다.
+    pos passage와 hard negative는 학습 때 이어붙이므로 같은 길이로 맞춥니다.
+    (pos 3개, negative 3개, question 3개)의 tensor tuple을 반환합니다.
+    '''
+
+    def __init__(self, tokenizer, max_context_seq_length):
+        self.tokenizer = tokenizer
+        self.max_context_seq_length = max_context_seq_length
+
+    def __call__(self, items):
+        positives, negatives, questions = zip(*items)
+        p_inputs = build_passage_inputs(
+            positives + negatives, self.max_context_seq_length, self.tokenizer
+        )
+        q_inputs = self.tokenizer.pad(
+            {"input_ids": list(questions)}, return_tensors="pt"
+        )
+        batch_size = len(items)
+        return (
+            p_inputs["input_ids"][:batch_size],
+            p_inputs["attention_mask"][:batch_size],
+            p_inputs["token_type_ids"][:batch_size],
+            p_inputs["input_ids"][batch_size:],
+            p_inputs["attention_mask"][batch_size:],
+            p_inputs["token_type_ids"][batch_size:],
+            q_inputs["input_ids"],
+            q_inputs["attention_mask"],
+            torch.zeros_like(q_inputs["input_ids"]),
+        )
+
 
 def seed_everything(seed: int = 42):
     random.seed(seed)
@@ -24,6 +94,9 @@ def seed_everything(seed: int = 42):
 class InBatchNegativeRandomDatasetNoTitle(Dataset):
     '''
     dense retrieval 모델을 학습시킬 데이터 셋
+    hard negative는 question 별 doc id만 들고 있고, token은 __getitem__ 에서
+    memory-map 된 PassageTokenStore에서 읽습니다. negative도 item 마다 하나를 뽑습니다.
+    item은 padding 하지 않은 token id이므로 DataLoader에 DenseBatchCollator를 넘겨야 합니다.
     '''
     def __init__(
         self,
@@ -33,15 +106,10 @@ class InBatchNegativeRandomDatasetNoTitle(Dataset):
         max_question_seq_length: int,
         neg_num,
         tokenizer,
+        passage_store_dir: str,
+        negatives_path: str = None,
+        num_mining_workers: int = 1,
     ):
-        preprocess_data = self.preprocess_pos_neg(
-            data_path,
-            bm25_path,
-            max_context_seq_length,
-            max_question_seq_length,
-            neg_num,
-            tokenizer,
-        )
         '''
         data_path
         -> query - context로 이루어진 dataset의 경로
@@ -60,147 +128,123 @@ class InBatchNegativeRandomDatasetNoTitle(Dataset):
         neg_num
         -> retrieval 학습에 사용할 Inbatch negative 외에 hard negative sample의 갯수
 
-        '''
+        passage_store_dir
+        -> wiki 문서와 정답 context를 special token 없이 tokenize 해둔 PassageTokenStore의 위치
+        처음 한번만 만들고 이후에는 memory-map으로 불러옵니다.
 
-        self.p_input_ids = preprocess_data[0]
-        self.p_attension_mask = preprocess_data[1]
-        self.p_token_type_ids = preprocess_data[2]
+        negatives_path
+        -> mine_negatives.py로 만든 question 별 negative id 파일
+        없으면 num_mining_workers개 process로 mining 해서 저장합니다.
+        '''
+        self.max_context_seq_length = max_context_seq_length
+        self.num_neg = neg_num
 
-        self.np_input_ids = preprocess_data[3]
-        self.np_attension_mask = preprocess_data[4]
-        self.np_token_type_ids = preprocess_data[5]
+        preprocess_data = self.preprocess_pos_neg(
+            data_path,
+            bm25_path,
+            max_question_seq_length,
+            neg_num,
+            tokenizer,
+            passage_store_dir,
+            negatives_path,
+            num_mining_workers,
+        )
+        self.wiki_store = preprocess_data[0]
+        self.positive_store = preprocess_data[1]
+        # (질문 수, num_neg). 0 이상은 wiki doc id, 음수는 -1 - (정답 context의 행 번호)
+        self.negative_ids = preprocess_data[2]
 
-        self.q_input_ids = preprocess_data[6]
-        self.q_attension_mask = preprocess_data[7]
-        self.q_token_type_ids = preprocess_data[8]
+        self.q_input_ids = preprocess_data[3]
 
     def __len__(self):
-        return self.p_input_ids.size()[0]
+        return len(self.negative_ids)
+
+    def set_negative_ids(self, negative_ids):
+        '''
+        학습 중에 새로 mining 한 negative로 바꿉니다. 다음 __getitem__ 부터 적용됩니다.
+        '''
+        assert negative_ids.shape == self.negative_ids.shape
+        self.negative_ids = negative_ids
+
+    def get_negative_token_ids(self, negative_id):
+        if negative_id < 0:
+            return self.positive_store.get_input_ids(-1 - negative_id)
+        return self.wiki_store.get_input_ids(negative_id)
 
     def __getitem__(self, index):
+        '''
+        question과 pos passage는 1대1로 매칭이 되지만
+        hard negative sample들은 해당 question에 대해 num_neg의 수만큼 매칭이 되기 때문에
+        매번 한개를 랜덤하게 뽑아서 사용합니다.
+        '''
+        negative_id = int(self.negative_ids[index, random.randrange(self.num_neg)])
         return (
-            self.p_input_ids[index],
-            self.p_attension_mask[index],
-            self.p_token_type_ids[index],
-            self.np_input_ids[index],
-            self.np_attension_mask[index],
-            self.np_token_type_ids[index],
+            self.positive_store.get_input_ids(index),
+            self.get_negative_token_ids(negative_id),
             self.q_input_ids[index],
-            self.q_attension_mask[index],
-            self.q_token_type_ids[index],
         )
 
     def preprocess_pos_neg(
         self,
         data_path: str,
         bm25_path: str,
-        max_context_seq_length: int,
         max_question_seq_length: int,
         num_neg,
         tokenizer,
+        passage_store_dir: str,
+        negatives_path: str = None,
+        num_mining_workers: int = 1,
     ):
-        data_path = "/opt/ml/mrc-level2-nlp-08/Retrieval/"
-        caching_path = "caching/"
-        caching_context_id_path = data_path + caching_path + "wiki_context_id_pair.bin"
-        caching_id_context_path = data_path + caching_path + "wiki_id_context_pair.bin"
-        caching_id_title_path = data_path + caching_path + "id_title_pair.bin"
-
         # doc_id - context dict
-        with open(caching_id_context_path, "rb") as f:
+        with open(WIKI_ID_CONTEXT_PATH, "rb") as f:
             wiki_id_context = pickle.load(f)
-        # doc_id - title dict
-        with open(caching_id_title_path, "rb") as f:
-            wiki_id_title = pickle.load(f)
-        # context - doc_id dict
-        with open(caching_context_id_path, "rb") as f:
-            wiki_context_id = pickle.load(f)
-
-        # question - doc_id_list
-        with open(bm25_path, "rb") as file:  # query - bm25_doc_id
-            elastic_question_ids = pickle.load(file)
-
-        dataset = load_from_disk(data_path).to_pandas()
-
-        pos_ctx = dataset["context"].to_list()
-        pos_title = dataset["title"].to_list()
-        questions = dataset["question"].to_list()
-
-        # print(len(pos_ctx))
-
-        neg_ctx = []
-        neg_title = []
-        for i in tqdm(range(len(pos_ctx))):
-            q = questions[i]  # i 번째 question
-            ground_truth = pos_ctx[i]  # 정답 문장
-            ground_truth_title = pos_title[i]  # 정답 타이틀
-            cnt = num_neg  # 추가할 negative context 갯수
-            answer = dataset["answers"][i]["text"][0]  # 정답
-            idx = 0
-
-            while cnt != 0:
-                neg_ctx_sample = wiki_id_context[elastic_question_ids[q][idx]]
-                if (ground_truth != neg_ctx_sample) and (not answer in neg_ctx_sample):
-                    # 비슷한 context를 추가하되 정답을 포함하지 않는 문장을 추가한다.
-                    neg_ctx.append(wiki_id_context[int(elastic_question_ids[q][idx])])
-                    neg_title.append(wiki_id_title[int(elastic_question_ids[q][idx])])
-                    cnt -= 1
-                idx += 1
-                if idx == len(elastic_question_ids[q]):
-                    # 예외처리 ex) 정답이 전부 포함되서 추가할 문장이 없을 경우
-                    idx_step = 1
-                    while cnt != 0:
-                        temp_neg = pos_ctx[i - idx_step]
-                        temp_neg_title = pos_title[i - idx_step]
-                        # 이전에 추가된 ground truth context를 negative sample로 생성
-                        neg_ctx.append(temp_neg)
-                        neg_title.append(temp_neg_title)
-                        idx_step += 1
-                        cnt -= 1
 
-        print(f"pos_context cnt: {len(pos_ctx)}")
-        print(f"neg_context cnt: {len(neg_ctx)}")
+        dataset = load_from_disk(data_path)
+        pos_ctx = dataset["context"]
+        questions = dataset["question"]
 
-        print(f"pos * num_neg == neg? : {len(pos_ctx) * num_neg == len(neg_ctx)}")
+        # mining이 본문을 store에서 읽도록 wiki 본문도 같이 저장합니다.
+        wiki_store = PassageTokenStore.load_or_build(
+            os.path.join(passage_store_dir, "wiki"),
+            tokenizer,
+            wiki_id_context,
+            return_offsets_mapping=False,
+            store_text=True,
+        )
 
-        q_seqs = tokenizer(
-            questions,
-            max_length=max_question_seq_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
+        # 비슷한 context를 추가하되 정답을 포함하지 않는 문장을 추가한다.
+        negative_ids = load_or_mine_negatives(
+            negatives_path,
+            dataset,
+            bm25_path,
+            wiki_store,
+            num_neg,
+            num_workers=num_mining_workers,
         )
 
-        p_seqs = tokenizer(
-            pos_ctx,
-            max_length=max_context_seq_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
+        print(f"pos_context cnt: {len(pos_ctx)}")
+        print(f"neg_context cnt: {negative_ids.size}")
+
+        # 정답 context는 wiki 문서와 전처리가 다를 수 있어 dataset 행 번호로 따로 저장합니다.
+        positive_store = PassageTokenStore.load_or_build(
+            os.path.join(passage_store_dir, f"positives-{dataset._fingerprint}"),
+            tokenizer,
+            dict(enumerate(pos_ctx)),
+            return_offsets_mapping=False,
         )
 
-        np_seqs = tokenizer(
-            neg_ctx,
-            max_length=max_context_seq_length,
-            padding="max_length",
+        # padding은 DenseBatchCollator가 batch 단위로 합니다.
+        q_seqs = tokenizer(
+            questions,
+            max_length=max_question_seq_length,
             truncation=True,
-            return_tensors="pt",
         )
 
-        max_len = np_seqs["input_ids"].size(-1)
-        np_seqs["input_ids"] = np_seqs["input_ids"].view(-1, num_neg, max_len)
-        np_seqs["attention_mask"] = np_seqs["attention_mask"].view(-1, num_neg, max_len)
-        np_seqs["token_type_ids"] = np_seqs["token_type_ids"].view(-1, num_neg, max_len)
-
         return (
-            p_seqs["input_ids"],
-            p_seqs["attention_mask"],
-            p_seqs["token_type_ids"],
-            np_seqs["input_ids"],
-            np_seqs["attention_mask"],
-            np_seqs["token_type_ids"],
+            wiki_store,
+            positive_store,
+            negative_ids,
             q_seqs["input_ids"],
-            q_seqs["attention_mask"],
-            q_seqs["token_type_ids"],
         )
 
     def preprocess_text(self, text):
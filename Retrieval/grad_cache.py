@@ -0,0 +1,107 @@
+import torch
+import torch.nn.functional as F
+
+
+class RandContext:
+    '''
+    chunk를 graph 없이 encode 할 때의 RNG 상태를 저장해두고,
+    backward 할 때 같은 dropout mask로 다시 forward 하도록 그 상태로 되돌립니다.
+    '''
+
+    def __init__(self, device):
+        self.device = device
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_state = (
+            torch.cuda.get_rng_state(device) if device.type == "cuda" else None
+        )
+        self.fork = None
+
+    def __enter__(self):
+        self.fork = torch.random.fork_rng(
+            devices=[self.device] if self.cuda_state is not None else []
+        )
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        if self.cuda_state is not None:
+            torch.cuda.set_rng_state(self.cuda_state, self.device)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fork.__exit__(exc_type, exc_value, traceback)
+        self.fork = None
+
+
+def split_inputs(inputs, chunk_size):
+    num_rows = inputs["input_ids"].size(0)
+    return [
+        {key: value[start : start + chunk_size] for key, value in inputs.items()}
+        for start in range(0, num_rows, chunk_size)
+    ]
+
+
+def encode_without_graph(encoder, inputs, chunk_size, device):
+    '''
+    chunk_size개씩 graph 없이 embedding을 구하고, 각 chunk의 RNG 상태를 같이 반환합니다.
+    '''
+    embeddings = []
+    rand_contexts = []
+    with torch.no_grad():
+        for chunk in split_inputs(inputs, chunk_size):
+            rand_contexts.append(RandContext(device))
+            embeddings.append(encoder(**chunk))
+    return torch.cat(embeddings), rand_contexts
+
+
+def backward_with_cached_grads(encoder, inputs, chunk_size, grads, rand_contexts):
+    '''
+    chunk를 같은 RNG 상태로 다시 forward 하고, 전체 batch의 loss에서 구해둔
+    embedding gradient를 흘려 encoder parameter에 gradient를 쌓습니다.
+    '''
+    for chunk, chunk_grads, rand_context in zip(
+        split_inputs(inputs, chunk_size), grads.split(chunk_size), rand_contexts
+    ):
+        with rand_context:
+            embeddings = encoder(**chunk)
+        embeddings.backward(gradient=chunk_grads)
+
+
+def grad_cache_step(
+    p_encoder,
+    q_encoder,
+    p_inputs,
+    q_inputs,
+    targets,
+    chunk_size,
+    extra_negatives=None,
+):
+    '''
+    Gradient Cache(https://arxiv.org/abs/2101.06983) 방식으로 in-batch negative loss의 gradient를 구합니다.
+    chunk_size개씩만 graph를 만들기 때문에 batch 크기와 상관없이 memory 사용량이 일정하고,
+    gradient는 전체 batch를 한번에 forward / backward 한 것과 같습니다.
+    extra_negatives는 gradient가 흐르지 않는 추가 passage embedding 입니다(memory bank).
+    loss, log softmax 된 similarity, passage embedding을 반환하고, optimizer.step()은 호출하는 쪽에서 합니다.
+    '''
+    device = targets.device
+    p_outputs, p_rand_contexts = encode_without_graph(
+        p_encoder, p_inputs, chunk_size, device
+    )
+    q_outputs, q_rand_contexts = encode_without_graph(
+        q_encoder, q_inputs, chunk_size, device
+    )
+    p_outputs.requires_grad_()
+    q_outputs.requires_grad_()
+
+    candidates = p_outputs
+    if extra_negatives is not None:
+        candidates = torch.cat((p_outputs, extra_negatives))
+    sim_scores = torch.matmul(q_outputs, torch.transpose(candidates, 0, 1))
+    sim_scores = F.log_softmax(sim_scores, dim=1)
+    loss = F.nll_loss(sim_scores, targets)
+    loss.backward()
+
+    backward_with_cached_grads(
+        p_encoder, p_inputs, chunk_size, p_outputs.grad, p_rand_contexts
+    )
+    backward_with_cached_grads(
+        q_encoder, q_inputs, chunk_size, q_outputs.grad, q_rand_contexts
+    )
+    return loss.detach(), sim_scores.detach(), p_outputs.detach()
@@ -0,0 +1,41 @@
+import torch
+
+
+class EmbeddingMemoryBank:
+    '''
+    이전 batch들의 passage embedding을 FIFO로 size개까지 들고 있다가 추가 negative로 씁니다.
+    gradient는 흐르지 않고, 넣은 뒤 max_staleness step이 지난 embedding은 encoder가 많이 바뀌었으므로 버립니다.
+    '''
+
+    def __init__(self, size, max_staleness=None):
+        self.size = size
+        self.max_staleness = max_staleness
+        self.embeddings = None
+        self.steps = None
+
+    def __len__(self):
+        return 0 if self.embeddings is None else len(self.embeddings)
+
+    def get(self, global_step):
+        '''
+        global_step에서 쓸 수 있는 embedding을 반환합니다. 없으면 None 입니다.
+        '''
+        if self.embeddings is not None and self.max_staleness is not None:
+            fresh = global_step - self.steps <= self.max_staleness
+            if not fresh.all():
+                self.embeddings = self.embeddings[fresh]
+                self.steps = self.steps[fresh]
+        if not len(self):
+            return None
+        return self.embeddings
+
+    def push(self, embeddings, global_step):
+        embeddings = embeddings.detach()
+        steps = torch.full(
+            (len(embeddings),), global_step, dtype=torch.long, device=embeddings.device
+        )
+        if self.embeddings is not None:
+            embeddings = torch.cat((self.embeddings, embeddings))
+            steps = torch.cat((self.steps, steps))
+        self.embeddings = embeddings[-self.size :]
+        self.steps = steps[-self.size :]
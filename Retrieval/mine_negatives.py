@@ -0,0 +1,224 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from datasets import load_from_disk
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from passage_store import PassageTokenStore
+
+# worker마다 한번 여는 wiki PassageTokenStore. pickle 되는 것은 경로뿐이고 본문은 memory-map으로 읽습니다.
+WIKI_STORE = None
+
+
+def set_wiki_store(wiki_store):
+    global WIKI_STORE
+    WIKI_STORE = wiki_store
+
+
+def mine_shard(shard, max_neg):
+    '''
+    question 마다 bm25 후보를 순서대로 보면서 정답 context가 아니고 정답을 포함하지 않는
+    wiki doc id를 최대 max_neg개 모읍니다.
+    정답과 정답 context는 미리 UTF-8 byte로 바꿔두었으므로 후보 하나의 검사는 store 본문 byte와의 비교뿐입니다.
+    '''
+    mined = []
+    for row, candidate_ids, answer, ground_truth in shard:
+        negative_ids = []
+        for doc_id in candidate_ids:
+            neg_ctx_sample = WIKI_STORE.get_text_bytes(doc_id)
+            if (ground_truth != neg_ctx_sample) and (not answer in neg_ctx_sample):
+                negative_ids.append(doc_id)
+                if len(negative_ids) == max_neg:
+                    break
+        mined.append((row, negative_ids))
+    return mined
+
+
+def mine_negatives(dataset, question_candidate_ids, wiki_store, max_neg, num_workers=1):
+    '''
+    (질문 수, max_neg) negative id 배열과 질문 별로 wiki에서 찾은 negative 수를 반환합니다.
+    wiki_store는 store_text로 만든 wiki PassageTokenStore 입니다.
+    0 이상은 wiki doc id, 음수는 -1 - (negative로 대신 쓰는 이전 질문의 정답 context 행 번호) 입니다.
+    후보에서 max_neg개를 못 채우면 이전 질문들의 정답 context로 채우므로,
+    앞에서 num_neg개만 잘라 써도 num_neg개를 바로 mining 한 것과 같습니다.
+    '''
+    set_wiki_store(wiki_store)
+
+    questions = dataset["question"]
+    contexts = dataset["context"]
+    answers = dataset["answers"]
+    items = [
+        (
+            row,
+            [int(doc_id) for doc_id in question_candidate_ids[question]],
+            answers[row]["text"][0].encode("utf-8"),
+            contexts[row].encode("utf-8"),
+        )
+        for row, question in enumerate(questions)
+    ]
+
+    num_shards = max(1, num_workers * 4)
+    shard_size = (len(items) + num_shards - 1) // num_shards or 1
+    shards = [items[i : i + shard_size] for i in range(0, len(items), shard_size)]
+
+    negative_ids = np.zeros((len(items), max_neg), dtype=np.int64)
+    num_mined = np.zeros(len(items), dtype=np.int32)
+
+    def fill(mined):
+        for row, row_negative_ids in mined:
+            negative_ids[row, : len(row_negative_ids)] = row_negative_ids
+            num_mined[row] = len(row_negative_ids)
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_wiki_store,
+            initargs=(wiki_store,),
+        ) as executor:
+            futures = [executor.submit(mine_shard, shard, max_neg) for shard in shards]
+            for future in tqdm(futures, desc="Mining negatives"):
+                fill(future.result())
+    else:
+        for shard in tqdm(shards, desc="Mining negatives"):
+            fill(mine_shard(shard, max_neg))
+
+    for row in np.flatnonzero(num_mined < max_neg):
+        # 예외처리 ex) 정답이 전부 포함되서 추가할 문장이 없을 경우
+        # 이전에 추가된 ground truth context를 negative sample로 생성
+        for cnt, idx_step in zip(
+            range(num_mined[row], max_neg), range(1, max_neg + 1)
+        ):
+            negative_ids[row, cnt] = -1 - ((row - idx_step) % len(items))
+    return negative_ids, num_mined
+
+
+def save_negatives(negatives_path, negative_ids, num_mined, meta):
+    tmp_path = negatives_path + f".tmp{os.getpid()}.npz"
+    np.savez(
+        tmp_path,
+        negative_ids=negative_ids.astype(np.int32),
+        num_mined=num_mined,
+        meta=np.asarray(json.dumps(meta, ensure_ascii=False)),
+    )
+    os.replace(tmp_path, negatives_path)
+
+
+def load_negatives(negatives_path, num_neg, dataset=None, wiki_store=None):
+    '''
+    mining 결과에서 질문 별 앞 num_neg개의 negative id를 불러옵니다.
+    '''
+    with np.load(negatives_path) as negatives:
+        meta = json.loads(str(negatives["meta"]))
+        negative_ids = negatives["negative_ids"]
+    if num_neg > negative_ids.shape[1]:
+        raise ValueError(
+            f"{negatives_path} has {negative_ids.shape[1]} negatives per question, "
+            f"{num_neg} requested"
+        )
+    if dataset is not None and meta["dataset"] != dataset._fingerprint:
+        raise ValueError(f"{negatives_path} was mined for a different dataset")
+    if wiki_store is not None and meta["corpus"] != wiki_store.meta["corpus"]:
+        raise ValueError(f"{negatives_path} was mined from a different wiki")
+    return negative_ids[:, :num_neg].astype(np.int64)
+
+
+def load_or_mine_negatives(
+    negatives_path,
+    dataset,
+    bm25_path,
+    wiki_store,
+    num_neg,
+    num_workers=1,
+):
+    if negatives_path and os.path.isfile(negatives_path):
+        return load_negatives(negatives_path, num_neg, dataset, wiki_store)
+
+    with open(bm25_path, "rb") as file:  # query - bm25_doc_id
+        question_candidate_ids = pickle.load(file)
+    negative_ids, num_mined = mine_negatives(
+        dataset, question_candidate_ids, wiki_store, num_neg, num_workers
+    )
+    if negatives_path:
+        save_negatives(
+            negatives_path,
+            negative_ids,
+            num_mined,
+            {
+                "dataset": dataset._fingerprint,
+                "bm25_path": bm25_path,
+                "corpus": wiki_store.meta["corpus"],
+            },
+        )
+    return negative_ids
+
+
+def main(args):
+    with open(args.wiki_id_context_path, "rb") as f:
+        wiki_id_context = pickle.load(f)
+    wiki_store = PassageTokenStore.load_or_build(
+        os.path.join(args.passage_store_dir, "wiki"),
+        AutoTokenizer.from_pretrained(args.tokenizer),
+        wiki_id_context,
+        return_offsets_mapping=False,
+        store_text=True,
+    )
+    with open(args.bm25_path, "rb") as file:
+        question_candidate_ids = pickle.load(file)
+    dataset = load_from_disk(args.data_path)
+
+    started = time.perf_counter()
+    negative_ids, num_mined = mine_negatives(
+        dataset, question_candidate_ids, wiki_store, args.max_neg, args.num_workers
+    )
+    seconds = time.perf_counter() - started
+    save_negatives(
+        args.output_path,
+        negative_ids,
+        num_mined,
+        {
+            "dataset": dataset._fingerprint,
+            "bm25_path": args.bm25_path,
+            "corpus": wiki_store.meta["corpus"],
+        },
+    )
+    print(
+        f"mined {negative_ids.shape} negatives in {seconds:.1f}s, "
+        f"{int((num_mined < args.max_neg).sum())} questions padded with previous positives"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_path", type=str, default="/opt/ml/data/new_train_dataset/train"
+    )
+    parser.add_argument(
+        "--bm25_path", type=str, default="/opt/ml/data/elastic_train_1000.bin"
+    )  # elastic search로 query와 유사도가 높은 wiki의 문서를 dict로 저장한 경로 (query - top k wiki ids)
+    parser.add_argument(
+        "--wiki_id_context_path",
+        type=str,
+        default="/opt/ml/mrc-level2-nlp-08/Retrieval/caching/wiki_id_context_pair.bin",
+    )
+    parser.add_argument(
+        "--passage_store_dir", type=str, default="/opt/ml/data/dense_passage_store"
+    )  # dense_train.py의 --passage_store_dir와 같은 경로를 주면 wiki store를 같이 씁니다.
+    parser.add_argument(
+        "--tokenizer", type=str, default="klue/bert-base"
+    )  # wiki store가 없을 때 만들 tokenizer (dense_train.py의 --model_checkpoint)
+    parser.add_argument(
+        "--output_path", type=str, default="/opt/ml/data/negatives_train.npz"
+    )
+    parser.add_argument("--max_neg", type=int, default=100)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    main(args=args)
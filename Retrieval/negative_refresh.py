@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from datasets import load_from_disk
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from dense_model import BertEncoder
+from dense_train_utils import build_passage_inputs
+from mine_negatives import mine_negatives
+from passage_store import PassageTokenStore
+
+
+def encode_passages(p_encoder, store, max_length, tokenizer, batch_size, device):
+    '''
+    store의 모든 passage를 encode 해서 store 행 순서의 (문서 수, emb_dim) 배열로 반환합니다.
+    padding을 줄이려고 길이 순으로 batch를 만듭니다.
+    '''
+    doc_lengths = np.diff(store.doc_pointers)
+    order = np.argsort(doc_lengths, kind="stable")
+    p_embs = None
+    p_encoder.eval()
+    with torch.no_grad():
+        for start in tqdm(range(0, len(order), batch_size), desc="Encoding passages"):
+            rows = order[start : start + batch_size]
+            p_inputs = build_passage_inputs(
+                [
+                    store.input_ids[store.doc_pointers[row] : store.doc_pointers[row + 1]]
+                    for row in rows
+                ],
+                max_length,
+                tokenizer,
+            )
+            outputs = p_encoder(
+                **{key: value.to(device) for key, value in p_inputs.items()}
+            )
+            outputs = outputs.float().cpu().numpy()
+            if p_embs is None:
+                p_embs = np.zeros((len(order), outputs.shape[1]), dtype=np.float32)
+            p_embs[rows] = outputs
+    return p_embs
+
+
+def encode_questions(q_encoder, tokenizer, questions, max_length, batch_size, device):
+    q_embs = []
+    q_encoder.eval()
+    with torch.no_grad():
+        for start in range(0, len(questions), batch_size):
+            q_inputs = tokenizer(
+                questions[start : start + batch_size],
+                max_length=max_length,
+                padding=True,
+                truncation=True,
+                return_tensors="pt",
+            )
+            outputs = q_encoder(
+                **{key: value.to(device) for key, value in q_inputs.items()}
+            )
+            q_embs.append(outputs.float().cpu().numpy())
+    return np.concatenate(q_embs)
+
+
+def search_topk(q_embs, p_embs, top_k, batch_size=256):
+    '''
+    내적이 큰 순서로 top_k개 passage의 행 번호를 반환합니다.
+    '''
+    p_embs = torch.from_numpy(p_embs)
+    top_k = min(top_k, len(p_embs))
+    rows = []
+    for start in range(0, len(q_embs), batch_size):
+        scores = torch.from_numpy(q_embs[start : start + batch_size]) @ p_embs.T
+        rows.append(torch.topk(scores, top_k, dim=1).indices.numpy())
+    return np.concatenate(rows)
+
+
+def refresh_negatives(
+    config,
+    p_state_dict,
+    q_state_dict,
+    tokenizer_name,
+    data_path,
+    passage_store_dir,
+    num_neg,
+    top_k,
+    max_context_seq_length,
+    max_question_seq_length,
+    batch_size,
+    device,
+    num_threads,
+):
+    '''
+    background process에서 도는 함수입니다.
+    학습 중인 encoder의 snapshot으로 wiki 전체와 question을 다시 encode 하고,
+    dense top_k 후보에서 mine_negatives와 같은 규칙으로 hard negative를 다시 고릅니다.
+    p_state_dict / q_state_dict는 학습 process와 공유하는 shared memory tensor라서 넘길 때 복사되지 않습니다.
+    '''
+    started = time.perf_counter()
+    # 학습 step과 CPU를 나눠 쓰도록 refresh process의 torch thread 수를 제한합니다.
+    torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    p_encoder = BertEncoder(config)
+    p_encoder.load_state_dict(p_state_dict)
+    q_encoder = BertEncoder(config)
+    q_encoder.load_state_dict(q_state_dict)
+    p_encoder.to(device)
+    q_encoder.to(device)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    wiki_store = PassageTokenStore(os.path.join(passage_store_dir, "wiki"))
+    p_embs = encode_passages(
+        p_encoder, wiki_store, max_context_seq_length, tokenizer, batch_size, device
+    )
+    dataset = load_from_disk(data_path)
+    questions = dataset["question"]
+    q_embs = encode_questions(
+        q_encoder, tokenizer, questions, max_question_seq_length, batch_size, device
+    )
+    candidate_rows = search_topk(q_embs, p_embs, top_k)
+    question_candidate_ids = {
+        question: wiki_store.doc_ids[rows].tolist()
+        for question, rows in zip(questions, candidate_rows)
+    }
+
+    negative_ids, _ = mine_negatives(
+        dataset, question_candidate_ids, wiki_store, num_neg
+    )
+    return negative_ids, time.perf_counter() - started
+
+
+def snapshot_state_dict(encoder, shared_state_dict=None):
+    '''
+    encoder weight를 CPU shared memory tensor로 복사합니다. 처음에만 만들고 이후에는 같은 tensor에 덮어씁니다.
+    이전 refresh가 끝난 뒤에만 부르므로 background process가 읽는 중인 tensor를 바꾸지 않습니다.
+    '''
+    state_dict = encoder.state_dict()
+    if shared_state_dict is None:
+        return {
+            key: value.detach().to("cpu", copy=True).share_memory_()
+            for key, value in state_dict.items()
+        }
+    with torch.no_grad():
+        for key, value in state_dict.items():
+            shared_state_dict[key].copy_(value.detach())
+    return shared_state_dict
+
+
+class NegativeRefresher:
+    '''
+    refresh_interval step 마다 p_encoder / q_encoder의 snapshot을 background process로 보내
+    hard negative를 다시 mining 하고, 끝난 결과는 다음 poll에서 train_dataset에 반영합니다.
+    이전 refresh가 아직 돌고 있으면 기다리지 않고 이번 refresh를 건너뜁니다.
+    snapshot은 처음에 한번 만든 shared memory tensor에 weight를 copy_ 하는 것이라
+    학습 thread는 그 copy만큼만 멈추고, 그 시간은 refresh 결과와 함께 출력합니다.
+    '''
+
+    def __init__(
+        self,
+        train_dataset,
+        refresh_interval,
+        tokenizer_name,
+        data_path,
+        passage_store_dir,
+        num_neg,
+        top_k=100,
+        max_context_seq_length=512,
+        max_question_seq_length=64,
+        batch_size=64,
+        device="cpu",
+        num_threads=1,
+    ):
+        self.train_dataset = train_dataset
+        self.refresh_interval = refresh_interval
+        self.refresh_kwargs = {
+            "tokenizer_name": tokenizer_name,
+            "data_path": data_path,
+            "passage_store_dir": passage_store_dir,
+            "num_neg": num_neg,
+            "top_k": top_k,
+            "max_context_seq_length": max_context_seq_length,
+            "max_question_seq_length": max_question_seq_length,
+            "batch_size": batch_size,
+            "device": device,
+            "num_threads": num_threads,
+        }
+        # CUDA를 쓰는 학습 process를 fork 하지 않도록 spawn 합니다.
+        self.executor = ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.future = None
+        self.submitted_step = 0
+        self.last_refresh_step = 0
+        self.p_state_dict = None
+        self.q_state_dict = None
+        self.snapshot_seconds = 0.0
+
+    def poll(self):
+        '''
+        끝난 refresh가 있으면 반영하고, 그 negative를 만든 encoder의 step을 반환합니다.
+        '''
+        if self.future is None or not self.future.done():
+            return None
+        negative_ids, seconds = self.future.result()
+        self.future = None
+        self.train_dataset.set_negative_ids(negative_ids)
+        print(
+            f"refreshed hard negatives with the encoder of step "
+            f"{self.submitted_step} in {seconds:.1f}s "
+            f"(snapshot stalled training for {self.snapshot_seconds * 1000:.0f}ms)"
+        )
+        return self.submitted_step
+
+    def step(self, global_step, p_encoder, q_encoder):
+        refreshed_step = self.poll()
+        if (
+            self.future is not None
+            or global_step - self.last_refresh_step < self.refresh_interval
+        ):
+            return refreshed_step
+        started = time.perf_counter()
+        self.p_state_dict = snapshot_state_dict(p_encoder, self.p_state_dict)
+        self.q_state_dict = snapshot_state_dict(q_encoder, self.q_state_dict)
+        self.snapshot_seconds = time.perf_counter() - started
+        self.future = self.executor.submit(
+            refresh_negatives,
+            p_encoder.config,
+            self.p_state_dict,
+            self.q_state_dict,
+            **self.refresh_kwargs,
+        )
+        self.submitted_step = self.last_refresh_step = global_step
+        return refreshed_step
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+
+def get_tokenizer_fingerprint(tokenizer):
+    '''
+    이름이 같아도 vocab이나 special token, normalizer 설정이 다르면 다른 feature가 나오므로
+    tokenizer 내용으로 hash를 만듭니다.
+    '''
+    sha = hashlib.sha1()
+    sha.update(type(tokenizer).__name__.encode("utf-8"))
+    sha.update(
+        json.dumps(tokenizer.get_vocab(), sort_keys=True, ensure_ascii=False).encode(
+            "utf-8"
+        )
+    )
+    sha.update(
+        json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode("utf-8")
+    )
+    if getattr(tokenizer, "is_fast", False):
+        sha.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+class PassageTokenStore:
+    '''
+    wiki 문서를 한번만 tokenize 하여 doc id 별 input_ids와 offset_mapping을
+    memory-map 된 numpy 배열로 저장합니다.
+    special token 없이 문서 단위로 저장하기 때문에, 같은 문서가 여러 query나
+    여러 순서(context shuffle)로 등장해도 다시 tokenize 하지 않습니다.
+    store_text로 만들면 문서 본문도 UTF-8 byte로 같이 저장해서 본문이 필요한 작업(hard negative mining)이
+    wiki dict 없이 memory-map으로 읽을 수 있습니다.
+    '''
+
+    VERSION = 2
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        self.doc_ids = np.load(os.path.join(store_path, "doc_ids.npy"))
+        self.doc_pointers = np.load(os.path.join(store_path, "doc_pointers.npy"))
+        self.char_lengths = np.load(os.path.join(store_path, "char_lengths.npy"))
+        self.input_ids = np.load(
+            os.path.join(store_path, "input_ids.npy"), mmap_mode="r"
+        )
+        offsets_path = os.path.join(store_path, "offset_mapping.npy")
+        self.offset_mapping = (
+            np.load(offsets_path, mmap_mode="r")
+            if os.path.isfile(offsets_path)
+            else None
+        )
+        self.text = None
+        self.text_pointers = None
+        if os.path.isfile(os.path.join(store_path, "text.npy")):
+            self.text = np.load(os.path.join(store_path, "text.npy"), mmap_mode="r")
+            self.text_pointers = np.load(os.path.join(store_path, "text_pointers.npy"))
+        self.doc_id_to_row = {
+            int(doc_id): row for row, doc_id in enumerate(self.doc_ids)
+        }
+
+    def __getstate__(self):
+        # datasets.map(num_proc=...)로 넘길 때 memmap 내용 대신 경로만 pickle 합니다.
+        return {"store_path": self.store_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_path"])
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return int(doc_id) in self.doc_id_to_row
+
+    def get_input_ids(self, doc_id):
+        row = self.doc_id_to_row[int(doc_id)]
+        return self.input_ids[self.doc_pointers[row] : self.doc_pointers[row + 1]]
+
+    def get_offset_mapping(self, doc_id):
+        row = self.doc_id_to_row[int(doc_id)]
+        return self.offset_mapping[
+            self.doc_pointers[row] : self.doc_pointers[row + 1]
+        ]
+
+    def get_char_length(self, doc_id):
+        return int(self.char_lengths[self.doc_id_to_row[int(doc_id)]])
+
+    def get_text_bytes(self, doc_id):
+        # UTF-8은 글자 경계가 byte로 구분되므로 byte 부분 문자열 검사는 str 부분 문자열 검사와 같습니다.
+        row = self.doc_id_to_row[int(doc_id)]
+        return self.text[
+            self.text_pointers[row] : self.text_pointers[row + 1]
+        ].tobytes()
+
+    @staticmethod
+    def corpus_fingerprint(doc_ids, texts):
+        # 문서 수가 같아도 내용이나 id가 바뀌면 다시 만들도록 문서 전체로 hash를 만듭니다.
+        sha = hashlib.sha1()
+        for doc_id, text in zip(doc_ids, texts):
+            sha.update(f"{int(doc_id)}\0{len(text)}\0".encode("utf-8"))
+            sha.update(text.encode("utf-8"))
+        return sha.hexdigest()[:16]
+
+    @classmethod
+    def build(
+        cls,
+        store_path,
+        tokenizer,
+        doc_ids,
+        texts,
+        return_offsets_mapping=True,
+        store_text=False,
+        batch_size=1000,
+    ):
+        tmp_path = store_path.rstrip("/") + f".tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        input_ids = []
+        offset_mapping = []
+        doc_lengths = []
+        for i in tqdm(range(0, len(texts), batch_size), desc="Tokenizing passages"):
+            tokenized = tokenizer(
+                list(texts[i : i + batch_size]),
+                add_special_tokens=False,
+                return_offsets_mapping=return_offsets_mapping,
+            )
+            for j, ids in enumerate(tokenized["input_ids"]):
+                input_ids.append(np.asarray(ids, dtype=np.int32))
+                doc_lengths.append(len(ids))
+                if return_offsets_mapping:
+                    offset_mapping.append(
+                        np.asarray(tokenized["offset_mapping"][j], dtype=np.int32)
+                        .reshape(-1, 2)
+                    )
+
+        doc_pointers = np.zeros(len(doc_lengths) + 1, dtype=np.int64)
+        np.cumsum(doc_lengths, out=doc_pointers[1:])
+        np.save(os.path.join(tmp_path, "doc_ids.npy"), np.asarray(doc_ids, np.int64))
+        np.save(os.path.join(tmp_path, "doc_pointers.npy"), doc_pointers)
+        np.save(
+            os.path.join(tmp_path, "char_lengths.npy"),
+            np.asarray([len(text) for text in texts], dtype=np.int64),
+        )
+        np.save(
+            os.path.join(tmp_path, "input_ids.npy"),
+            np.concatenate(input_ids) if input_ids else np.zeros(0, np.int32),
+        )
+        if return_offsets_mapping:
+            np.save(
+                os.path.join(tmp_path, "offset_mapping.npy"),
+                np.concatenate(offset_mapping)
+                if offset_mapping
+                else np.zeros((0, 2), np.int32),
+            )
+        if store_text:
+            text_bytes = [text.encode("utf-8") for text in texts]
+            text_pointers = np.zeros(len(text_bytes) + 1, dtype=np.int64)
+            np.cumsum([len(text) for text in text_bytes], out=text_pointers[1:])
+            np.save(os.path.join(tmp_path, "text_pointers.npy"), text_pointers)
+            np.save(
+                os.path.join(tmp_path, "text.npy"),
+                np.frombuffer(b"".join(text_bytes), dtype=np.uint8),
+            )
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": cls.VERSION,
+                    "tokenizer": get_tokenizer_fingerprint(tokenizer),
+                    "corpus": cls.corpus_fingerprint(doc_ids, texts),
+                    "num_docs": len(doc_lengths),
+                    "num_tokens": int(doc_pointers[-1]),
+                },
+                f,
+                ensure_ascii=False,
+                indent=4,
+            )
+
+        # 다른 프로세스가 같은 store를 동시에 만들어도 완성된 store만 보이도록 rename 합니다.
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path)
+        os.replace(tmp_path, store_path)
+        return cls(store_path)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        store_path,
+        tokenizer,
+        wiki_id_context_dict,
+        return_offsets_mapping=True,
+        store_text=False,
+    ):
+        '''
+        store_path에 같은 tokenizer와 같은 wiki로 만든 store가 있으면 불러오고, 없으면 새로 만듭니다.
+        '''
+        doc_ids = list(wiki_id_context_dict.keys())
+        texts = [wiki_id_context_dict[doc_id] for doc_id in doc_ids]
+        meta_path = os.path.join(store_path, "meta.json")
+        if os.path.isfile(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if (
+                meta["version"] == cls.VERSION
+                and meta["tokenizer"] == get_tokenizer_fingerprint(tokenizer)
+                and meta["corpus"] == cls.corpus_fingerprint(doc_ids, texts)
+                and (
+                    not return_offsets_mapping
+                    or os.path.isfile(os.path.join(store_path, "offset_mapping.npy"))
+                )
+                and (
+                    not store_text
+                    or os.path.isfile(os.path.join(store_path, "text.npy"))
+                )
+            ):
+                return cls(store_path)
+
+        return cls.build(
+            store_path,
+            tokenizer,
+            doc_ids,
+            texts,
+            return_offsets_mapping=return_offsets_mapping,
+            store_text=store_text,
+        )
@@ -1,7 +1,10 @@
+import copy
 import pickle
 import os
+import threading
+from contextlib import contextmanager
+
 import pandas as pd
-from elasticsearch import Elasticsearch, helpers
 from rank_bm25 import BM25Okapi
 from transformers import AutoTokenizer
 from tqdm import tqdm
@@ -10,6 +13,12 @@ import torch
 from torch.utils.data import DataLoader, TensorDataset, SequentialSampler
 import numpy as np
 
+try:
+    from elasticsearch import Elasticsearch, helpers
+except ImportError:
+    # elasticsearch가 없으면 SparseRetrieval은 BM25Okapi만 사용합니다.
+    Elasticsearch = None
+
 
 class Retrieval:
     def __init__(
@@ -18,12 +27,29 @@ class Retrieval:
         data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
         caching_path="caching/",
         context_path="/opt/ml/data/preprocess_wiki.json",
+        num_threads=None,
+        load_wiki=True,
     ):
         '''
         Retrieval의 최상위 클래스
         Sparse, Dense, Hybrid 모두 이 클래스를 상속받아서 사용합니다.        
+        init이 끝난 뒤의 검색 함수들은 불러온 상태를 바꾸지 않으므로 여러 thread에서 같은 객체로 동시에 검색할 수 있습니다.
+        num_threads는 torch intra-op thread 수 입니다. torch.set_num_threads는 OpenMP / MKL /
+        native thread pool 모두에 process 전체로 적용되므로 검색 중이 아니라 init에서 한번만 정합니다.
+        load_wiki가 False이면 wiki와 id / context dict를 불러오지 않습니다. (sharded retrieval)
         '''
         self.tokenizer = tokenizer
+        self.num_threads = num_threads
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.thread_local = threading.local()
+        if load_wiki:
+            self.load_wiki(data_path, caching_path, context_path)
+
+    def load_wiki(self, data_path, caching_path, context_path):
+        '''
+        wiki와 context / id / title dict를 불러옵니다. dict는 caching_path에 cache 합니다.
+        '''
         self.wiki_dataset = pd.read_json(context_path, orient="index")
 
         caching_context_id_path = data_path + caching_path + "wiki_context_id_pair.bin"
@@ -59,6 +85,25 @@ class Retrieval:
 
         self.wiki_corpus = list(self.wiki_context_id_dict.keys())
 
+    def get_tokenizer(self):
+        '''
+        fast tokenizer는 호출할 때마다 padding / truncation 설정을 바꾸기 때문에
+        thread끼리 공유하면 "Already borrowed" 에러가 납니다. thread마다 복사본을 씁니다.
+        '''
+        tokenizer = getattr(self.thread_local, "tokenizer", None)
+        if tokenizer is None:
+            tokenizer = copy.deepcopy(self.tokenizer)
+            self.thread_local.tokenizer = tokenizer
+        return tokenizer
+
+    @contextmanager
+    def inference_context(self):
+        '''
+        검색 한번을 감싸는 context 입니다. autograd 기록을 끕니다.
+        '''
+        with torch.inference_mode():
+            yield
+
     def get_topk_doc_id_and_score(self, query, top_k):
         '''
         query를 입력받아 wiki context에서 점수가 높은 top_k개의 context의 id와 해당 score를 
@@ -82,12 +127,15 @@ class SparseRetrieval(Retrieval):
         data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
         caching_path="caching/",
         context_path="/opt/ml/data/preprocess_wiki.json",
+        use_elasticsearch=True,
+        num_threads=None,
     ):
         super().__init__(
             tokenizer,
             data_path=data_path,
             caching_path=caching_path,
             context_path=context_path,
+            num_threads=num_threads,
         )
         self.tokenized_corpus = [
             self.tokenizer.tokenize(context) for context in self.wiki_corpus
@@ -101,6 +149,12 @@ class SparseRetrieval(Retrieval):
             with open(caching_bm25_path, "wb") as f:
                 pickle.dump(self.bm25, f)
 
+        self.es = None
+        if not use_elasticsearch:
+            return
+        if Elasticsearch is None:
+            print("elasticsearch is not installed, falling back to BM25Okapi")
+            return
         self.es = Elasticsearch()
         self.index_name, self.index_setting = self.__get_index_settings()
         if self.es.indices.exists(self.index_name):
@@ -116,34 +170,43 @@ class SparseRetrieval(Retrieval):
             self.es.search(index=self.index_name, q="test", size=10)
         ####
 
-    def get_topk_doc_id_and_score(self, query, top_k):
-
-        try:
-            res = self.es.search(index=self.index_name, q=query, size=top_k)
-            hits = res["hits"]["hits"]
-            top_k_list = []
-            top_k_score = []
-
-            for hit in hits:
-                wiki_id = hit["_id"]
-                ctx = hit["_source"]["content"]
-                score = hit["_score"]
+    def get_es(self):
+        # Elasticsearch client는 thread마다 따로 만들어 connection을 공유하지 않습니다.
+        if self.es is None:
+            return None
+        es = getattr(self.thread_local, "es", None)
+        if es is None:
+            es = Elasticsearch()
+            self.thread_local.es = es
+        return es
 
-                top_k_list.append(self.wiki_context_id_dict[ctx])
-                top_k_score.append(score)
-
-        except Exception as e:
-            top_k_list = []
-            tokenized_query = self.tokenizer.tokenize(query)
-            top_n_text = self.bm25.get_top_n(tokenized_query, self.wiki_corpus, n=top_k)
-
-            for ctx in top_n_text:
-                top_k_list.append(self.wiki_context_id_dict[ctx])
-            top_k_score = self.bm25.get_scores(tokenized_query).tolist()
-            top_k_score.sort(reverse=True)
-            top_k_score = top_k_score[:top_k]
-
-        return top_k_list, top_k_score
+    def get_topk_doc_id_and_score(self, query, top_k):
+        es = self.get_es()
+        if es is not None:
+            try:
+                res = es.search(index=self.index_name, q=query, size=top_k)
+                hits = res["hits"]["hits"]
+                top_k_list = []
+                top_k_score = []
+
+                for hit in hits:
+                    ctx = hit["_source"]["content"]
+                    score = hit["_score"]
+
+                    top_k_list.append(self.wiki_context_id_dict[ctx])
+                    top_k_score.append(score)
+                return top_k_list, top_k_score
+            except Exception:
+                pass
+
+        return self.get_bm25_topk_doc_id_and_score(query, top_k)
+
+    def get_bm25_topk_doc_id_and_score(self, query, top_k):
+        # score를 한 번만 계산해서 순위와 점수를 같이 구합니다.
+        scores = self.bm25.get_scores(self.get_tokenizer().tokenize(query))
+        rank = np.argsort(-scores, kind="stable")[:top_k]
+        top_k_list = [self.wiki_context_id_dict[self.wiki_corpus[i]] for i in rank]
+        return top_k_list, scores[rank].tolist()
 
     def get_topk_doc_id_and_score_for_querys(self, querys, top_k):
         query_ids = {}
@@ -210,19 +273,24 @@ class DenseRetrieval(Retrieval):
         data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
         caching_path="caching/",
         context_path="/opt/ml/data/preprocess_wiki.json",
+        num_threads=None,
     ):
         super().__init__(
             tokenizer,
             data_path=data_path,
             caching_path=caching_path,
             context_path=context_path,
+            num_threads=num_threads,
         )
 
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.q_encoder = BertEncoder.from_pretrained(data_path + q_encoder_path)
         self.p_encoder = BertEncoder.from_pretrained(data_path + p_encoder_path)
-        if torch.cuda.is_available():
-            self.p_encoder.cuda()
-            self.q_encoder.cuda()
+        # 검색 중에는 encoder의 mode를 바꾸지 않도록 init에서 한번만 eval로 둡니다.
+        for encoder in [self.p_encoder, self.q_encoder]:
+            encoder.to(self.device)
+            encoder.eval()
+            encoder.requires_grad_(False)
 
         dense_embedding_path = data_path + caching_path + "dense_embedding.bin"
 
@@ -233,6 +301,13 @@ class DenseRetrieval(Retrieval):
             self.p_embs = self.get_wiki_dense_embedding(self.p_encoder)
             with open(dense_embedding_path, "wb") as f:
                 pickle.dump(self.p_embs, f)
+        self.p_embs_tensor = torch.from_numpy(
+            np.asarray(self.p_embs, dtype=np.float32)
+        ).to(self.device)
+        self.p_embs.setflags(write=False)
+        # p_embs의 행 순서(wiki_corpus 순서)대로의 doc id 입니다.
+        self.doc_ids = [self.wiki_context_id_dict[ctx] for ctx in self.wiki_corpus]
+        self.doc_id_rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
 
     def get_wiki_dense_embedding(self, p_encoder):
         eval_batch_size = 32
@@ -263,7 +338,7 @@ class DenseRetrieval(Retrieval):
             epoch_iterator = tqdm(dataloader, desc="Iteration", position=0, leave=True)
             p_encoder.eval()
             for _, batch in enumerate(epoch_iterator):
-                batch = tuple(t.cuda() for t in batch)
+                batch = tuple(t.to(self.device) for t in batch)
                 p_inputs = {
                     "input_ids": batch[0],
                     "attention_mask": batch[1],
@@ -271,38 +346,17 @@ class DenseRetrieval(Retrieval):
                 }
                 outputs = p_encoder(**p_inputs).to("cpu").numpy()
                 p_embs.extend(outputs)
-        torch.cuda.empty_cache()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
         p_embs = np.array(p_embs)
 
         return p_embs
 
-    def get_topk_doc_id_and_score(self, query, top_k):
-        with torch.no_grad():
-            self.q_encoder.eval()
-
-            q_seqs_val = self.tokenizer(
-                [query], padding="max_length", truncation=True, return_tensors="pt"
-            ).to("cuda")
-            q_emb = self.q_encoder(**q_seqs_val).to("cpu")  # (num_query, emb_dim)
-
-            p_embs = torch.Tensor(self.p_embs).squeeze()  # (num_passage, emb_dim)
-            dot_prod_scores = torch.matmul(q_emb, torch.transpose(p_embs, 0, 1))
-
-            rank = (
-                torch.argsort(dot_prod_scores, dim=1, descending=True)
-                .squeeze()
-                .to("cpu")
-                .numpy()
-                .tolist()
-            )
-            scores = []
-            for r in rank[:top_k]:
-                scores.append(dot_prod_scores[0][r].item())
-
-        return rank[:top_k], scores
-
-    def get_topk_doc_id_and_score_for_querys(self, querys, top_k):
-        q_seqs = self.tokenizer(
+    def get_query_embedding(self, querys, batch_size=32, show_progress=False):
+        '''
+        query들을 batch_size개씩 encode 해서 self.device 위의 (query 수, emb_dim) tensor로 반환합니다.
+        '''
+        q_seqs = self.get_tokenizer()(
             querys,
             max_length=64,
             padding="max_length",
@@ -313,47 +367,53 @@ class DenseRetrieval(Retrieval):
             q_seqs["input_ids"], q_seqs["attention_mask"], q_seqs["token_type_ids"]
         )
         query_sampler = SequentialSampler(dataset)
-        query_dataloader = DataLoader(dataset, sampler=query_sampler, batch_size=32)
+        query_dataloader = DataLoader(
+            dataset, sampler=query_sampler, batch_size=batch_size
+        )
         q_embs = []
-        with torch.no_grad():
-
+        with self.inference_context():
             epoch_iterator = tqdm(
-                query_dataloader, desc="Iteration", position=0, leave=True
+                query_dataloader,
+                desc="Iteration",
+                position=0,
+                leave=True,
+                disable=not show_progress,
             )
-            self.q_encoder.eval()
-
             for _, batch in enumerate(epoch_iterator):
-                batch = tuple(t.cuda() for t in batch)
+                batch = tuple(t.to(self.device) for t in batch)
 
                 q_inputs = {
                     "input_ids": batch[0],
                     "attention_mask": batch[1],
                     "token_type_ids": batch[2],
                 }
+                q_embs.append(self.q_encoder(**q_inputs))
+        return torch.cat(q_embs)
 
-                outputs = self.q_encoder(**q_inputs).to("cpu").numpy()
-                q_embs.extend(outputs)
-        q_embs = np.array(q_embs)
-        if torch.cuda.is_available():
-            p_embs_cuda = torch.Tensor(self.p_embs).to("cuda")
-            q_embs_cuda = torch.Tensor(q_embs).to("cuda")
-        dot_prod_scores = torch.matmul(q_embs_cuda, torch.transpose(p_embs_cuda, 0, 1))
-        rank = torch.argsort(dot_prod_scores, dim=1, descending=True).squeeze()
+    def search(self, q_embs, top_k):
+        '''
+        query embedding마다 내적이 큰 순서로 top_k개 passage의 doc id와 score를 반환합니다.
+        '''
+        with self.inference_context():
+            dot_prod_scores = torch.matmul(
+                q_embs, torch.transpose(self.p_embs_tensor, 0, 1)
+            )
+            scores, rank = torch.topk(
+                dot_prod_scores, min(top_k, dot_prod_scores.size(1)), dim=1
+            )
+        doc_ids = [[self.doc_ids[r] for r in row] for row in rank.tolist()]
+        return doc_ids, scores.tolist()
 
-        query_ids = {}
-        query_scores = {}
-        idx = 0
-        for i in tqdm(range(len(querys))):
-            p_list = []
-            scores = []
-            q = querys[i]
-            for j in range(top_k):
-                p_list.append(self.wiki_context_id_dict[self.wiki_corpus[rank[idx][j]]])
-                scores.append(dot_prod_scores[idx][rank[idx][j]].item())
-            query_ids[q] = p_list
-            query_scores[q] = scores
-            idx += 1
+    def get_topk_doc_id_and_score(self, query, top_k):
+        doc_ids, scores = self.search(self.get_query_embedding([query]), top_k)
+        return doc_ids[0], scores[0]
 
+    def get_topk_doc_id_and_score_for_querys(self, querys, top_k):
+        doc_ids, scores = self.search(
+            self.get_query_embedding(querys, show_progress=True), top_k
+        )
+        query_ids = {q: ids for q, ids in zip(querys, doc_ids)}
+        query_scores = {q: score for q, score in zip(querys, scores)}
         return query_ids, query_scores
 
     def to_cuda(batch):
@@ -369,66 +429,80 @@ class HybridRetrieval(Retrieval):
         data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
         caching_path="caching/",
         context_path="/opt/ml/data/preprocess_wiki.json",
+        use_elasticsearch=True,
+        num_threads=None,
     ):
         super().__init__(
             tokenizer,
             data_path=data_path,
             caching_path=caching_path,
             context_path=context_path,
+            num_threads=num_threads,
         )
 
-        self.sparse_retrieval = SparseRetrieval(tokenizer=tokenizer)
+        self.sparse_retrieval = SparseRetrieval(
+            tokenizer=tokenizer,
+            data_path=data_path,
+            caching_path=caching_path,
+            context_path=context_path,
+            use_elasticsearch=use_elasticsearch,
+            num_threads=num_threads,
+        )
         self.dense_retrieval = DenseRetrieval(
             tokenizer=tokenizer,
             p_encoder_path=p_encoder_path,
             q_encoder_path=q_encoder_path,
+            data_path=data_path,
+            caching_path=caching_path,
+            context_path=context_path,
+            num_threads=num_threads,
         )
         self.q_encoder = self.dense_retrieval.q_encoder
-        self.p_embs = self.dense_retrieval.p_embs
-        if torch.cuda.is_available():
-            self.p_embs = torch.Tensor(self.p_embs).to("cuda")
+        self.p_embs = self.dense_retrieval.p_embs_tensor
 
     def get_topk_doc_id_and_score(self, query, top_k):
         es_id, es_score = self.sparse_retrieval.get_topk_doc_id_and_score(
             query=query, top_k=top_k
         )
-        return self.__rerank(query, es_id, es_score)
+        q_embs = self.dense_retrieval.get_query_embedding([query])
+        return self.__rerank(q_embs[0], es_id, es_score)
+
+    def get_topk_doc_id_and_score_for_querys(self, querys, top_k, show_progress=True):
+        '''
+        sparse 후보는 query마다 구하고, query embedding은 querys 전체를 batch로 한번에 구합니다.
+        '''
+        candidates = [
+            self.sparse_retrieval.get_topk_doc_id_and_score(query=query, top_k=top_k)
+            for query in tqdm(querys, disable=not show_progress)
+        ]
+        q_embs = self.dense_retrieval.get_query_embedding(
+            querys, show_progress=show_progress
+        )
 
-    def get_topk_doc_id_and_score_for_querys(self, querys, top_k):
         hybrid_ids = {}
         hybrid_scores = {}
-
-        for i in tqdm(range(len(querys))):
-            query = querys[i]
-            doc_ids, scores = self.get_topk_doc_id_and_score(query, top_k)
-            hybrid_ids[query] = doc_ids
-            hybrid_scores[query] = scores
-
+        for query, q_emb, (es_id, es_score) in zip(querys, q_embs, candidates):
+            hybrid_ids[query], hybrid_scores[query] = self.__rerank(
+                q_emb, es_id, es_score
+            )
         return hybrid_ids, hybrid_scores
 
-    def __rerank(self, query, es_id, es_score):
-        p_embs = self.p_embs
-        with torch.no_grad():
-            self.q_encoder.eval()
-            q_seqs_val = self.tokenizer(
-                query, padding="max_length", truncation=True, return_tensors="pt"
-            ).to("cuda")
-            q_emb = self.q_encoder(**q_seqs_val).to("cuda")
-        dot_prod_scores = torch.matmul(q_emb, torch.transpose(p_embs, 0, 1))
-        rank = torch.argsort(dot_prod_scores, dim=1, descending=True).squeeze()
-        rank = rank.cpu().numpy().tolist()
-
+    def __rerank(self, q_emb, es_id, es_score):
+        '''
+        sparse 후보 passage의 embedding만 골라 dense 점수를 구하고 sparse 점수와 더해 다시 정렬합니다.
+        점수가 같으면 wiki_corpus 순서가 앞인 passage가 먼저 옵니다.
+        '''
         es_id_score = {k: v for k, v in zip(es_id, es_score)}
-
-        hybrid_id_score = dict()
-
-        for i in range(len(rank)):
-            dense_id = self.wiki_context_id_dict[self.wiki_corpus[i]]
-            if dense_id in es_id_score:
-                lin_score = dot_prod_scores[0][i].item() + es_id_score[dense_id]
-                hybrid_id_score[dense_id] = lin_score
-
-        hybrid_id_score = list(hybrid_id_score.items())
+        doc_ids = self.dense_retrieval.doc_ids
+        doc_id_rows = self.dense_retrieval.doc_id_rows
+        rows = sorted(doc_id_rows[k] for k in es_id_score if k in doc_id_rows)
+        with self.inference_context():
+            dense_scores = torch.matmul(self.p_embs[rows], q_emb).tolist()
+
+        hybrid_id_score = [
+            (doc_ids[row], dense_score + es_id_score[doc_ids[row]])
+            for row, dense_score in zip(rows, dense_scores)
+        ]
         hybrid_id_score.sort(key=lambda x: x[1], reverse=True)
         hybrid_ids = list(map(lambda x: x[0], hybrid_id_score))
         hybrid_scores = list(map(lambda x: x[1], hybrid_id_score))
@@ -0,0 +1,601 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import pickle
+import threading
+from itertools import islice
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import torch
+from rank_bm25 import BM25Okapi
+from transformers import AutoTokenizer
+
+from .dense_model import BertEncoder
+from .retrieval import DenseRetrieval, Retrieval, SparseRetrieval
+
+SHARD_METHODS = ("search", "get_bm25_stats", "set_bm25_stats")
+
+
+def get_shard_dir(data_path, caching_path, kind, num_shards):
+    return data_path + caching_path + f"shards-{kind}-{num_shards}/"
+
+
+def get_shard_source_path(kind, data_path, caching_path):
+    if kind == "dense":
+        return data_path + caching_path + "dense_embedding.bin"
+    return data_path + caching_path + "wiki_context_id_pair.bin"
+
+
+def get_source_stat(source_path):
+    stat = os.stat(source_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_shard_meta(shard_dir):
+    with open(os.path.join(shard_dir, "meta.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_shard_rows(meta, shard_index):
+    start, end = meta["bounds"][shard_index : shard_index + 2]
+    return np.arange(start, end, dtype=np.int64)
+
+
+def prepare_shards(
+    kind,
+    num_shards,
+    data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
+    caching_path="caching/",
+    context_path="/opt/ml/data/preprocess_wiki.json",
+):
+    '''
+    wiki를 연속된 행 구간 num_shards개로 나눠 shard 마다 파일 하나로 저장합니다.
+    dense는 shard{i}.npy (passage embedding 행), sparse는 shard{i}.pkl (passage text)이고
+    coordinator가 쓰는 행 -> doc id (doc_ids.npy)와 행 구간 (meta.json)을 같이 저장합니다.
+    worker는 meta.json과 자기 shard 파일만 읽으므로 다른 host에는 그 두 파일만 복사하면 됩니다.
+    dense_embedding.bin은 pickle이라 나눠 읽을 수 없으므로 여기서 한번만 전체를 읽습니다.
+    '''
+    context_id_path = get_shard_source_path("sparse", data_path, caching_path)
+    if not os.path.isfile(context_id_path):
+        Retrieval(None, data_path, caching_path, context_path)
+    with open(context_id_path, "rb") as f:
+        wiki_context_id_dict = pickle.load(f)
+
+    source_path = get_shard_source_path(kind, data_path, caching_path)
+    if kind == "dense":
+        if not os.path.isfile(source_path):
+            raise FileNotFoundError(
+                f"{source_path} does not exist. Build it once with "
+                "DenseRetrieval before sharding."
+            )
+        with open(source_path, "rb") as f:
+            passages = pickle.load(f)
+        if len(passages) != len(wiki_context_id_dict):
+            raise ValueError(
+                f"{source_path} has {len(passages)} rows but the wiki has "
+                f"{len(wiki_context_id_dict)} passages. Rebuild it with DenseRetrieval."
+            )
+    else:
+        passages = list(wiki_context_id_dict.keys())
+
+    num_rows = len(passages)
+    if not 0 < num_shards <= num_rows:
+        raise ValueError(
+            f"num_shards must be between 1 and the number of passages ({num_rows}), "
+            f"got {num_shards}"
+        )
+    # shard는 corpus의 연속된 행 구간을 맡습니다. 그래야 합친 결과의 동점 순서가 shard를 나누지 않은 것과 같습니다.
+    shard_rows = np.array_split(np.arange(num_rows), num_shards)
+    bounds = [0] + np.cumsum([len(rows) for rows in shard_rows]).tolist()
+
+    shard_dir = get_shard_dir(data_path, caching_path, kind, num_shards)
+    os.makedirs(shard_dir, exist_ok=True)
+    # meta.json을 마지막에 쓰므로 중간에 멈춘 폴더는 쓰지 않고 다시 만듭니다.
+    meta_path = os.path.join(shard_dir, "meta.json")
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    np.save(
+        os.path.join(shard_dir, "doc_ids.npy"),
+        np.array(list(wiki_context_id_dict.values()), dtype=np.int64),
+    )
+    for shard_index in range(num_shards):
+        start, end = bounds[shard_index : shard_index + 2]
+        if kind == "dense":
+            np.save(
+                os.path.join(shard_dir, f"shard{shard_index}.npy"),
+                np.asarray(passages[start:end], dtype=np.float32),
+            )
+        else:
+            with open(os.path.join(shard_dir, f"shard{shard_index}.pkl"), "wb") as f:
+                pickle.dump(passages[start:end], f)
+
+    meta = {
+        "kind": kind,
+        "num_shards": num_shards,
+        "bounds": bounds,
+        "source": get_source_stat(source_path),
+    }
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return shard_dir
+
+
+def load_or_prepare_shards(kind, num_shards, data_path, caching_path, context_path):
+    '''
+    shard 파일이 있고 만든 뒤 원본(dense_embedding.bin / wiki cache)이 바뀌지 않았으면 그대로 씁니다.
+    원본이 없는 host(shard 폴더만 복사해 온 coordinator)에서는 있는 shard 파일을 씁니다.
+    '''
+    shard_dir = get_shard_dir(data_path, caching_path, kind, num_shards)
+    source_path = get_shard_source_path(kind, data_path, caching_path)
+    if os.path.isfile(os.path.join(shard_dir, "meta.json")):
+        if not os.path.isfile(source_path):
+            return shard_dir
+        if load_shard_meta(shard_dir)["source"] == get_source_stat(source_path):
+            return shard_dir
+    return prepare_shards(kind, num_shards, data_path, caching_path, context_path)
+
+
+class DenseShard:
+    '''
+    wiki passage embedding 중 rows 행만 들고 query embedding과 내적이 큰 top k를 반환합니다.
+    '''
+
+    def __init__(self, p_embs, rows):
+        self.p_embs = torch.from_numpy(np.ascontiguousarray(p_embs, dtype=np.float32))
+        self.rows = rows
+
+    def search(self, q_embs, top_k):
+        with torch.inference_mode():
+            scores = torch.from_numpy(q_embs) @ self.p_embs.T
+            scores, idxs = torch.topk(scores, min(top_k, len(self.rows)), dim=1)
+        return scores.numpy(), self.rows[idxs.numpy()]
+
+
+class SparseShard:
+    '''
+    rows 행의 문서로 만든 BM25Okapi 입니다. idf와 avgdl은 coordinator가 모든 shard의 통계로
+    다시 계산해서 넣어주므로 점수는 corpus 전체로 만든 BM25Okapi와 같습니다.
+    '''
+
+    def __init__(self, tokenized_docs, rows):
+        self.bm25 = BM25Okapi(tokenized_docs)
+        self.rows = rows
+
+    def get_bm25_stats(self):
+        # BM25Okapi가 idf를 계산할 때와 같은 순서(문서 순, 문서 안에서 처음 나온 순)로 document frequency를 셉니다.
+        document_frequency = {}
+        for frequencies in self.bm25.doc_freqs:
+            for word in frequencies:
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        return document_frequency, self.bm25.corpus_size, sum(self.bm25.doc_len)
+
+    def set_bm25_stats(self, idf, avgdl):
+        self.bm25.idf = idf
+        self.bm25.avgdl = avgdl
+
+    def search(self, tokenized_querys, top_k):
+        top_k = min(top_k, len(self.rows))
+        if not tokenized_querys:
+            return np.zeros((0, top_k)), np.zeros((0, top_k), dtype=np.int64)
+        scores = np.stack([self.bm25.get_scores(query) for query in tokenized_querys])
+        # SparseRetrieval.get_bm25_topk_doc_id_and_score와 같이 동점이면 앞 행이 먼저 옵니다.
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return np.take_along_axis(scores, order, axis=1), self.rows[order]
+
+
+def get_global_bm25_stats(shard_stats, epsilon=0.25):
+    '''
+    shard 별 document frequency / 문서 수 / 전체 길이를 합쳐 corpus 전체의 idf와 avgdl을 구합니다.
+    idf 식은 BM25Okapi의 것을 그대로 씁니다.
+    '''
+    document_frequency = {}
+    corpus_size = 0
+    total_length = 0
+    for shard_document_frequency, shard_corpus_size, shard_length in shard_stats:
+        for word, frequency in shard_document_frequency.items():
+            document_frequency[word] = document_frequency.get(word, 0) + frequency
+        corpus_size += shard_corpus_size
+        total_length += shard_length
+
+    bm25 = BM25Okapi.__new__(BM25Okapi)
+    bm25.corpus_size = corpus_size
+    bm25.epsilon = epsilon
+    bm25.idf = {}
+    bm25._calc_idf(document_frequency)
+    return bm25.idf, total_length / corpus_size
+
+
+def build_dense_shard(shard_dir, shard_index):
+    p_embs = np.load(os.path.join(shard_dir, f"shard{shard_index}.npy"))
+    return DenseShard(p_embs, get_shard_rows(load_shard_meta(shard_dir), shard_index))
+
+
+def build_sparse_shard(shard_dir, shard_index, tokenizer):
+    if isinstance(tokenizer, str):
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+    with open(os.path.join(shard_dir, f"shard{shard_index}.pkl"), "rb") as f:
+        passages = pickle.load(f)
+    return SparseShard(
+        [tokenizer.tokenize(passage) for passage in passages],
+        get_shard_rows(load_shard_meta(shard_dir), shard_index),
+    )
+
+
+SHARD_BUILDERS = {"dense": build_dense_shard, "sparse": build_sparse_shard}
+
+
+def serve_connection(conn, shard, stopped, wake_up):
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                return
+            if method == "shutdown":
+                stopped.set()
+                wake_up()
+                return
+            try:
+                if method not in SHARD_METHODS:
+                    raise ValueError(f"unknown shard method {method}")
+                conn.send(("ok", getattr(shard, method)(*args)))
+            except Exception as e:
+                conn.send(("error", repr(e)))
+
+
+def serve_shard(listener, shard, authkey):
+    '''
+    coordinator 연결마다 thread를 하나 띄워 (method, args) 요청을 처리합니다.
+    coordinator는 호출하는 thread마다 연결을 따로 열므로 여러 thread의 요청이 shard에서 겹쳐 돕니다.
+    shutdown 요청을 받으면 accept에서 기다리는 loop를 자기 자신에게 연결해서 깨우고 끝납니다.
+    '''
+    stopped = threading.Event()
+
+    def wake_up():
+        Client(listener.address, authkey=authkey).close()
+
+    while not stopped.is_set():
+        conn = listener.accept()
+        threading.Thread(
+            target=serve_connection,
+            args=(conn, shard, stopped, wake_up),
+            daemon=True,
+        ).start()
+
+
+def run_shard_worker(
+    kind,
+    shard_dir,
+    shard_index,
+    shard_kwargs,
+    address,
+    authkey,
+    num_threads=None,
+    ready_conn=None,
+):
+    '''
+    shard_dir의 shard{shard_index} 파일만 읽어 shard를 만든 뒤 address에서 요청을 기다립니다.
+    ready_conn이 있으면 실제로 listen 하는 address를 보내 준비가 끝났음을 알립니다.
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    shard = SHARD_BUILDERS[kind](shard_dir, shard_index, **shard_kwargs)
+    with Listener(address, authkey=authkey) as listener:
+        if ready_conn is not None:
+            ready_conn.send(listener.address)
+            ready_conn.close()
+        serve_shard(listener, shard, authkey)
+
+
+def merge_topk(shard_results, top_k):
+    '''
+    shard 마다 점수 순으로 정렬된 (scores, rows)를 query 별로 합쳐 전체 top k를 구합니다.
+    전체 top k는 반드시 어느 shard의 top k 안에 있으므로 shard를 나누지 않은 결과와 같습니다.
+    heapq.merge는 점수가 같으면 앞 shard(앞 행)를 먼저 내보냅니다.
+    '''
+    rows, scores = [], []
+    for query_results in zip(
+        *[zip(shard_scores, shard_rows) for shard_scores, shard_rows in shard_results]
+    ):
+        merged = list(
+            islice(
+                heapq.merge(
+                    *[
+                        zip(query_scores.tolist(), query_rows.tolist())
+                        for query_scores, query_rows in query_results
+                    ],
+                    key=lambda candidate: -candidate[0],
+                ),
+                top_k,
+            )
+        )
+        scores.append([score for score, _ in merged])
+        rows.append([row for _, row in merged])
+    return rows, scores
+
+
+class ShardGroup:
+    '''
+    shard worker들과의 연결입니다. 요청을 모든 shard에 먼저 보내고(scatter) 나서
+    응답을 모으므로(gather) shard들은 동시에 계산합니다.
+    연결은 호출하는 thread마다 따로 열어서 여러 thread의 scatter-gather가 lock 없이 겹칩니다.
+    끝난 thread의 연결은 새 thread가 연결을 열 때 닫습니다.
+    '''
+
+    def __init__(self, addresses, authkey, processes=()):
+        self.addresses = addresses
+        self.authkey = authkey
+        self.processes = list(processes)
+        # thread -> shard 순서의 연결
+        self.connections_per_thread = {}
+        self.lock = threading.Lock()
+        # 잘못된 address / authkey는 첫 검색이 아니라 여기서 바로 드러나게 합니다.
+        self.get_connections()
+
+    def get_connections(self):
+        thread = threading.current_thread()
+        with self.lock:
+            connections = self.connections_per_thread.get(thread)
+            if connections is None:
+                for finished_thread in [
+                    other
+                    for other in self.connections_per_thread
+                    if not other.is_alive()
+                ]:
+                    for conn in self.connections_per_thread.pop(finished_thread):
+                        conn.close()
+                connections = [
+                    Client(address, authkey=self.authkey) for address in self.addresses
+                ]
+                self.connections_per_thread[thread] = connections
+        return connections
+
+    @classmethod
+    def start_local(cls, kind, shard_dir, num_shards, shard_kwargs, num_threads=None):
+        '''
+        이 host에 shard worker process를 num_shards개 띄우고 모두 준비될 때까지 기다립니다.
+        '''
+        context = multiprocessing.get_context("spawn")
+        authkey = os.urandom(16)
+        processes, ready_conns = [], []
+        for shard_index in range(num_shards):
+            ready_conn, worker_conn = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_shard_worker,
+                args=(
+                    kind,
+                    shard_dir,
+                    shard_index,
+                    shard_kwargs,
+                    ("127.0.0.1", 0),
+                    authkey,
+                    num_threads,
+                    worker_conn,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_conn.close()
+            processes.append(process)
+            ready_conns.append(ready_conn)
+        addresses = [ready_conn.recv() for ready_conn in ready_conns]
+        return cls(addresses, authkey, processes)
+
+    @classmethod
+    def connect(cls, addresses, authkey):
+        '''
+        다른 host에서 `python -m Retrieval.sharded_retrieval serve`로 띄운 shard에 연결합니다.
+        addresses는 shard_index 순서여야 합니다.
+        '''
+        return cls([tuple(address) for address in addresses], authkey)
+
+    def call_all(self, method, *args):
+        connections = self.get_connections()
+        for conn in connections:
+            conn.send((method, args))
+        responses = [conn.recv() for conn in connections]
+        for shard_index, (status, result) in enumerate(responses):
+            if status == "error":
+                raise RuntimeError(f"shard {shard_index} failed: {result}")
+        return [result for _, result in responses]
+
+    def search(self, querys, top_k):
+        if len(querys) == 0:
+            return [], []
+        return merge_topk(self.call_all("search", querys, top_k), top_k)
+
+    def close(self):
+        # 직접 띄운 worker만 끄고, 다른 host의 shard는 연결만 끊습니다.
+        if self.processes:
+            for conn in self.get_connections():
+                conn.send(("shutdown", ()))
+        with self.lock:
+            for connections in self.connections_per_thread.values():
+                for conn in connections:
+                    conn.close()
+            self.connections_per_thread = {}
+        for process in self.processes:
+            process.join(timeout=10)
+
+
+def get_shard_group(
+    kind, shard_dir, shard_kwargs, shard_addresses, authkey, num_threads
+):
+    num_shards = load_shard_meta(shard_dir)["num_shards"]
+    if not shard_addresses:
+        return ShardGroup.start_local(
+            kind, shard_dir, num_shards, shard_kwargs, num_threads
+        )
+    if len(shard_addresses) != num_shards:
+        raise ValueError(
+            f"{shard_dir} has {num_shards} shards but got "
+            f"{len(shard_addresses)} shard addresses"
+        )
+    return ShardGroup.connect(shard_addresses, authkey)
+
+
+class ShardedDenseRetrieval(DenseRetrieval):
+    '''
+    DenseRetrieval과 같은 API로 검색하지만 passage embedding은 shard worker들이 나눠 들고 있습니다.
+    query encoding은 이 process에서 하고 inner product top k만 shard에서 계산합니다.
+    DenseRetrieval이 caching_path에 만들어둔 dense_embedding.bin을 처음 한번 shard 파일로 나눠두고
+    이 process는 wiki 대신 행 -> doc id만 불러옵니다.
+    '''
+
+    def __init__(
+        self,
+        tokenizer,
+        q_encoder_path,
+        data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
+        caching_path="caching/",
+        context_path="/opt/ml/data/preprocess_wiki.json",
+        num_shards=2,
+        shard_addresses=None,
+        authkey=None,
+        num_threads=None,
+    ):
+        Retrieval.__init__(self, tokenizer, num_threads=num_threads, load_wiki=False)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.q_encoder = BertEncoder.from_pretrained(data_path + q_encoder_path)
+        self.q_encoder.to(self.device)
+        self.q_encoder.eval()
+        self.q_encoder.requires_grad_(False)
+
+        shard_dir = load_or_prepare_shards(
+            "dense", num_shards, data_path, caching_path, context_path
+        )
+        self.doc_ids = np.load(os.path.join(shard_dir, "doc_ids.npy")).tolist()
+        self.shards = get_shard_group(
+            "dense", shard_dir, {}, shard_addresses, authkey, num_threads
+        )
+
+    def search(self, q_embs, top_k):
+        rows, scores = self.shards.search(q_embs.float().cpu().numpy(), top_k)
+        doc_ids = [[self.doc_ids[row] for row in query_rows] for query_rows in rows]
+        return doc_ids, scores
+
+    def close(self):
+        self.shards.close()
+
+
+class ShardedSparseRetrieval(SparseRetrieval):
+    '''
+    SparseRetrieval의 BM25Okapi 검색을 shard worker들로 나눕니다.
+    시작할 때 shard 별 통계로 corpus 전체의 idf / avgdl을 구해 모든 shard에 넣으므로
+    점수와 순위는 shard를 나누지 않은 BM25Okapi와 같습니다. elasticsearch는 쓰지 않습니다.
+    wiki text는 처음 한번 shard 파일로 나눠두고 shard worker가 자기 파일만 읽어 tokenize 합니다.
+    '''
+
+    def __init__(
+        self,
+        tokenizer,
+        data_path="/opt/ml/mrc-level2-nlp-08/Retrieval/",
+        caching_path="caching/",
+        context_path="/opt/ml/data/preprocess_wiki.json",
+        num_shards=2,
+        shard_addresses=None,
+        authkey=None,
+        num_threads=None,
+    ):
+        Retrieval.__init__(self, tokenizer, num_threads=num_threads, load_wiki=False)
+        self.es = None
+        shard_dir = load_or_prepare_shards(
+            "sparse", num_shards, data_path, caching_path, context_path
+        )
+        self.doc_ids = np.load(os.path.join(shard_dir, "doc_ids.npy")).tolist()
+        self.shards = get_shard_group(
+            "sparse",
+            shard_dir,
+            {"tokenizer": tokenizer},
+            shard_addresses,
+            authkey,
+            num_threads,
+        )
+        idf, avgdl = get_global_bm25_stats(self.shards.call_all("get_bm25_stats"))
+        self.shards.call_all("set_bm25_stats", idf, avgdl)
+
+    def search_tokenized(self, tokenized_querys, top_k):
+        rows, scores = self.shards.search(tokenized_querys, top_k)
+        doc_ids = [[self.doc_ids[row] for row in query_rows] for query_rows in rows]
+        return doc_ids, scores
+
+    def get_bm25_topk_doc_id_and_score(self, query, top_k):
+        doc_ids, scores = self.search_tokenized(
+            [self.get_tokenizer().tokenize(query)], top_k
+        )
+        return doc_ids[0], scores[0]
+
+    def get_topk_doc_id_and_score_for_querys(self, querys, top_k):
+        # query 하나씩 보내지 않고 batch 전체를 한번에 모든 shard로 보냅니다.
+        tokenizer = self.get_tokenizer()
+        doc_ids, scores = self.search_tokenized(
+            [tokenizer.tokenize(query) for query in querys], top_k
+        )
+        return dict(zip(querys, doc_ids)), dict(zip(querys, scores))
+
+    def close(self):
+        self.shards.close()
+
+
+if __name__ == "__main__":
+    # repo root에서 python -m Retrieval.sharded_retrieval
+    # prepare는 shard 파일을 만들고, serve는 다른 host에서 shard 하나를 띄웁니다.
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = subparsers.add_parser("prepare")
+    prepare_parser.add_argument(
+        "--kind", type=str, required=True, choices=["dense", "sparse"]
+    )
+    prepare_parser.add_argument("--num_shards", type=int, required=True)
+    prepare_parser.add_argument(
+        "--data_path", type=str, default="/opt/ml/mrc-level2-nlp-08/Retrieval/"
+    )
+    prepare_parser.add_argument("--caching_path", type=str, default="caching/")
+    prepare_parser.add_argument(
+        "--context_path", type=str, default="/opt/ml/data/preprocess_wiki.json"
+    )
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument(
+        "--kind", type=str, required=True, choices=["dense", "sparse"]
+    )
+    serve_parser.add_argument(
+        "--shard_dir", type=str, required=True
+    )  # prepare가 만든 폴더. meta.json과 이 shard의 파일만 있으면 됩니다.
+    serve_parser.add_argument("--shard_index", type=int, required=True)
+    serve_parser.add_argument("--host", type=str, default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument(
+        "--authkey", type=str, required=True
+    )  # coordinator의 authkey와 같아야 합니다.
+    serve_parser.add_argument(
+        "--tokenizer", type=str, default=None
+    )  # sparse shard가 wiki를 tokenize 할 tokenizer (retriever에 넘기는 것과 같아야 합니다)
+    serve_parser.add_argument("--num_threads", type=int, default=None)
+    cli_args = parser.parse_args()
+
+    if cli_args.command == "prepare":
+        print(
+            prepare_shards(
+                cli_args.kind,
+                cli_args.num_shards,
+                cli_args.data_path,
+                cli_args.caching_path,
+                cli_args.context_path,
+            )
+        )
+    else:
+        run_shard_worker(
+            cli_args.kind,
+            cli_args.shard_dir,
+            cli_args.shard_index,
+            {"tokenizer": cli_args.tokenizer} if cli_args.kind == "sparse" else {},
+            (cli_args.host, cli_args.port),
+            cli_args.authkey.encode("utf-8"),
+            cli_args.num_threads,
+        )
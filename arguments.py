@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 from transformers import TrainingArguments
 from transformers.trainer_utils import IntervalStrategy
@@ -12,7 +12,76 @@ class SettingsArguments:
     trainset_path: str = field(default="../data/new_train_dataset")
     testset_path: str = field(default="../data/test_dataset")
     load_from_cache_file: bool = field(default=False)
-    num_proc: Optional[int] = field(default=None)
+    num_proc: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of processes used by datasets.map for preprocessing."},
+    )
+    passage_store_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Where to cache the reader tokenization of every wiki passage. "
+            "When set, test features are assembled from the cached tokens."
+        },
+    )
+    logit_store_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Where to save raw reader logits, keyed by model fingerprint, "
+            "so that redecode.py can re-run postprocessing or ensembling without the model."
+        },
+    )
+    feature_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Where to keep tokenized train/eval features. Features are reused when "
+            "the tokenizer, max_length, stride, preprocessing version and dataset match."
+        },
+    )
+    model_type: str = field(
+        default="auto",
+        metadata={
+            "help": "Reader used by train.py. auto is AutoModelForQuestionAnswering, "
+            "the others are the heads in models/.",
+            "choices": ["auto", "lstm", "cnn", "frozen_head"],
+        },
+    )
+    hidden_state_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "With --model_type frozen_head, train only the head on backbone "
+            "hidden states computed once and memory-mapped under this directory. "
+            "pretrained_model_name_or_path is used as the frozen backbone. The states "
+            "are computed in eval mode, so the head trains without backbone dropout, "
+            "unlike uncached frozen_head training."
+        },
+    )
+    hidden_state_dtype: str = field(
+        default="float16",
+        metadata={
+            "help": "dtype of the cached hidden states.",
+            "choices": ["float16", "float32"],
+        },
+    )
+    retrieval_num_threads: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "torch intra-op threads, set once when the retriever is built. "
+            "torch.set_num_threads is process-wide, so this also applies to the "
+            "reader. When several threads share the retriever, keep threads * this "
+            "within the CPU count."
+        },
+    )
+    metrics_log_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Append timing spans and per-step throughput/memory as JSON lines to "
+            "this file."
+        },
+    )
+    prometheus_port: Optional[int] = field(
+        default=None,
+        metadata={"help": "Serve the latest metrics at http://0.0.0.0:<port>/metrics."},
+    )
 
 
 @dataclass
@@ -99,6 +168,20 @@ class Arguments(TrainingArguments):
     pad_to_multiple_of: int = field(
         default=8, metadata={"help": "Pad to multiple of set number"}
     )
+    group_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to put training features of similar length in the same batch "
+            "to reduce padding. Uses the `length` column made by preprocess."
+        },
+    )
+    predict_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to run prediction on features sorted by length. "
+            "Logits are returned in the original feature order."
+        },
+    )
 
     label_names: Optional[Tuple[str]] = field(
         default=("start_positions", "end_positions"),
@@ -146,9 +229,124 @@ class Arguments(TrainingArguments):
             "help": "Define how many top-k passages to retrieve based on similarity."
         },
     )
+    per_passage_reader: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to window each retrieved passage separately instead of "
+            "concatenating the top-k passages into one context."
+        },
+    )
+    retrieval_score_weight: float = field(
+        default=0.0,
+        metadata={
+            "help": "Weight of the retrieval score added to the span score "
+            "in per passage reader mode."
+        },
+    )
+    passage_prune_threshold: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "In per passage reader mode, skip lower-ranked passages of a question "
+            "once a span with start + end logit above this value is found."
+        },
+    )
+    postprocess_num_workers: int = field(
+        default=1,
+        metadata={
+            "help": "Number of processes decoding n-best spans in postprocess. "
+            "Features of one example always go to the same process."
+        },
+    )
     use_faiss: bool = field(
         default=False, metadata={"help": "Whether to build with faiss"}
     )
     num_clusters: int = field(
         default=5, metadata={"help": "Define how many clusters to use for faiss."}
     )
+
+
+@dataclass
+class ServeArguments:
+    host: str = field(default="127.0.0.1")
+    port: int = field(default=8000)
+    max_batch_size: int = field(
+        default=16,
+        metadata={"help": "Maximum number of questions answered in one micro-batch."},
+    )
+    max_wait_ms: float = field(
+        default=10.0,
+        metadata={
+            "help": "How long the first question of a micro-batch waits for others."
+        },
+    )
+    max_queue_size: int = field(
+        default=256,
+        metadata={"help": "Questions waiting beyond this are rejected with 503."},
+    )
+    latency_window: int = field(
+        default=10000,
+        metadata={"help": "Number of recent requests used for latency percentiles."},
+    )
+
+
+@dataclass
+class PipelineArguments:
+    chunk_size: int = field(
+        default=32,
+        metadata={"help": "Number of questions flowing through the pipeline together."},
+    )
+    queue_size: int = field(
+        default=4,
+        metadata={"help": "Maximum number of chunks buffered between two stages."},
+    )
+    retrieval_workers: int = field(default=1)
+    tokenization_workers: int = field(default=1)
+    decoding_workers: int = field(default=1)
+
+
+@dataclass
+class RedecodeArguments:
+    logit_stores: List[str] = field(
+        metadata={
+            "help": "Logit stores saved by inference.py. "
+            "Several stores of the same features are ensembled by averaging logits."
+        },
+    )
+    output_dir: str = field(default="output")
+    max_answer_length: int = field(default=30)
+    num_max_prediction: int = field(default=20)
+    retrieval_score_weight: float = field(default=0.0)
+    ensemble_weights: Optional[List[float]] = field(
+        default=None,
+        metadata={"help": "Weight of each logit store. Defaults to a plain average."},
+    )
+    postprocess_num_workers: int = field(default=1)
+
+
+@dataclass
+class SweepArguments:
+    sweep_top_ks: List[int] = field(
+        default_factory=lambda: [1, 3, 5, 10, 20],
+        metadata={
+            "help": "top_k_retrieval values to evaluate. Passages are retrieved and "
+            "read once at the largest k and every smaller k uses the top ranked prefix."
+        },
+    )
+    sweep_logit_store: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "A per passage logit store of the validation questions with "
+            "top_k_retrieval >= the largest k. Its features and logits are reused "
+            "instead of running retrieval and the reader."
+        },
+    )
+    sweep_target_metric: str = field(
+        default="f1",
+        metadata={"choices": ["exact_match", "f1"]},
+    )
+    sweep_target_score: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Report the smallest k whose target metric reaches this score."
+        },
+    )
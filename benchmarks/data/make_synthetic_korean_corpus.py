@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+PLACES = [
+    "서울", "부산", "대구", "인천", "광주", "대전", "울산", "수원", "전주", "강릉",
+    "제주", "춘천", "포항", "목포", "여수", "안동", "경주", "청주", "원주", "진주",
+]
+JOBS = [
+    "화가", "작곡가", "과학자", "소설가", "건축가", "정치인", "요리사", "천문학자",
+    "조각가", "시인", "영화감독", "수학자", "외교관", "사진작가", "무용가",
+]
+WORKS = [
+    "바다", "새벽", "정원", "등대", "겨울", "무지개", "기차", "달빛", "여름", "노을",
+    "별자리", "항구", "숲길", "시계탑", "파도", "고향", "구름", "들판", "강물", "눈꽃",
+]
+AWARDS = ["대한민국예술상", "과학기술대상", "문화훈장", "올해의인물상", "창작대상"]
+SYLLABLES = "가나다라마바사아자차카타파하강민서윤지현우진성태영수호준재경"
+FAMILY_NAMES = "김이박최정강조윤장임한오서신권황안송류홍"
+
+
+def josa(word, with_batchim, without_batchim):
+    # 마지막 글자의 받침 여부에 따라 조사를 고릅니다.
+    has_batchim = (ord(word[-1]) - 0xAC00) % 28 != 0
+    return word + (with_batchim if has_batchim else without_batchim)
+
+
+def make_corpus(num_docs, seed):
+    '''
+    인물 문서와 그 문서에서만 답할 수 있는 질문을 만듭니다.
+    질문은 본문 문장을 바꿔 쓴 것이라 BM25와 dense 모두 정답 문서를 찾을 수 있습니다.
+    '''
+    rng = np.random.default_rng(seed)
+    names = set()
+    while len(names) < num_docs:
+        names.add(
+            rng.choice(list(FAMILY_NAMES))
+            + "".join(rng.choice(list(SYLLABLES), size=2))
+        )
+
+    works = [f"{first}의 {second}" for first in WORKS for second in WORKS]
+    works = rng.permutation(works)[:num_docs]
+
+    wiki = {}
+    questions = []
+    for document_id, (name, work) in enumerate(zip(sorted(names), works)):
+        place, job = rng.choice(PLACES), rng.choice(JOBS)
+        year = int(rng.integers(1850, 2000))
+        award = rng.choice(AWARDS)
+        award_year = year + int(rng.integers(25, 60))
+        text = (
+            f"{josa(name, '은', '는')} {year}년 {place}에서 태어난 "
+            f"대한민국의 {job}이다. 대표작은 《{work}》이며 "
+            f"{award_year}년 {josa(award, '을', '를')} 받았다. "
+            f"{place}의 학교를 졸업한 뒤 {josa(job, '으로서', '로서')} "
+            "여러 작품을 남겼다."
+        )
+        wiki[str(document_id)] = {
+            "text": text,
+            "document_id": document_id,
+            "title": name,
+        }
+        questions.extend(
+            [
+                {
+                    "question": f"{josa(name, '이', '가')} 태어난 도시는?",
+                    "document_id": document_id,
+                },
+                {
+                    "question": f"《{work}》{josa(work, '을', '를')[len(work):]} "
+                    f"남긴 {josa(job, '이', '가')} 받은 상은?",
+                    "document_id": document_id,
+                },
+            ]
+        )
+    return wiki, questions
+
+
+def main(cli_args):
+    wiki, questions = make_corpus(cli_args.num_docs, cli_args.seed)
+    os.makedirs(cli_args.output_dir, exist_ok=True)
+    with open(
+        os.path.join(cli_args.output_dir, "synthetic_korean_wiki.json"),
+        "w",
+        encoding="utf-8",
+    ) as f:
+        json.dump(wiki, f, ensure_ascii=False, indent=1)
+    with open(
+        os.path.join(cli_args.output_dir, "synthetic_korean_questions.json"),
+        "w",
+        encoding="utf-8",
+    ) as f:
+        json.dump(questions, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_docs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output_dir", type=str, default=os.path.dirname(os.path.abspath(__file__))
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import BertConfig
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Retrieval")
+)
+from dense_model import BertEncoder
+from dense_train_utils import DenseBatchCollator
+
+
+def make_items(num_items, vocab_size, mean_passage_length, mean_question_length, rng):
+    '''
+    wiki 문단처럼 길이가 들쭉날쭉한 token id를 만듭니다.
+    '''
+    def sample(mean_length):
+        length = max(1, int(rng.exponential(mean_length)))
+        return rng.integers(5, vocab_size, size=length, dtype=np.int64)
+
+    return [
+        (
+            sample(mean_passage_length),
+            sample(mean_passage_length),
+            [2] + sample(mean_question_length).tolist()[:62] + [3],
+        )
+        for _ in range(num_items)
+    ]
+
+
+def pad_to_max_length(batch, max_context_seq_length, max_question_seq_length):
+    # 이전 dataset처럼 passage는 max_context_seq_length, question은 max_question_seq_length까지 padding 합니다.
+    padded = []
+    for i, tensor in enumerate(batch):
+        max_length = max_context_seq_length if i < 6 else max_question_seq_length
+        padded.append(F.pad(tensor, (0, max_length - tensor.size(1))))
+    return tuple(padded)
+
+
+def run(cli_args, dynamic_padding, bf16):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    config = BertConfig(
+        vocab_size=cli_args.vocab_size,
+        hidden_size=cli_args.hidden_size,
+        num_hidden_layers=cli_args.num_layers,
+        num_attention_heads=cli_args.hidden_size // 64,
+        intermediate_size=cli_args.hidden_size * 4,
+        max_position_embeddings=cli_args.max_context_seq_length,
+    )
+    p_encoder = BertEncoder(config)
+    q_encoder = BertEncoder(config)
+    optimizer = torch.optim.AdamW(
+        list(p_encoder.parameters()) + list(q_encoder.parameters()), lr=1e-5
+    )
+    tokenizer = SimpleNamespace(
+        pad_token_id=0,
+        cls_token_id=2,
+        sep_token_id=3,
+        pad=lambda encoded, return_tensors: {
+            "input_ids": torch.nn.utils.rnn.pad_sequence(
+                [torch.tensor(ids) for ids in encoded["input_ids"]], batch_first=True
+            ),
+            "attention_mask": torch.nn.utils.rnn.pad_sequence(
+                [torch.ones(len(ids), dtype=torch.long) for ids in encoded["input_ids"]],
+                batch_first=True,
+            ),
+        },
+    )
+    collator = DenseBatchCollator(tokenizer, cli_args.max_context_seq_length)
+    items = make_items(
+        cli_args.batch_size * (cli_args.num_steps + cli_args.warmup_steps),
+        cli_args.vocab_size,
+        cli_args.mean_passage_length,
+        cli_args.mean_question_length,
+        rng,
+    )
+
+    tokens = 0
+    started = None
+    for step in range(cli_args.num_steps + cli_args.warmup_steps):
+        if step == cli_args.warmup_steps:
+            started = time.perf_counter()
+        batch = collator(
+            items[step * cli_args.batch_size : (step + 1) * cli_args.batch_size]
+        )
+        if not dynamic_padding:
+            batch = pad_to_max_length(
+                batch, cli_args.max_context_seq_length, cli_args.max_question_seq_length
+            )
+        tokens += batch[0].numel() + batch[3].numel()
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=bf16):
+            p_outputs = p_encoder(
+                torch.cat((batch[0], batch[3])),
+                torch.cat((batch[1], batch[4])),
+                torch.cat((batch[2], batch[5])),
+            )
+            q_outputs = q_encoder(batch[6], batch[7], batch[8])
+            sim_scores = F.log_softmax((q_outputs @ p_outputs.T).float(), dim=1)
+            loss = F.nll_loss(sim_scores, torch.arange(len(q_outputs)))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    seconds = time.perf_counter() - started
+    return {
+        "dynamic_padding": dynamic_padding,
+        "bf16": bf16,
+        "steps_per_second": cli_args.num_steps / seconds,
+        "mean_padded_passage_length": tokens / (2 * cli_args.batch_size * (step + 1)),
+    }
+
+
+def main(cli_args):
+    torch.set_num_threads(cli_args.num_threads or torch.get_num_threads())
+    results = [
+        run(cli_args, dynamic_padding=False, bf16=False),
+        run(cli_args, dynamic_padding=True, bf16=False),
+        run(cli_args, dynamic_padding=True, bf16=True),
+    ]
+    baseline = results[0]["steps_per_second"]
+    for result in results:
+        result["speedup"] = result["steps_per_second"] / baseline
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--warmup_steps", type=int, default=2)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--max_context_seq_length", type=int, default=512)
+    parser.add_argument("--max_question_seq_length", type=int, default=64)
+    parser.add_argument("--mean_passage_length", type=int, default=200)
+    parser.add_argument("--mean_question_length", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=None)
+
+    main(parser.parse_args())
@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from bisect import bisect_left
+
+from datasets import load_from_disk
+from transformers import AutoTokenizer, BertTokenizerFast
+from transformers.models.bert.tokenization_bert import BasicTokenizer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from process import get_answer_token_positions, get_context_mask
+
+
+# --known_span_check에서 정답을 뽑는 context 입니다.
+KNOWN_SPAN_CONTEXT = (
+    "강나강은 1907년 전주에서 태어난 대한민국의 정치인이다. 대표작은 《고향의 숲길》이며 "
+    "1953년 과학기술대상을 받았다. 전주의 학교를 졸업한 뒤 정치인으로서 여러 작품을 남겼다. "
+    "강민수는 1967년 포항에서 태어난 대한민국의 시인이다. 대표작은 《항구의 파도》이며 "
+    "2001년 올해의인물상을 받았다. 포항의 학교를 졸업한 뒤 시인으로서 여러 작품을 남겼다. "
+    "강우카는 1937년 부산에서 태어난 대한민국의 요리사이다. 대표작은 《고향의 바다》이며 "
+    "1987년 창작대상을 받았다. 부산의 학교를 졸업한 뒤 요리사로서 여러 작품을 남겼다. "
+    "강자아는 1948년 울산에서 태어난 대한민국의 수학자이다. 대표작은 《고향의 무지개》이며 "
+    "2002년 문화훈장을 받았다. 울산의 학교를 졸업한 뒤 수학자로서 여러 작품을 남겼다."
+)
+
+
+def build_known_span_tokenizer(context, save_dir):
+    '''
+    한글 음절, ASCII 문자와 context 어절로 vocab을 만든 BertTokenizerFast 입니다.
+    끝 글자를 뗀 어절도 넣어서 "강나강은"이 "강나강 ##은"처럼 여러 token으로 나뉘게 합니다.
+    '''
+    chars = [chr(code) for code in range(0xAC00, 0xD7A4)]
+    chars += [chr(code) for code in range(0x21, 0x7F)]
+    tokens = set(chars) | {"##" + char for char in chars}
+    for word in BasicTokenizer(do_lower_case=False).tokenize(context):
+        tokens.update([word, word[:-1]])
+        tokens.update(word)
+        tokens.update("##" + char for char in word)
+    tokens.discard("")
+
+    vocab_file = os.path.join(save_dir, "vocab.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+        f.write("\n".join(special_tokens + sorted(tokens)) + "\n")
+    # do_lower_case=True면 accent 제거 때문에 한글이 자모로 분리됩니다.
+    return BertTokenizerFast(vocab_file, do_lower_case=False, model_max_length=512)
+
+
+def get_answer_token_positions_zip(args, examples, answers):
+    '''
+    offset을 feature마다 zip 하고 slice 해서 bisect_left 하던 이전 구현을 옮겨 적은 것입니다.
+    옮겨 적은 copy와의 비교라서, 정답 위치 자체는 --known_span_check로 따로 확인합니다.
+    '''
+    start_positions, end_positions = [], []
+    for i, (input_ids, offset_mapping, overflow_to_sample_mapping) in enumerate(
+        zip(
+            examples["input_ids"],
+            examples["offset_mapping"],
+            examples["overflow_to_sample_mapping"],
+        )
+    ):
+        cls_token_idx = input_ids.index(args.tokenizer.cls_token_id)
+        answer_token_start_idx = answer_token_end_idx = cls_token_idx
+        sequence_ids = examples.sequence_ids(i)
+
+        answer_info = answers[overflow_to_sample_mapping]
+        if answer_info["answer_start"]:
+            answer_start_idx = answer_info["answer_start"][0]
+            answer_end_idx = answer_start_idx + len(answer_info["text"][0])
+
+            context_token_start_idx = sequence_ids.index(1)
+            context_token_end_idx = len(sequence_ids) - 2
+
+            offset_start_idxs, offset_end_idxs = zip(*offset_mapping)
+            if (
+                answer_start_idx >= offset_start_idxs[context_token_start_idx]
+                and answer_end_idx <= offset_end_idxs[context_token_end_idx]
+            ):
+                answer_token_start_idx = context_token_start_idx + bisect_left(
+                    offset_start_idxs[context_token_start_idx:context_token_end_idx],
+                    answer_start_idx,
+                )
+                answer_token_end_idx = context_token_start_idx + bisect_left(
+                    offset_end_idxs[context_token_start_idx:context_token_end_idx],
+                    answer_end_idx,
+                )
+
+        start_positions.append(answer_token_start_idx)
+        end_positions.append(answer_token_end_idx)
+    return start_positions, end_positions
+
+
+def get_answer_token_positions_bisect(args, examples, answers):
+    # preprocess와 같이 context mask를 만드는 시간까지 포함해서 잽니다.
+    examples["context_mask"] = [
+        get_context_mask(examples.sequence_ids(i))
+        for i in range(len(examples["input_ids"]))
+    ]
+    return get_answer_token_positions(args, examples, answers)
+
+
+def run_batches(align_fn, args, batches):
+    start_positions, end_positions = [], []
+    started = time.perf_counter()
+    for examples, answers in batches:
+        batch_start_positions, batch_end_positions = align_fn(args, examples, answers)
+        start_positions.extend(batch_start_positions)
+        end_positions.extend(batch_end_positions)
+    return start_positions, end_positions, time.perf_counter() - started
+
+
+def get_expected_positions(
+    examples, i, answer_start_idx, answer_end_idx, cls_token_id
+):
+    '''
+    정답 양 끝이 token 경계에 있을 때 feature i의 context token 중
+    offset이 정답 양 끝과 정확히 맞는 token을 찾습니다.
+    둘 중 하나라도 이 feature에 없으면 cls token 위치가 정답입니다.
+    '''
+    sequence_ids = examples.sequence_ids(i)
+    offset_mapping = examples["offset_mapping"][i]
+    context_idxs = [
+        idx for idx, sequence_id in enumerate(sequence_ids) if sequence_id == 1
+    ]
+    start_idxs = [
+        idx for idx in context_idxs if offset_mapping[idx][0] == answer_start_idx
+    ]
+    end_idxs = [
+        idx for idx in context_idxs if offset_mapping[idx][1] == answer_end_idx
+    ]
+    if start_idxs and end_idxs:
+        return start_idxs[0], end_idxs[0], end_idxs[0] == context_idxs[-1]
+    cls_token_idx = examples["input_ids"][i].index(cls_token_id)
+    return cls_token_idx, cls_token_idx, False
+
+
+def run_known_span_check(cli_args):
+    '''
+    competition data 없이 KNOWN_SPAN_CONTEXT의 연속한 두 어절을 하나씩 정답으로 두고,
+    짧은 window(max_length / stride)로 나눈 feature 마다
+    get_answer_token_positions가 offset으로 직접 찾은 위치와 같은지 봅니다.
+    어절은 token 경계에서 시작하고 끝나므로 위치를 offset 비교만으로 정확히 알 수 있습니다.
+    정답이 window 마지막 context token에서 끝나는 경우, window 끝에 걸친 경우,
+    window 밖인 경우가 모두 한번 이상 나와야 통과합니다.
+    '''
+    context = KNOWN_SPAN_CONTEXT
+    with tempfile.TemporaryDirectory() as work_dir:
+        tokenizer = build_known_span_tokenizer(context, work_dir)
+    args = Namespace(tokenizer=tokenizer)
+
+    word_spans = []
+    search_start = 0
+    for word in BasicTokenizer(do_lower_case=False).tokenize(context):
+        word_start_idx = context.index(word, search_start)
+        search_start = word_start_idx + len(word)
+        word_spans.append((word_start_idx, search_start))
+    # 연속한 두 어절을 정답으로 두어 window 끝에 걸치는 정답도 생기게 합니다.
+    answers = [
+        {
+            "text": [context[answer_start_idx:answer_end_idx]],
+            "answer_start": [answer_start_idx],
+        }
+        for (answer_start_idx, _), (_, answer_end_idx) in zip(
+            word_spans, word_spans[1:]
+        )
+    ]
+    examples = tokenizer(
+        ["정답은 무엇인가?"] * len(answers),
+        [context] * len(answers),
+        truncation="only_second",
+        max_length=cli_args.check_max_length,
+        stride=cli_args.check_stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+    )
+    start_positions, end_positions = get_answer_token_positions_bisect(
+        args, examples, answers
+    )
+
+    counts = {"inside": 0, "window_end": 0, "crosses_window": 0, "outside": 0}
+    num_mismatches = 0
+    for i, sample_idx in enumerate(examples["overflow_to_sample_mapping"]):
+        answer_start_idx = answers[sample_idx]["answer_start"][0]
+        answer_end_idx = answer_start_idx + len(answers[sample_idx]["text"][0])
+        expected_start, expected_end, at_window_end = get_expected_positions(
+            examples, i, answer_start_idx, answer_end_idx, tokenizer.cls_token_id
+        )
+        num_mismatches += (start_positions[i], end_positions[i]) != (
+            expected_start,
+            expected_end,
+        )
+        offset_mapping = examples["offset_mapping"][i]
+        context_starts = [
+            offset_mapping[idx][0]
+            for idx, sequence_id in enumerate(examples.sequence_ids(i))
+            if sequence_id == 1
+        ]
+        if at_window_end:
+            counts["window_end"] += 1
+        elif expected_start != examples["input_ids"][i].index(tokenizer.cls_token_id):
+            counts["inside"] += 1
+        elif context_starts[0] <= answer_start_idx < offset_mapping[-2][1]:
+            counts["crosses_window"] += 1
+        else:
+            counts["outside"] += 1
+
+    passed = num_mismatches == 0 and all(counts.values())
+    print(
+        json.dumps(
+            {
+                "num_answers": len(answers),
+                "num_features": len(start_positions),
+                "num_mismatches": num_mismatches,
+                **counts,
+                "passed": passed,
+            }
+        )
+    )
+    if not passed:
+        sys.exit(1)
+
+
+def main(cli_args):
+    if cli_args.known_span_check:
+        run_known_span_check(cli_args)
+        return
+
+    args = Namespace(
+        tokenizer=AutoTokenizer.from_pretrained(cli_args.tokenizer),
+        max_length=cli_args.max_length,
+        stride=cli_args.stride,
+    )
+    dataset = load_from_disk(cli_args.trainset_path)[cli_args.split]
+    if cli_args.num_examples:
+        dataset = dataset.select(range(min(cli_args.num_examples, len(dataset))))
+    # tokenize는 두 구현이 같으므로 미리 해두고 label alignment만 잽니다.
+    started = time.perf_counter()
+    batches = []
+    for batch_start in range(0, len(dataset), cli_args.batch_size):
+        examples = dataset[batch_start : batch_start + cli_args.batch_size]
+        batches.append(
+            (
+                args.tokenizer(
+                    examples["question"],
+                    examples["context"],
+                    truncation="only_second",
+                    max_length=args.max_length,
+                    stride=args.stride,
+                    return_overflowing_tokens=True,
+                    return_offsets_mapping=True,
+                ),
+                examples["answers"],
+            )
+        )
+    tokenize_seconds = time.perf_counter() - started
+    num_features = sum(len(examples["input_ids"]) for examples, _ in batches)
+
+    zip_start, zip_end, zip_seconds = run_batches(
+        get_answer_token_positions_zip, args, batches
+    )
+    start, end, bisect_seconds = run_batches(
+        get_answer_token_positions_bisect, args, batches
+    )
+
+    parity = zip_start == start and zip_end == end
+    print(
+        json.dumps(
+            {
+                "num_examples": len(dataset),
+                "num_features": num_features,
+                "tokenize_seconds": tokenize_seconds,
+                "zip_seconds": zip_seconds,
+                "bisect_seconds": bisect_seconds,
+                "zip_features_per_second": num_features / zip_seconds,
+                "bisect_features_per_second": num_features / bisect_seconds,
+                "speedup": zip_seconds / bisect_seconds,
+                "parity": parity,
+            }
+        )
+    )
+    if not parity:
+        mismatches = [
+            i
+            for i, positions in enumerate(zip(zip_start, zip_end, start, end))
+            if positions[:2] != positions[2:]
+        ]
+        print(f"{len(mismatches)} features differ, e.g. {mismatches[:10]}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trainset_path", default="../data/new_train_dataset")
+    parser.add_argument("--split", default="train_concat_dataset")
+    parser.add_argument("--tokenizer", default="klue/roberta-large")
+    parser.add_argument("--max_length", type=int, default=384)
+    parser.add_argument("--stride", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--num_examples", type=int, default=None)
+    parser.add_argument(
+        "--known_span_check", action="store_true"
+    )  # competition data 없이 KNOWN_SPAN_CONTEXT의 알려진 정답 위치로만 검사합니다.
+    parser.add_argument("--check_max_length", type=int, default=48)
+    parser.add_argument("--check_stride", type=int, default=16)
+
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+import numpy as np
+from datasets import Dataset, DatasetDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metric import postprocess
+
+
+def make_synthetic_predictions(num_examples, features_per_example, max_length, seed):
+    '''
+    reader 출력과 같은 모양의 가짜 feature / logits를 만듭니다.
+    question 32 token + context (max_length - 35) token 구성을 흉내냅니다.
+    '''
+    rng = np.random.default_rng(seed)
+    question_length = 32
+    context_length = max_length - question_length - 3
+    context = "".join(
+        chr(0xAC00 + syllable)
+        for syllable in rng.integers(0, 11172, size=context_length * 2)
+    )
+
+    offset_mappings, context_masks, sample_mapping = [], [], []
+    for example_idx in range(num_examples):
+        for _ in range(features_per_example):
+            offset_mappings.append(
+                [(0, 0)]
+                + [(i, i + 1) for i in range(question_length)]
+                + [(0, 0)]
+                + [(2 * i, 2 * i + 2) for i in range(context_length)]
+                + [(0, 0)]
+            )
+            context_masks.append(
+                [0] * (question_length + 2) + [1] * context_length + [0]
+            )
+            sample_mapping.append(example_idx)
+
+    num_features = len(sample_mapping)
+    args = Namespace(
+        max_answer_length=30,
+        num_max_prediction=20,
+        retrieval_score_weight=0.0,
+        dataset=DatasetDict(
+            {
+                "validation": Dataset.from_dict(
+                    {
+                        "id": [f"mrc-{i}" for i in range(num_examples)],
+                        "context": [context] * num_examples,
+                    }
+                )
+            }
+        ),
+        processed_eval_dataset={
+            "offset_mapping": offset_mappings,
+            "overflow_to_sample_mapping": sample_mapping,
+            "context_mask": context_masks,
+        },
+    )
+    outputs = Namespace(
+        predictions=(
+            rng.normal(size=(num_features, max_length)).astype(np.float32),
+            rng.normal(size=(num_features, max_length)).astype(np.float32),
+        )
+    )
+    return args, outputs
+
+
+def main(cli_args):
+    results = []
+    for num_examples in cli_args.num_examples:
+        args, outputs = make_synthetic_predictions(
+            num_examples,
+            cli_args.features_per_example,
+            cli_args.max_length,
+            cli_args.seed,
+        )
+        num_features = len(args.processed_eval_dataset["context_mask"])
+        with tempfile.TemporaryDirectory() as output_dir:
+            args.output_dir = output_dir
+            started = time.perf_counter()
+            postprocess(args, outputs)
+            elapsed = time.perf_counter() - started
+        results.append(
+            {
+                "num_examples": num_examples,
+                "num_features": num_features,
+                "seconds": elapsed,
+                "ms_per_feature": elapsed / num_features * 1000,
+            }
+        )
+        print(json.dumps(results[-1]))
+
+    # decoding이 feature 수에 선형이라면 feature 당 시간은 크기와 상관없이 비슷해야 합니다.
+    ms_per_feature = [result["ms_per_feature"] for result in results]
+    ratio = max(ms_per_feature) / min(ms_per_feature)
+    print(json.dumps({"max_to_min_ms_per_feature": ratio}))
+    if ratio > cli_args.max_ratio:
+        print(
+            f"postprocess is not linear in the number of features "
+            f"(ratio {ratio:.2f} > {cli_args.max_ratio})"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_examples", type=int, nargs="+", default=[250, 500, 1000, 2000]
+    )
+    parser.add_argument("--features_per_example", type=int, default=4)
+    parser.add_argument("--max_length", type=int, default=384)
+    parser.add_argument("--max_ratio", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+
+    main(parser.parse_args())
@@ -0,0 +1,326 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+from datasets import DatasetDict, load_from_disk
+from transformers import AutoTokenizer, BertConfig, BertTokenizerFast
+from transformers.models.bert.tokenization_bert import BasicTokenizer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import get_peak_rss_mb
+from Retrieval.dense_model import BertEncoder
+from Retrieval.retrieval import DenseRetrieval, HybridRetrieval, SparseRetrieval
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+# top k가 top max_k의 앞부분과 같은 retriever 입니다. hybrid는 sparse top k 후보를 dense 점수로
+# 다시 정렬하므로 k가 바뀌면 후보 자체가 바뀝니다.
+PREFIX_CONSISTENT_RETRIEVERS = ("sparse", "dense")
+
+
+def load_questions(questions_path, context_path):
+    '''
+    (question, 정답 doc id) list를 반환합니다.
+    json list 파일이면 그대로 읽고, load_from_disk 경로면 validation의 context로 정답 문서를 찾습니다.
+    '''
+    if questions_path.endswith(".json"):
+        with open(questions_path, encoding="utf-8") as f:
+            return [(row["question"], row["document_id"]) for row in json.load(f)]
+
+    dataset = load_from_disk(questions_path)
+    if isinstance(dataset, DatasetDict):
+        dataset = dataset["validation"]
+    wiki = pd.read_json(context_path, orient="index")
+    wiki_context_id = dict(zip(wiki["text"], wiki["document_id"]))
+    # wiki에 없는 context의 question은 정답이 없으므로 제외합니다.
+    return [
+        (question, wiki_context_id[context])
+        for question, context in zip(dataset["question"], dataset["context"])
+        if context in wiki_context_id
+    ]
+
+
+def build_offline_tokenizer(context_path, save_dir):
+    '''
+    모든 한글 음절, ASCII 문자와 wiki 어절로 vocab을 만든 BertTokenizerFast를 save_dir에 저장합니다.
+    끝 글자(조사)를 뗀 어절도 넣어서 "홍길동이"가 "홍길동 ##이"로 나뉘도록 합니다.
+    '''
+    wiki = pd.read_json(context_path, orient="index")
+    basic_tokenizer = BasicTokenizer(do_lower_case=False)
+    chars = [chr(code) for code in range(0xAC00, 0xD7A4)]
+    chars += [chr(code) for code in range(0x21, 0x7F)]
+    tokens = set(chars) | {"##" + char for char in chars}
+    for text in list(wiki["text"]) + list(wiki["title"]):
+        for word in basic_tokenizer.tokenize(text):
+            tokens.update([word, word[:-1]])
+            tokens.update(word)
+            tokens.update("##" + char for char in word)
+    tokens.discard("")
+
+    os.makedirs(save_dir, exist_ok=True)
+    vocab_file = os.path.join(save_dir, "vocab.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(SPECIAL_TOKENS + sorted(tokens)) + "\n")
+    # do_lower_case=True면 accent 제거 때문에 한글이 자모로 분리됩니다.
+    tokenizer = BertTokenizerFast(vocab_file, do_lower_case=False, model_max_length=512)
+    tokenizer.save_pretrained(save_dir)
+    return tokenizer
+
+
+def build_tiny_encoders(tokenizer, save_dir, hidden_size, num_layers, seed):
+    '''
+    random weight의 작은 BertEncoder를 p_encoder / q_encoder로 저장합니다.
+    검색 품질이 아니라 DenseRetrieval / HybridRetrieval의 시간과 memory를 재기 위한 것입니다.
+    '''
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=max(1, hidden_size // 32),
+        intermediate_size=hidden_size * 4,
+        max_position_embeddings=512,
+    )
+    for name in ["p_encoder", "q_encoder"]:
+        BertEncoder(config).save_pretrained(os.path.join(save_dir, name))
+    return os.path.join(save_dir, "p_encoder"), os.path.join(save_dir, "q_encoder")
+
+
+def build_retriever(cli_args, retriever_name, tokenizer, work_dir):
+    retrieval_kwargs = {
+        "data_path": work_dir + "/",
+        # retriever마다 caching 폴더를 따로 써서 build 시간에 다른 retriever의 cache가 섞이지 않게 합니다.
+        "caching_path": f"caching-{retriever_name}/",
+        "context_path": cli_args.context_path,
+        "num_threads": cli_args.retrieval_num_threads,
+    }
+    os.makedirs(
+        retrieval_kwargs["data_path"] + retrieval_kwargs["caching_path"], exist_ok=True
+    )
+    # DenseRetrieval은 data_path 기준 상대 경로로 encoder를 읽습니다.
+    encoder_paths = {
+        "p_encoder_path": os.path.relpath(cli_args.p_encoder_path, work_dir) + "/",
+        "q_encoder_path": os.path.relpath(cli_args.q_encoder_path, work_dir) + "/",
+    }
+    if retriever_name == "sparse":
+        return SparseRetrieval(
+            tokenizer, use_elasticsearch=cli_args.use_elasticsearch, **retrieval_kwargs
+        )
+    if retriever_name == "dense":
+        return DenseRetrieval(tokenizer, **encoder_paths, **retrieval_kwargs)
+    return HybridRetrieval(
+        tokenizer,
+        use_elasticsearch=cli_args.use_elasticsearch,
+        **encoder_paths,
+        **retrieval_kwargs,
+    )
+
+
+def get_ranking_metrics(ranked_doc_ids, gold_doc_ids, top_ks):
+    ranks = [
+        doc_ids.index(gold) + 1 if gold in doc_ids else None
+        for doc_ids, gold in zip(ranked_doc_ids, gold_doc_ids)
+    ]
+    metrics = {
+        f"recall@{k}": float(
+            np.mean([rank is not None and rank <= k for rank in ranks])
+        )
+        for k in top_ks
+    }
+    metrics[f"mrr@{top_ks[-1]}"] = float(
+        np.mean([0.0 if rank is None else 1.0 / rank for rank in ranks])
+    )
+    return metrics
+
+
+def get_recall_at_each_k(retriever, querys, gold_doc_ids, top_ks, batch_size):
+    '''
+    k 마다 top_k_retrieval=k로 따로 retrieve 해서 recall@k를 구합니다.
+    '''
+    metrics = {}
+    for top_k in top_ks:
+        ranked_doc_ids = []
+        for start in range(0, len(querys), batch_size):
+            batch = querys[start : start + batch_size]
+            query_ids, _ = retriever.get_topk_doc_id_and_score_for_querys(
+                batch, top_k, show_progress=False
+            )
+            ranked_doc_ids.extend(list(query_ids[query]) for query in batch)
+        metrics[f"recall@{top_k}"] = get_ranking_metrics(
+            ranked_doc_ids, gold_doc_ids, [top_k]
+        )[f"recall@{top_k}"]
+    return metrics
+
+
+def get_latency_summary(latencies):
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def run_retriever(cli_args, retriever_name, tokenizer_path, work_dir, questions):
+    '''
+    spawn 된 process에서 retriever 하나를 만들고 단건 / batch API를 잽니다.
+    process를 나누기 때문에 peak RSS가 retriever마다 따로 측정됩니다.
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    querys = [question for question, _ in questions]
+    gold_doc_ids = [doc_id for _, doc_id in questions]
+    max_k = cli_args.top_k[-1]
+
+    started = time.perf_counter()
+    retriever = build_retriever(cli_args, retriever_name, tokenizer, work_dir)
+    build_seconds = time.perf_counter() - started
+    build_peak_rss_mb = get_peak_rss_mb()
+
+    # 첫 query의 lazy 초기화 비용은 빼고 잽니다.
+    retriever.get_topk_doc_id_and_score(querys[0], max_k)
+    single_latencies = []
+    single_doc_ids = []
+    for query in querys:
+        started = time.perf_counter()
+        doc_ids, _ = retriever.get_topk_doc_id_and_score(query, max_k)
+        single_latencies.append(time.perf_counter() - started)
+        single_doc_ids.append(list(doc_ids))
+
+    batch_latencies = []
+    batch_doc_ids = {}
+    batch_started = time.perf_counter()
+    for start in range(0, len(querys), cli_args.batch_size):
+        batch = querys[start : start + cli_args.batch_size]
+        started = time.perf_counter()
+        query_ids, _ = retriever.get_topk_doc_id_and_score_for_querys(batch, max_k)
+        # batch API는 query 하나 당 걸린 시간으로 나눠서 비교합니다.
+        batch_latencies.append((time.perf_counter() - started) / len(batch))
+        batch_doc_ids.update(query_ids)
+    batch_seconds = time.perf_counter() - batch_started
+
+    ranking_metrics = get_ranking_metrics(single_doc_ids, gold_doc_ids, cli_args.top_k)
+    if retriever_name not in PREFIX_CONSISTENT_RETRIEVERS:
+        ranking_metrics.update(
+            get_recall_at_each_k(
+                retriever, querys, gold_doc_ids, cli_args.top_k, cli_args.batch_size
+            )
+        )
+
+    return {
+        "retriever": retriever_name,
+        **ranking_metrics,
+        "build_seconds": build_seconds,
+        "build_peak_rss_mb": build_peak_rss_mb,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "single_latency": get_latency_summary(single_latencies),
+        "batch_latency": get_latency_summary(batch_latencies),
+        "batch_queries_per_second": len(querys) / batch_seconds,
+        # 같은 query에 대해 batch API가 단건 API와 같은 문서를 돌려주는 비율입니다.
+        "batch_agreement": float(
+            np.mean(
+                [
+                    list(batch_doc_ids[query]) == doc_ids
+                    for query, doc_ids in zip(querys, single_doc_ids)
+                ]
+            )
+        ),
+    }
+
+
+def main(cli_args):
+    cli_args.top_k = sorted(cli_args.top_k)
+    questions = load_questions(cli_args.questions_path, cli_args.context_path)
+    if cli_args.num_questions:
+        questions = questions[: cli_args.num_questions]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = os.path.abspath(cli_args.work_dir or temp_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        tokenizer_path = cli_args.tokenizer
+        if tokenizer_path is None:
+            tokenizer_path = os.path.join(work_dir, "tokenizer")
+            tokenizer = build_offline_tokenizer(cli_args.context_path, tokenizer_path)
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        if cli_args.p_encoder_path is None or cli_args.q_encoder_path is None:
+            cli_args.p_encoder_path, cli_args.q_encoder_path = build_tiny_encoders(
+                tokenizer,
+                work_dir,
+                cli_args.encoder_hidden_size,
+                cli_args.encoder_num_layers,
+                cli_args.seed,
+            )
+
+        results = []
+        for retriever_name in cli_args.retriever:
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                result = executor.submit(
+                    run_retriever,
+                    cli_args,
+                    retriever_name,
+                    tokenizer_path,
+                    work_dir,
+                    questions,
+                ).result()
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+
+    report = {
+        "context_path": cli_args.context_path,
+        "questions_path": cli_args.questions_path,
+        "num_questions": len(questions),
+        "top_k": cli_args.top_k,
+        "batch_size": cli_args.batch_size,
+        "results": results,
+    }
+    if cli_args.output:
+        with open(cli_args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--retriever",
+        type=str,
+        nargs="+",
+        default=["sparse", "dense", "hybrid"],
+        choices=["sparse", "dense", "hybrid"],
+    )
+    parser.add_argument(
+        "--context_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_wiki.json"),
+    )
+    parser.add_argument(
+        "--questions_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_questions.json"),
+    )  # json list 또는 validation이 있는 load_from_disk 경로
+    parser.add_argument("--num_questions", type=int, default=None)
+    parser.add_argument("--top_k", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument(
+        "--tokenizer", type=str, default=None
+    )  # 없으면 corpus로 offline tokenizer를 만듭니다.
+    parser.add_argument(
+        "--p_encoder_path", type=str, default=None
+    )  # 없으면 random weight의 작은 encoder를 씁니다.
+    parser.add_argument("--q_encoder_path", type=str, default=None)
+    parser.add_argument("--encoder_hidden_size", type=int, default=64)
+    parser.add_argument("--encoder_num_layers", type=int, default=2)
+    parser.add_argument("--use_elasticsearch", action="store_true")
+    parser.add_argument("--retrieval_num_threads", type=int, default=None)
+    parser.add_argument(
+        "--work_dir", type=str, default=None
+    )  # 지정하면 cache가 남아서 두 번째 실행부터는 cache load 시간을 잽니다.
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+
+    main(parser.parse_args())
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from retrieval_benchmark import (
+    DATA_DIR,
+    build_offline_tokenizer,
+    build_retriever,
+    build_tiny_encoders,
+    load_questions,
+)
+
+
+def is_same_result(expected, actual, tolerance):
+    '''
+    doc id와 score가 serial 실행과 같은지 봅니다.
+    score가 tolerance 안에서 같은 문서끼리는 순서가 바뀌어도 같은 결과로 봅니다.
+    '''
+    expected_ids, expected_scores = expected
+    actual_ids, actual_scores = actual
+    if len(expected_ids) != len(actual_ids) or not np.allclose(
+        expected_scores, actual_scores, rtol=0, atol=tolerance
+    ):
+        return False
+    expected_score_by_id = dict(zip(expected_ids, expected_scores))
+    return all(
+        doc_id in expected_score_by_id
+        and abs(expected_score_by_id[doc_id] - score) <= tolerance
+        for doc_id, score in zip(actual_ids, actual_scores)
+    )
+
+
+def call(retriever, task, querys, batches, top_k):
+    kind, idx = task
+    try:
+        if kind == "single":
+            return retriever.get_topk_doc_id_and_score(querys[idx], top_k)
+        return retriever.get_topk_doc_id_and_score_for_querys(batches[idx], top_k)
+    except Exception as e:
+        return e
+
+
+def count_mismatches(task, result, expected, batches, tolerance):
+    kind, idx = task
+    if kind == "single":
+        return int(not is_same_result(expected[task], result, tolerance))
+    query_ids, query_scores = result
+    expected_ids, expected_scores = expected[task]
+    return sum(
+        not is_same_result(
+            (expected_ids[query], expected_scores[query]),
+            (query_ids[query], query_scores[query]),
+            tolerance,
+        )
+        for query in batches[idx]
+    )
+
+
+def stress(cli_args, retriever_name, tokenizer, work_dir, querys):
+    '''
+    retriever 하나를 여러 thread가 동시에 단건 / batch API로 부르게 하고
+    모든 결과를 같은 호출을 serial로 돌린 결과와 비교합니다.
+    '''
+    retriever = build_retriever(cli_args, retriever_name, tokenizer, work_dir)
+    top_k = cli_args.top_k
+    batches = [
+        querys[start : start + cli_args.batch_size]
+        for start in range(0, len(querys), cli_args.batch_size)
+    ]
+    tasks = [("single", i) for i in range(len(querys))]
+    tasks += [("batch", i) for i in range(len(batches))]
+
+    started = time.perf_counter()
+    expected = {task: call(retriever, task, querys, batches, top_k) for task in tasks}
+    serial_seconds = time.perf_counter() - started
+    for task, result in expected.items():
+        if isinstance(result, Exception):
+            raise RuntimeError(f"serial {task} failed") from result
+
+    rng = np.random.default_rng(cli_args.seed)
+    concurrent_tasks = [
+        tasks[i]
+        for _ in range(cli_args.num_rounds)
+        for i in rng.permutation(len(tasks))
+    ]
+    errors = []
+    num_mismatches = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(cli_args.num_threads) as executor:
+        for task, result in zip(
+            concurrent_tasks,
+            executor.map(
+                lambda task: call(retriever, task, querys, batches, top_k),
+                concurrent_tasks,
+            ),
+        ):
+            if isinstance(result, Exception):
+                errors.append(f"{task}: {result!r}")
+                continue
+            num_mismatches += count_mismatches(
+                task, result, expected, batches, cli_args.tolerance
+            )
+    concurrent_seconds = time.perf_counter() - started
+
+    return {
+        "retriever": retriever_name,
+        "num_threads": cli_args.num_threads,
+        "retrieval_num_threads": cli_args.retrieval_num_threads,
+        "num_calls": len(concurrent_tasks),
+        "num_errors": len(errors),
+        "errors": errors[:5],
+        "num_mismatches": num_mismatches,
+        # 같은 호출 묶음 한번을 serial / concurrent로 돌리는 데 걸린 시간입니다.
+        "serial_seconds": serial_seconds,
+        "concurrent_seconds_per_round": concurrent_seconds / cli_args.num_rounds,
+    }
+
+
+def main(cli_args):
+    querys = [
+        question
+        for question, _ in load_questions(
+            cli_args.questions_path, cli_args.context_path
+        )
+    ][: cli_args.num_questions]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tokenizer = build_offline_tokenizer(
+            cli_args.context_path, os.path.join(work_dir, "tokenizer")
+        )
+        cli_args.p_encoder_path, cli_args.q_encoder_path = build_tiny_encoders(
+            tokenizer,
+            work_dir,
+            cli_args.encoder_hidden_size,
+            cli_args.encoder_num_layers,
+            cli_args.seed,
+        )
+        results = []
+        for retriever_name in cli_args.retriever:
+            result = stress(cli_args, retriever_name, tokenizer, work_dir, querys)
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+
+    if any(result["num_errors"] or result["num_mismatches"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--retriever",
+        type=str,
+        nargs="+",
+        default=["sparse", "dense", "hybrid"],
+        choices=["sparse", "dense", "hybrid"],
+    )
+    parser.add_argument(
+        "--context_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_wiki.json"),
+    )
+    parser.add_argument(
+        "--questions_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_questions.json"),
+    )
+    parser.add_argument("--num_questions", type=int, default=100)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_threads", type=int, default=16)  # 동시에 부르는 thread 수
+    parser.add_argument(
+        "--retrieval_num_threads", type=int, default=1
+    )  # 검색 한번이 쓰는 torch intra-op thread 수
+    parser.add_argument("--num_rounds", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    parser.add_argument("--encoder_hidden_size", type=int, default=64)
+    parser.add_argument("--encoder_num_layers", type=int, default=2)
+    parser.add_argument("--use_elasticsearch", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
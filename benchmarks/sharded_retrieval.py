@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from retrieval_benchmark import (
+    DATA_DIR,
+    build_offline_tokenizer,
+    build_retriever,
+    build_tiny_encoders,
+    load_questions,
+)
+from retrieval_concurrency import is_same_result
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Retrieval.sharded_retrieval import ShardedDenseRetrieval, ShardedSparseRetrieval
+
+
+def build_sharded_retriever(cli_args, retriever_name, tokenizer, work_dir, num_shards):
+    # build_retriever가 만든 caching 폴더(dense_embedding.bin 등)를 그대로 나눠 씁니다.
+    retrieval_kwargs = {
+        "data_path": work_dir + "/",
+        "caching_path": f"caching-{retriever_name}/",
+        "context_path": cli_args.context_path,
+        "num_shards": num_shards,
+        "num_threads": cli_args.retrieval_num_threads,
+    }
+    if retriever_name == "sparse":
+        return ShardedSparseRetrieval(tokenizer, **retrieval_kwargs)
+    return ShardedDenseRetrieval(
+        tokenizer,
+        os.path.relpath(cli_args.q_encoder_path, work_dir) + "/",
+        **retrieval_kwargs,
+    )
+
+
+def get_shard_querys(retriever, retriever_name, querys):
+    # shard에 보내는 입력만 미리 만들어 scatter-gather 시간만 잽니다.
+    if retriever_name == "sparse":
+        tokenizer = retriever.get_tokenizer()
+        return [tokenizer.tokenize(query) for query in querys]
+    return retriever.get_query_embedding(querys).float().cpu().numpy()
+
+
+def time_search(shards, shard_querys, batch_size, top_k, num_rounds, num_callers):
+    '''
+    batch들을 num_callers개 thread가 나눠서 동시에 검색합니다.
+    thread마다 shard 연결이 따로 있으므로 scatter-gather가 서로 기다리지 않습니다.
+    검색 시간과 함께 한 thread로 순서대로 검색한 결과와 다른 batch 수를 돌려줍니다.
+    '''
+    batches = [
+        shard_querys[start : start + batch_size]
+        for start in range(0, len(shard_querys), batch_size)
+    ]
+    expected = [shards.search(batch, top_k) for batch in batches]
+    with ThreadPoolExecutor(num_callers) as pool:
+        started = time.perf_counter()
+        for _ in range(num_rounds):
+            results = list(pool.map(lambda batch: shards.search(batch, top_k), batches))
+        seconds = (time.perf_counter() - started) / num_rounds
+    num_mismatches = sum(
+        result != expected_result for result, expected_result in zip(results, expected)
+    )
+    return seconds, num_mismatches
+
+
+def compare(cli_args, retriever_name, tokenizer, work_dir, querys):
+    '''
+    shard를 나누지 않은 retriever의 batch 결과를 기준으로 shard 수 별 결과가 같은지와
+    shard 검색(scatter-gather)의 query/sec를 잽니다.
+    '''
+    retriever = build_retriever(cli_args, retriever_name, tokenizer, work_dir)
+    top_k = cli_args.top_k
+    expected_ids, expected_scores = retriever.get_topk_doc_id_and_score_for_querys(
+        querys, top_k
+    )
+    del retriever
+
+    results = []
+    for num_shards in cli_args.num_shards:
+        started = time.perf_counter()
+        sharded = build_sharded_retriever(
+            cli_args, retriever_name, tokenizer, work_dir, num_shards
+        )
+        start_seconds = time.perf_counter() - started
+        try:
+            doc_ids, scores = sharded.get_topk_doc_id_and_score_for_querys(
+                querys, top_k
+            )
+            num_exact = sum(
+                doc_ids[query] == expected_ids[query]
+                and scores[query] == list(expected_scores[query])
+                for query in querys
+            )
+            num_mismatches = sum(
+                not is_same_result(
+                    (expected_ids[query], expected_scores[query]),
+                    (doc_ids[query], scores[query]),
+                    cli_args.tolerance,
+                )
+                for query in querys
+            )
+            shard_querys = get_shard_querys(sharded, retriever_name, querys)
+            search_seconds, num_concurrent_mismatches = time_search(
+                sharded.shards,
+                shard_querys,
+                cli_args.batch_size,
+                top_k,
+                cli_args.num_rounds,
+                cli_args.num_callers,
+            )
+        finally:
+            sharded.close()
+
+        result = {
+            "retriever": retriever_name,
+            "num_shards": num_shards,
+            "num_querys": len(querys),
+            # doc id 순서와 score가 shard를 나누지 않은 결과와 완전히 같은 query 수
+            "num_exact": num_exact,
+            "num_mismatches": num_mismatches,
+            # 여러 thread가 동시에 검색한 결과가 한 thread로 검색한 결과와 다른 batch 수
+            "num_concurrent_mismatches": num_concurrent_mismatches,
+            "num_callers": cli_args.num_callers,
+            "start_seconds": start_seconds,
+            "search_qps": len(querys) / search_seconds,
+        }
+        result["speedup"] = result["search_qps"] / (
+            results[0]["search_qps"] if results else result["search_qps"]
+        )
+        print(json.dumps(result, ensure_ascii=False))
+        results.append(result)
+    return results
+
+
+def main(cli_args):
+    # ShardedSparseRetrieval은 BM25Okapi만 나누므로 기준도 BM25Okapi로 만듭니다.
+    cli_args.use_elasticsearch = False
+    querys = [
+        question
+        for question, _ in load_questions(
+            cli_args.questions_path, cli_args.context_path
+        )
+    ][: cli_args.num_questions]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tokenizer = build_offline_tokenizer(
+            cli_args.context_path, os.path.join(work_dir, "tokenizer")
+        )
+        cli_args.p_encoder_path, cli_args.q_encoder_path = build_tiny_encoders(
+            tokenizer,
+            work_dir,
+            cli_args.encoder_hidden_size,
+            cli_args.encoder_num_layers,
+            cli_args.seed,
+        )
+        results = []
+        for retriever_name in cli_args.retriever:
+            results += compare(cli_args, retriever_name, tokenizer, work_dir, querys)
+
+    if any(
+        result["num_mismatches"] or result["num_concurrent_mismatches"]
+        for result in results
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--retriever",
+        type=str,
+        nargs="+",
+        default=["sparse", "dense"],
+        choices=["sparse", "dense"],
+    )
+    parser.add_argument(
+        "--context_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_wiki.json"),
+    )
+    parser.add_argument(
+        "--questions_path",
+        type=str,
+        default=os.path.join(DATA_DIR, "synthetic_korean_questions.json"),
+    )
+    parser.add_argument("--num_questions", type=int, default=200)
+    parser.add_argument(
+        "--num_shards", type=int, nargs="+", default=[1, 2, 4]
+    )  # 첫 값이 speedup의 기준입니다.
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument(
+        "--retrieval_num_threads", type=int, default=1
+    )  # shard worker 하나가 쓰는 torch intra-op thread 수
+    parser.add_argument("--num_rounds", type=int, default=3)
+    parser.add_argument(
+        "--num_callers", type=int, default=1
+    )  # shard 검색을 동시에 호출하는 thread 수
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    parser.add_argument("--encoder_hidden_size", type=int, default=64)
+    parser.add_argument("--encoder_num_layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
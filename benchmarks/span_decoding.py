@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metric import get_prediction_candidates
+from postprocess_scaling import make_synthetic_predictions
+
+
+def get_prediction_candidates_loop(args, outputs):
+    '''
+    vectorize 하기 전의 argsort + 이중 loop 구현입니다. parity 비교용으로만 남겨둡니다.
+    '''
+    dataset = args.dataset["validation"]
+    ids = dataset["id"]
+    contexts = dataset["context"]
+    prediction_cadidates_info = defaultdict(list)
+    for (
+        context_mask,
+        offset_mapping,
+        overflow_to_sample_mapping,
+        logits_of_start_idxs_prediction,
+        logits_of_end_idxs_prediction,
+    ) in zip(
+        args.processed_eval_dataset["context_mask"],
+        args.processed_eval_dataset["offset_mapping"],
+        args.processed_eval_dataset["overflow_to_sample_mapping"],
+        *outputs.predictions,
+    ):
+        start_offset_idxs = np.argsort(logits_of_start_idxs_prediction)[
+            -1 : -args.num_max_prediction - 1 : -1
+        ]
+        end_offset_idxs = np.argsort(logits_of_end_idxs_prediction)[
+            -1 : -args.num_max_prediction - 1 : -1
+        ]
+        for start_offset_idx in start_offset_idxs:
+            for end_offset_idx in end_offset_idxs:
+                if (
+                    start_offset_idx < len(offset_mapping)
+                    and context_mask[start_offset_idx] == 1
+                    and start_offset_idx <= end_offset_idx < len(offset_mapping)
+                    and end_offset_idx - start_offset_idx <= args.max_answer_length
+                    and offset_mapping[start_offset_idx][0]
+                    < offset_mapping[end_offset_idx][1]
+                ):
+                    prediction_cadidates_info[ids[overflow_to_sample_mapping]].append(
+                        {
+                            "text": contexts[overflow_to_sample_mapping][
+                                offset_mapping[start_offset_idx][0] : offset_mapping[
+                                    end_offset_idx
+                                ][1]
+                            ],
+                            "score": logits_of_start_idxs_prediction[start_offset_idx]
+                            + logits_of_end_idxs_prediction[end_offset_idx],
+                        }
+                    )
+    return prediction_cadidates_info
+
+
+def top_n(prediction_cadidates_info, num_max_prediction):
+    return {
+        id: [
+            (info["text"], float(info["score"]))
+            for info in sorted(infos, key=lambda x: x["score"], reverse=True)[
+                :num_max_prediction
+            ]
+        ]
+        for id, infos in prediction_cadidates_info.items()
+    }
+
+
+def is_same_top_n(expected, actual, tolerance=1e-4):
+    # float32 합과 python float 합의 차이만큼은 허용합니다.
+    return expected.keys() == actual.keys() and all(
+        len(expected[id]) == len(actual[id])
+        and all(
+            expected_text == actual_text
+            and abs(expected_score - actual_score) < tolerance
+            for (expected_text, expected_score), (actual_text, actual_score) in zip(
+                expected[id], actual[id]
+            )
+        )
+        for id in expected
+    )
+
+
+def main(cli_args):
+    args, outputs = make_synthetic_predictions(
+        cli_args.num_examples,
+        cli_args.features_per_example,
+        cli_args.max_length,
+        cli_args.seed,
+    )
+
+    started = time.perf_counter()
+    loop_candidates = get_prediction_candidates_loop(args, outputs)
+    loop_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    vectorized_candidates = get_prediction_candidates(args, outputs)
+    vectorized_seconds = time.perf_counter() - started
+
+    args.postprocess_num_workers = cli_args.num_workers
+    started = time.perf_counter()
+    parallel_candidates = get_prediction_candidates(args, outputs)
+    parallel_seconds = time.perf_counter() - started
+
+    expected = top_n(loop_candidates, args.num_max_prediction)
+    parity = is_same_top_n(
+        expected, top_n(vectorized_candidates, args.num_max_prediction)
+    )
+    # process 수와 상관없이 id 순서와 id 안의 후보 순서까지 같아야 합니다.
+    sharded_parity = list(parallel_candidates.items()) == list(
+        vectorized_candidates.items()
+    )
+    print(
+        json.dumps(
+            {
+                "num_features": len(args.processed_eval_dataset["context_mask"]),
+                "loop_seconds": loop_seconds,
+                "vectorized_seconds": vectorized_seconds,
+                "speedup": loop_seconds / vectorized_seconds,
+                "num_workers": cli_args.num_workers,
+                "parallel_seconds": parallel_seconds,
+                "parallel_speedup": vectorized_seconds / parallel_seconds,
+                "parity": parity,
+                "sharded_parity": sharded_parity,
+            }
+        )
+    )
+    if not (parity and sharded_parity):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_examples", type=int, default=1000)
+    parser.add_argument("--features_per_example", type=int, default=4)
+    parser.add_argument("--max_length", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--num_workers", type=int, default=4)
+
+    main(parser.parse_args())
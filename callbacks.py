@@ -0,0 +1,146 @@
+import time
+from dataclasses import dataclass
+
+import torch
+from transformers import DataCollatorWithPadding, TrainerCallback
+
+from instrumentation import get_peak_rss_mb
+
+
+@dataclass
+class PaddingStatsCollator(DataCollatorWithPadding):
+    '''
+    DataCollatorWithPadding과 같이 batch를 padding 하면서
+    실제 token 수와 padding 후 token 수, 마지막 batch가 준비된 시각을 남깁니다.
+    dataloader_num_workers > 0 이면 worker process에서 세기 때문에 main process에서는 보이지 않습니다.
+    '''
+
+    num_tokens: int = 0
+    num_padded_tokens: int = 0
+    last_batch_time: float = 0.0
+
+    def __call__(self, features):
+        batch = super().__call__(features)
+        self.num_tokens += sum(len(feature["input_ids"]) for feature in features)
+        self.num_padded_tokens += batch["input_ids"].numel()
+        self.last_batch_time = time.perf_counter()
+        return batch
+
+    def get_state(self):
+        return self.num_tokens, self.num_padded_tokens
+
+    def set_state(self, state):
+        self.num_tokens, self.num_padded_tokens = state
+
+
+class PaddingWasteCallback(TrainerCallback):
+    '''
+    epoch마다 train batch에서 padding이 차지한 비율을 출력하고 log_history에 남깁니다.
+    evaluation도 같은 collator를 쓰므로 evaluation 동안 센 token은 빼고 계산합니다.
+    '''
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.train_state = (0, 0)
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.collator.set_state((0, 0))
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # 이 다음에 evaluation이 돌 수 있으므로 train batch까지의 수를 기억해둡니다.
+        self.train_state = self.collator.get_state()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.collator.set_state(self.train_state)
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        num_tokens, num_padded_tokens = self.collator.get_state()
+        if not num_padded_tokens:
+            return
+        padding_waste = 1 - num_tokens / num_padded_tokens
+        print(
+            f"epoch {state.epoch:.2f}: {num_padded_tokens - num_tokens} of "
+            f"{num_padded_tokens} train tokens are padding ({padding_waste:.2%})"
+        )
+        state.log_history.append(
+            {
+                "epoch": state.epoch,
+                "step": state.global_step,
+                "train_tokens": num_tokens,
+                "train_padded_tokens": num_padded_tokens,
+                "padding_waste": padding_waste,
+            }
+        )
+
+
+class ThroughputCallback(TrainerCallback):
+    '''
+    optimizer step마다 step 시간, dataloader 대기 시간, 초당 token 수, peak memory를
+    recorder에 train_step event로 남깁니다.
+    token 수와 batch가 준비된 시각은 PaddingStatsCollator에서 읽으므로
+    dataloader_num_workers가 0일 때만 dataloader 대기 시간이 잡힙니다.
+    evaluation batch를 빼고 세도록 PaddingWasteCallback 뒤에 등록해야 합니다.
+    '''
+
+    def __init__(self, collator, recorder):
+        self.collator = collator
+        self.recorder = recorder
+        self.last_step_end = 0.0
+        self.last_batch_end = 0.0
+        self.last_num_tokens = 0
+        self.last_num_padded_tokens = 0
+        self.dataloader_wait = 0.0
+
+    def reset_clock(self):
+        self.last_step_end = self.last_batch_end = time.perf_counter()
+        self.dataloader_wait = 0.0
+
+    def add_dataloader_wait(self):
+        # 이번 micro batch의 collate가 끝난 시각 - 이전 micro batch 학습이 끝난 시각
+        if self.collator.last_batch_time > self.last_batch_end:
+            self.dataloader_wait += self.collator.last_batch_time - self.last_batch_end
+        self.last_batch_end = time.perf_counter()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.reset_clock()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        # PaddingWasteCallback이 epoch마다 collator의 token 수를 0으로 돌립니다.
+        self.last_num_tokens, self.last_num_padded_tokens = 0, 0
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self.add_dataloader_wait()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.add_dataloader_wait()
+        now = time.perf_counter()
+        step_seconds = now - self.last_step_end
+        num_tokens, num_padded_tokens = self.collator.get_state()
+        step_tokens = num_tokens - self.last_num_tokens
+        step_padded_tokens = num_padded_tokens - self.last_num_padded_tokens
+        fields = {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "step_seconds": step_seconds,
+            "dataloader_wait_seconds": self.dataloader_wait,
+            "tokens": step_tokens,
+            "padded_tokens": step_padded_tokens,
+            "tokens_per_second": step_tokens / step_seconds,
+            "padded_tokens_per_second": step_padded_tokens / step_seconds,
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+        if torch.cuda.is_available():
+            fields["cuda_peak_memory_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+        self.recorder.emit("train_step", **fields)
+
+        self.last_num_tokens, self.last_num_padded_tokens = num_tokens, num_padded_tokens
+        self.last_step_end = now
+        self.dataloader_wait = 0.0
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        # evaluation 시간과 evaluation batch는 다음 train step에 넣지 않습니다.
+        self.last_num_tokens, self.last_num_padded_tokens = self.collator.get_state()
+        self.reset_clock()
+        self.recorder.emit(
+            "evaluate", step=state.global_step, **(kwargs.get("metrics") or {})
+        )
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+import shutil
+from os import path
+
+from datasets import load_from_disk
+
+from process import PREPROCESS_VERSION
+from Retrieval.passage_store import get_tokenizer_fingerprint
+from utils import send_along
+
+
+def get_feature_cache_key(args, dataset, preprocess_fn):
+    key = {
+        "preprocess": preprocess_fn.__name__,
+        "preprocess_version": PREPROCESS_VERSION,
+        "tokenizer": get_tokenizer_fingerprint(args.tokenizer),
+        "max_length": args.max_length,
+        "stride": args.stride,
+        # roberta 계열은 token_type_ids column을 빼고 저장합니다.
+        "model_type": args.config.model_type,
+        "dataset": dataset._fingerprint,
+    }
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def map_with_feature_cache(cache_dir, dataset, preprocess_fn, args, num_proc=None):
+    '''
+    dataset.map(preprocess_fn)의 결과를 cache_dir 아래에 Arrow로 저장해두고,
+    tokenizer / max_length / stride / preprocess 버전 / dataset fingerprint가 같으면
+    다시 tokenize 하지 않고 memory-map 으로 불러옵니다.
+    '''
+    cache_key = get_feature_cache_key(args, dataset, preprocess_fn)
+    cache_path = path.join(cache_dir, f"{preprocess_fn.__name__}-{cache_key}")
+    if path.isfile(path.join(cache_path, "dataset_info.json")):
+        print(f"loading cached features from {cache_path}")
+        return load_from_disk(cache_path)
+
+    features = dataset.map(
+        send_along(preprocess_fn, sent_along=args),
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        load_from_cache_file=False,
+    )
+    tmp_path = cache_path + f".tmp{os.getpid()}"
+    features.save_to_disk(tmp_path)
+    # 같은 cache를 여러 process가 동시에 만들면 먼저 rename 한 쪽을 씁니다.
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return load_from_disk(cache_path)
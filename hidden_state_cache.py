@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from os import path
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from callbacks import PaddingStatsCollator
+from logit_store import get_model_fingerprint
+
+
+# backbone과 head가 받는 column. offset_mapping 같은 postprocess용 column은 collator에서 뺍니다.
+BACKBONE_INPUT_COLUMNS = ("input_ids", "attention_mask", "token_type_ids")
+MODEL_INPUT_COLUMNS = BACKBONE_INPUT_COLUMNS + ("start_positions", "end_positions")
+
+
+class HiddenStateStore:
+    '''
+    feature 별 backbone last hidden state를 padding 없이 이어붙인 (num_tokens, hidden_size) memmap 입니다.
+    i 번째 feature는 hidden_states[offsets[i] : offsets[i + 1]] 입니다.
+    '''
+
+    def __init__(self, store_path):
+        with open(path.join(store_path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.hidden_states = np.load(
+            path.join(store_path, "hidden_states.npy"), mmap_mode="r"
+        )
+        self.offsets = np.load(path.join(store_path, "offsets.npy"))
+        self.hidden_size = self.hidden_states.shape[1]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.hidden_states[self.offsets[idx] : self.offsets[idx + 1]]
+
+
+def get_backbone_fingerprint(model_name_or_path):
+    # hub 이름이면 weight 파일이 없으므로 이름을 그대로 씁니다.
+    if path.isdir(model_name_or_path):
+        return get_model_fingerprint(model_name_or_path)
+    return model_name_or_path
+
+
+def get_hidden_state_cache_key(backbone_fingerprint, feature_cache_key, dtype):
+    '''
+    feature는 feature_cache.get_feature_cache_key로 구분합니다.
+    map 결과의 _fingerprint는 args를 hash 하지 못하면 실행마다 random으로 바뀌기 때문입니다.
+    '''
+    key = json.dumps(
+        {
+            "backbone": backbone_fingerprint,
+            "features": feature_cache_key,
+            "dtype": dtype,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def build_hidden_state_store(store_path, backbone, features, args, dtype="float16"):
+    '''
+    frozen backbone을 features 전체에 한번 돌려 last hidden state를 store_path에 저장합니다.
+    padding을 줄이려고 길이 순으로 batch를 만들고, 저장은 feature 순서대로 합니다.
+    backbone은 eval mode(dropout 없음)로 돌립니다. cache 없이 학습할 때는 backbone이 train mode라
+    dropout이 걸린 hidden state가 head에 들어가므로, 두 방식으로 학습한 head는 같지 않습니다.
+    '''
+    input_columns = [
+        column for column in BACKBONE_INPUT_COLUMNS if column in features.column_names
+    ]
+    lengths = np.asarray(
+        features["length"]
+        if "length" in features.column_names
+        else [len(input_ids) for input_ids in features["input_ids"]],
+        dtype=np.int64,
+    )
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    tmp_path = store_path + f".tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    hidden_states = np.lib.format.open_memmap(
+        path.join(tmp_path, "hidden_states.npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=(int(offsets[-1]), backbone.config.hidden_size),
+    )
+
+    device = args.device
+    backbone.to(device)
+    backbone.eval()
+    order = np.argsort(lengths, kind="stable")
+    batch_size = args.per_device_eval_batch_size
+    started = time.perf_counter()
+    with torch.no_grad(), torch.cuda.amp.autocast(
+        enabled=args.fp16 and device.type == "cuda"
+    ):
+        for batch_start in range(0, len(order), batch_size):
+            batch_idxs = order[batch_start : batch_start + batch_size].tolist()
+            batch = features[batch_idxs]
+            batch = args.tokenizer.pad(
+                {column: batch[column] for column in input_columns},
+                return_tensors="pt",
+            )
+            batch = {key: value.to(device) for key, value in batch.items()}
+            sequence_output = backbone(**batch)[0].float().cpu().numpy()
+            for row, idx in enumerate(batch_idxs):
+                hidden_states[offsets[idx] : offsets[idx + 1]] = sequence_output[
+                    row, : lengths[idx]
+                ]
+    hidden_states.flush()
+    print(
+        f"cached hidden states of {len(order)} features "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+    np.save(path.join(tmp_path, "offsets.npy"), offsets)
+    with open(path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "num_features": len(lengths),
+                "num_tokens": int(offsets[-1]),
+                "hidden_size": backbone.config.hidden_size,
+                "dtype": dtype,
+            },
+            f,
+            ensure_ascii=False,
+            indent=4,
+        )
+    # 같은 store를 여러 process가 동시에 만들면 먼저 rename 한 쪽을 씁니다.
+    try:
+        os.replace(tmp_path, store_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_or_build_hidden_state_store(
+    cache_dir,
+    backbone_fingerprint,
+    backbone,
+    features,
+    feature_cache_key,
+    args,
+    dtype="float16",
+):
+    cache_key = get_hidden_state_cache_key(
+        backbone_fingerprint, feature_cache_key, dtype
+    )
+    store_path = path.join(cache_dir, f"hidden_states-{cache_key}")
+    if path.isfile(path.join(store_path, "meta.json")):
+        print(f"loading cached hidden states from {store_path}")
+        store = HiddenStateStore(store_path)
+        if len(store) == len(features):
+            return store
+        # key가 같은데 feature 수가 다르면 믿을 수 없는 store이므로 다시 만듭니다.
+        print(f"{store_path} has {len(store)} features, rebuilding")
+        shutil.rmtree(store_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    build_hidden_state_store(store_path, backbone, features, args, dtype)
+    return HiddenStateStore(store_path)
+
+
+def attach_hidden_state_store(features, store_id):
+    '''
+    collator가 feature의 hidden state를 찾을 수 있도록 store 번호와 store 안의 index를 column으로 붙입니다.
+    '''
+    features = features.add_column("hidden_state_store", [store_id] * len(features))
+    return features.add_column("hidden_state_idx", list(range(len(features))))
+
+
+@dataclass
+class HiddenStateCollator(PaddingStatsCollator):
+    '''
+    PaddingStatsCollator와 같이 batch를 padding 하고, 저장된 hidden state를
+    같은 길이로 padding 해서 sequence_output으로 넘깁니다.
+    train / eval feature가 서로 다른 store를 쓰므로 store는 hidden_state_store 번호로 고릅니다.
+    feature의 다른 column이 필요하므로 remove_unused_columns=False로 학습해야 합니다.
+    '''
+
+    stores: Optional[List[HiddenStateStore]] = None
+
+    def __call__(self, features):
+        store_idxs = [
+            (feature["hidden_state_store"], feature["hidden_state_idx"])
+            for feature in features
+        ]
+        batch = super().__call__(
+            [
+                {
+                    key: value
+                    for key, value in feature.items()
+                    if key in MODEL_INPUT_COLUMNS
+                }
+                for feature in features
+            ]
+        )
+        batch_size, max_length = batch["input_ids"].shape
+        sequence_output = np.zeros(
+            (batch_size, max_length, self.stores[0].hidden_size), dtype=np.float32
+        )
+        for row, (store_id, idx) in enumerate(store_idxs):
+            hidden_states = self.stores[store_id][idx]
+            sequence_output[row, : len(hidden_states)] = hidden_states
+        batch["sequence_output"] = torch.from_numpy(sequence_output)
+        # memmap에서 읽는 시간도 dataloader 대기 시간에 넣습니다.
+        self.last_batch_time = time.perf_counter()
+        return batch
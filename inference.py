@@ -1,6 +1,14 @@
 import os
 
-from datasets import Features, load_from_disk, Value, DatasetDict, Dataset
+from datasets import (
+    Features,
+    load_from_disk,
+    Value,
+    DatasetDict,
+    Dataset,
+    Sequence,
+    concatenate_datasets,
+)
 from transformers import (
     AutoConfig,
     AutoTokenizer,
@@ -10,15 +18,22 @@ from transformers import (
     Trainer,
     set_seed,
 )
+from transformers.trainer_pt_utils import nested_concat
+from transformers.trainer_utils import PredictionOutput
 
 from arguments import SettingsArguments, Arguments
-from process import preprocess_testset
+from process import preprocess_testset, preprocess_testset_from_store
 
-from metric import postprocess
+from metric import get_prediction_candidates, postprocess
+from logit_store import get_model_fingerprint, save_logit_store
+from instrumentation import recorder
 from utils import send_along
 from Retrieval.retrieval import DenseRetrieval, HybridRetrieval
+from Retrieval.passage_store import PassageTokenStore
+import numpy as np
 import pandas as pd
 import pickle
+import torch
 
 
 def inference(settings, args):
@@ -34,10 +49,47 @@ def inference(settings, args):
 
     eval_dataset = args.dataset["validation"]
     hybrid_retrieval = HybridRetrieval(
-        args.tokenizer, "p_encoder/", "q_encoder/")
-    top_k_passage_ids, _ = hybrid_retrieval.get_topk_doc_id_and_score_for_querys(
-        eval_dataset.to_pandas()["question"].to_list(), args.top_k_retrieval
+        args.tokenizer,
+        "p_encoder/",
+        "q_encoder/",
+        num_threads=settings.retrieval_num_threads,
     )
+    with recorder.span("retrieval", num_questions=len(eval_dataset)):
+        (
+            top_k_passage_ids,
+            top_k_passage_scores,
+        ) = hybrid_retrieval.get_topk_doc_id_and_score_for_querys(
+            eval_dataset.to_pandas()["question"].to_list(), args.top_k_retrieval
+        )
+    with recorder.span("passage_store"):
+        args.passage_store = (
+            PassageTokenStore.load_or_build(
+                settings.passage_store_path,
+                args.tokenizer,
+                hybrid_retrieval.wiki_id_context_dict,
+            )
+            if settings.passage_store_path
+            else None
+        )
+
+    if args.per_passage_reader:
+        args.dataset = run_per_passage_retrieval(
+            args.dataset,
+            top_k_ids_dict=top_k_passage_ids,
+            top_k_scores_dict=top_k_passage_scores,
+            wiki_id_context_dict=hybrid_retrieval.wiki_id_context_dict,
+            top_k=args.top_k_retrieval,
+        )
+        trainer = Trainer(
+            model=model,
+            args=args,
+            tokenizer=args.tokenizer,
+            data_collator=data_collator,
+        )
+        outputs = predict_per_passage(settings, args, trainer)
+        save_logits_if_needed(settings, args, outputs)
+        postprocess(args, outputs)
+        return
 
     args.dataset = run_dense_retrival(
         args.dataset,
@@ -47,13 +99,14 @@ def inference(settings, args):
     )
     eval_dataset = args.dataset["validation"]
     column_names = eval_dataset.column_names
-    eval_dataset = eval_dataset.map(
-        send_along(preprocess_testset, sent_along=args),
-        batched=True,
-        num_proc=settings.num_proc,
-        remove_columns=column_names,
-        load_from_cache_file=settings.load_from_cache_file,
-    )
+    with recorder.span("tokenization", num_examples=len(eval_dataset)):
+        eval_dataset = eval_dataset.map(
+            send_along(get_testset_preprocess(args), sent_along=args),
+            batched=True,
+            num_proc=settings.num_proc,
+            remove_columns=column_names,
+            load_from_cache_file=settings.load_from_cache_file,
+        )
     args.processed_eval_dataset = eval_dataset
 
     trainer = Trainer(
@@ -62,24 +115,228 @@ def inference(settings, args):
         tokenizer=args.tokenizer,
         data_collator=data_collator,
     )
-    postprocess(args, trainer.predict(test_dataset=eval_dataset))
+    outputs = predict(args, trainer, eval_dataset)
+    save_logits_if_needed(settings, args, outputs)
+    postprocess(args, outputs)
+
+
+def save_logits_if_needed(settings, args, outputs):
+    if settings.logit_store_dir:
+        with recorder.span("save_logits"):
+            store_path = save_logit_store(
+                settings.logit_store_dir,
+                get_model_fingerprint(settings.trained_model_path),
+                args,
+                outputs,
+            )
+        print(f"raw logits are saved in {store_path}")
+
+
+def get_length_order(args, features):
+    num_features = len(features["input_ids"])
+    if not args.predict_by_length:
+        return np.arange(num_features)
+    return np.argsort(
+        np.fromiter(map(len, features["input_ids"]), np.int64, num_features),
+        kind="stable",
+    )
+
+
+def restore_order(predictions, order):
+    '''
+    order 순서로 계산한 logits를 원래 feature 순서로 되돌립니다.
+    '''
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return tuple(prediction[inverse] for prediction in predictions)
+
+
+def predict(args, trainer, features):
+    '''
+    predict_by_length이면 길이가 비슷한 feature끼리 batch가 되도록 정렬해서 predict 합니다.
+    batch마다 가장 긴 feature에 맞춰 붙는 padding이 줄어들고, logits는 원래 순서로 돌려줍니다.
+    '''
+    with recorder.span("predict", num_features=len(features)):
+        if not args.predict_by_length:
+            return trainer.predict(test_dataset=features)
+        order = get_length_order(args, features)
+        outputs = trainer.predict(test_dataset=features.select(order))
+    return PredictionOutput(
+        predictions=restore_order(outputs.predictions, order),
+        label_ids=None,
+        metrics=outputs.metrics,
+    )
+
+
+def predict_logits(args, model, features):
+    '''
+    Trainer 없이 tokenize 된 feature들의 start/end logits를 계산합니다.
+    Trainer.predict와 같이 batch 사이의 길이 차이는 -100으로 padding 됩니다.
+    '''
+    model_input_names = [
+        name for name in args.tokenizer.model_input_names if name in features
+    ]
+    batch_size = args.per_device_eval_batch_size
+    order = get_length_order(args, features).tolist()
+    predictions = None
+    with torch.no_grad():
+        for i in range(0, len(order), batch_size):
+            batch_idxs = order[i : i + batch_size]
+            batch = args.tokenizer.pad(
+                {
+                    name: [features[name][idx] for idx in batch_idxs]
+                    for name in model_input_names
+                },
+                pad_to_multiple_of=args.pad_to_multiple_of if args.fp16 else None,
+                return_tensors="pt",
+            )
+            batch = {name: tensor.to(model.device) for name, tensor in batch.items()}
+            outputs = model(**batch)
+            predictions = nested_concat(
+                predictions,
+                (
+                    outputs.start_logits.float().cpu().numpy(),
+                    outputs.end_logits.float().cpu().numpy(),
+                ),
+                padding_index=-100,
+            )
+    if predictions is not None:
+        predictions = restore_order(predictions, np.asarray(order))
+    return PredictionOutput(predictions=predictions, label_ids=None, metrics=None)
+
+
+def get_testset_preprocess(args):
+    if getattr(args, "passage_store", None) is not None:
+        return preprocess_testset_from_store
+    return preprocess_testset
+
+
+def predict_per_passage(settings, args, trainer):
+    '''
+    retrieved passage를 rank 순서대로 따로 windowing 하여 reader에 넣습니다.
+    passage_prune_threshold가 주어지면 이미 확신도가 높은 span을 찾은 question의
+    하위 rank passage는 reader에 넣지 않습니다.
+    '''
+    dataset = args.dataset["validation"]
+    ids = dataset["id"]
+    passage_ranks = dataset["passage_rank"]
+
+    confident_ids = set()
+    processed_datasets = []
+    predictions = None
+    for rank in range(args.top_k_retrieval):
+        row_idxs = [
+            i
+            for i, (id, passage_rank) in enumerate(zip(ids, passage_ranks))
+            if passage_rank == rank and id not in confident_ids
+        ]
+        if not row_idxs:
+            break
+
+        rank_dataset = dataset.select(row_idxs)
+        with recorder.span("tokenization", num_examples=len(row_idxs), rank=rank):
+            processed_dataset = rank_dataset.map(
+                send_along(get_testset_preprocess(args), sent_along=args),
+                batched=True,
+                num_proc=settings.num_proc,
+                remove_columns=rank_dataset.column_names,
+                load_from_cache_file=settings.load_from_cache_file,
+            )
+        # rank별 dataset의 sample index를 전체 per passage dataset의 row index로 되돌립니다.
+        processed_dataset = processed_dataset.map(
+            lambda examples: {
+                "overflow_to_sample_mapping": [
+                    row_idxs[sample_idx]
+                    for sample_idx in examples["overflow_to_sample_mapping"]
+                ]
+            },
+            batched=True,
+        )
+        rank_outputs = predict(args, trainer, processed_dataset)
+
+        args.processed_eval_dataset = processed_dataset
+        if args.passage_prune_threshold is not None:
+            for id, predictions_info in get_prediction_candidates(
+                args, rank_outputs
+            ).items():
+                if any(
+                    prediction_info["start_logit"] + prediction_info["end_logit"]
+                    >= args.passage_prune_threshold
+                    for prediction_info in predictions_info
+                ):
+                    confident_ids.add(id)
+
+        processed_datasets.append(processed_dataset)
+        predictions = nested_concat(
+            predictions, rank_outputs.predictions, padding_index=-100
+        )
+
+    args.processed_eval_dataset = concatenate_datasets(processed_datasets)
+    return PredictionOutput(predictions=predictions, label_ids=None, metrics=None)
+
+
+def run_per_passage_retrieval(
+    eval_datasets, top_k_ids_dict, top_k_scores_dict, wiki_id_context_dict, top_k
+):
+    '''
+    question 하나에 top_k개의 row를 만들어 retrieved passage마다 하나의 context를 갖도록 합니다.
+    '''
+    question_texts = eval_datasets["validation"]["question"]
+    ids = eval_datasets["validation"]["id"]
+    rows = {
+        "id": [],
+        "question": [],
+        "context": [],
+        "document_id": [],
+        "passage_rank": [],
+        "retrieval_score": [],
+    }
+    for id, question in zip(ids, question_texts):
+        for rank, (doc_id, score) in enumerate(
+            zip(top_k_ids_dict[question][:top_k], top_k_scores_dict[question][:top_k])
+        ):
+            rows["id"].append(id)
+            rows["question"].append(question)
+            rows["context"].append(wiki_id_context_dict[doc_id])
+            rows["document_id"].append(int(doc_id))
+            rows["passage_rank"].append(rank)
+            rows["retrieval_score"].append(float(score))
+
+    f = Features(
+        {
+            "id": Value(dtype="string", id=None),
+            "question": Value(dtype="string", id=None),
+            "context": Value(dtype="string", id=None),
+            "document_id": Value(dtype="int64", id=None),
+            "passage_rank": Value(dtype="int32", id=None),
+            "retrieval_score": Value(dtype="float32", id=None),
+        }
+    )
+    datasets = DatasetDict({"validation": Dataset.from_dict(rows, features=f)})
+
+    return datasets
 
 
-def run_dense_retrival(eval_datasets, top_k_ids_dict, wiki_id_context_dict):
+def run_dense_retrival(eval_datasets, top_k_ids_dict, wiki_id_context_dict, top_k):
     question_texts = eval_datasets["validation"]["question"]
     total = []
+    total_ids = []
     for i in range(len(eval_datasets["validation"]["id"])):
         texts = []
-        for j in range(len(top_k_ids_dict[question_texts[i]])):
+        doc_ids = []
+        for j in range(len(top_k_ids_dict[question_texts[i]][:top_k])):
             texts.append(
                 wiki_id_context_dict[top_k_ids_dict[question_texts[i]][j]])
+            doc_ids.append(int(top_k_ids_dict[question_texts[i]][j]))
         total.append(" ".join(texts))
+        total_ids.append(doc_ids)
 
     df = pd.DataFrame(
         data={
             "id": eval_datasets["validation"]["id"],
             "question": question_texts,
             "context": total,
+            "document_ids": total_ids,
         }
     )
 
@@ -88,6 +345,7 @@ def run_dense_retrival(eval_datasets, top_k_ids_dict, wiki_id_context_dict):
             "context": Value(dtype="string", id=None),
             "id": Value(dtype="string", id=None),
             "question": Value(dtype="string", id=None),
+            "document_ids": Sequence(Value(dtype="int64", id=None)),
         }
     )
     datasets = DatasetDict({"validation": Dataset.from_pandas(df, features=f)})
@@ -100,5 +358,6 @@ if __name__ == "__main__":
     parser = HfArgumentParser((SettingsArguments, Arguments))
     settings, args = parser.parse_args_into_dataclasses()
     set_seed(args.seed)
+    recorder.configure(settings.metrics_log_path, settings.prometheus_port)
 
     inference(settings, args)
@@ -0,0 +1,137 @@
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def get_peak_rss_mb():
+    # linux의 ru_maxrss는 KB 단위입니다.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MetricsRecorder:
+    '''
+    측정값을 JSON line으로 남기고, Prometheus text format으로 내보낼 최근 값과
+    span 별 누적 시간을 들고 있습니다.
+    log 파일도 endpoint도 설정하지 않으면 아무 것도 하지 않습니다.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.server = None
+        self.gauges = {}
+        self.span_totals = defaultdict(lambda: [0.0, 0])
+
+    @property
+    def enabled(self):
+        return self.log_file is not None or self.server is not None
+
+    def configure(self, log_path=None, prometheus_port=None, prometheus_host="0.0.0.0"):
+        if log_path:
+            self.log_file = open(log_path, "a", encoding="utf-8")
+        if prometheus_port is not None:
+            self.server = ThreadingHTTPServer(
+                (prometheus_host, prometheus_port), make_metrics_handler(self)
+            )
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(
+                f"prometheus metrics on http://{prometheus_host}:{prometheus_port}/metrics"
+            )
+
+    def write(self, record):
+        if self.log_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.log_file.write(line + "\n")
+            self.log_file.flush()
+
+    def emit(self, event, **fields):
+        '''
+        event 하나를 JSON line으로 남기고 숫자 field는 mrc_{event}_{field} gauge로 둡니다.
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            for key, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.gauges[f"mrc_{event}_{key}"] = value
+        self.write({"time": time.time(), "event": event, **fields})
+
+    @contextmanager
+    def span(self, name, **fields):
+        '''
+        with 안의 실행 시간을 재서 span event로 남깁니다.
+        '''
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                totals = self.span_totals[name]
+                totals[0] += seconds
+                totals[1] += 1
+            self.write(
+                {
+                    "time": time.time(),
+                    "event": "span",
+                    "name": name,
+                    "seconds": seconds,
+                    "peak_rss_mb": get_peak_rss_mb(),
+                    **fields,
+                }
+            )
+
+    def render_prometheus(self):
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+            span_totals = sorted(
+                (name, seconds, count)
+                for name, (seconds, count) in self.span_totals.items()
+            )
+        lines = [
+            "# TYPE mrc_process_peak_rss_bytes gauge",
+            f"mrc_process_peak_rss_bytes {get_peak_rss_mb() * 1024 * 1024:.0f}",
+        ]
+        for name, value in gauges:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        if span_totals:
+            lines.append("# TYPE mrc_span_seconds_total counter")
+            for name, seconds, _ in span_totals:
+                lines.append(f'mrc_span_seconds_total{{span="{name}"}} {seconds}')
+            lines.append("# TYPE mrc_span_count_total counter")
+            for name, _, count in span_totals:
+                lines.append(f'mrc_span_count_total{{span="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def make_metrics_handler(recorder):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = recorder.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+# train.py / inference.py에서 configure 하고, 각 모듈은 이 recorder에 span을 남깁니다.
+recorder = MetricsRecorder()
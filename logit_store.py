@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import shutil
+from os import path
+
+import numpy as np
+from datasets import load_from_disk
+from transformers.trainer_utils import PredictionOutput
+
+
+WEIGHTS_NAMES = ("pytorch_model.bin", "model.safetensors", "tf_model.h5")
+
+
+def get_model_fingerprint(model_path):
+    '''
+    config와 weight 파일 내용으로 모델을 구분하는 hash를 만듭니다.
+    '''
+    sha = hashlib.sha1()
+    for file_name in ("config.json",) + WEIGHTS_NAMES:
+        file_path = path.join(model_path, file_name)
+        if not path.isfile(file_path):
+            continue
+        sha.update(file_name.encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def get_dataset_fingerprint(dataset):
+    '''
+    retrieval까지 끝난 test set(질문과 붙인 passage)의 모든 column 내용으로 hash를 만듭니다.
+    '''
+    sha = hashlib.sha1()
+    for split in sorted(dataset):
+        for column in sorted(dataset[split].column_names):
+            sha.update(f"{split}\0{column}\0".encode("utf-8"))
+            for value in dataset[split][column]:
+                sha.update(str(value).encode("utf-8"))
+                sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+def get_logit_store_key(model_fingerprint, dataset_fingerprint, args):
+    '''
+    같은 모델이라도 test set, retrieval 결과, feature 설정이 다르면 다른 store가 되도록
+    model fingerprint 뒤에 그 설정의 hash를 붙입니다.
+    '''
+    config = {
+        "dataset_fingerprint": dataset_fingerprint,
+        "max_length": args.max_length,
+        "stride": args.stride,
+        "top_k_retrieval": args.top_k_retrieval,
+        "per_passage_reader": args.per_passage_reader,
+    }
+    config_hash = hashlib.sha1(
+        json.dumps(config, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{model_fingerprint}-{config_hash}"
+
+
+def save_logit_store(store_dir, model_fingerprint, args, outputs):
+    '''
+    reader의 raw start/end logits와 decoding에 필요한 feature 정보를
+    store_dir/<model fingerprint>-<test set / retrieval / feature 설정 hash> 아래에
+    memory-map 가능한 .npy로 저장합니다. key가 같으면 같은 입력이므로 덮어씁니다.
+    '''
+    dataset_fingerprint = get_dataset_fingerprint(args.dataset)
+    store_path = path.join(
+        store_dir, get_logit_store_key(model_fingerprint, dataset_fingerprint, args)
+    )
+    tmp_path = store_path + f".tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    start_logits, end_logits = outputs.predictions
+    offset_mappings = args.processed_eval_dataset["offset_mapping"]
+    num_features, max_length = start_logits.shape
+
+    np.save(path.join(tmp_path, "start_logits.npy"), start_logits.astype(np.float32))
+    np.save(path.join(tmp_path, "end_logits.npy"), end_logits.astype(np.float32))
+    np.save(
+        path.join(tmp_path, "overflow_to_sample_mapping.npy"),
+        np.asarray(
+            args.processed_eval_dataset["overflow_to_sample_mapping"], dtype=np.int64
+        ),
+    )
+
+    feature_lengths = np.lib.format.open_memmap(
+        path.join(tmp_path, "feature_lengths.npy"),
+        mode="w+",
+        dtype=np.int32,
+        shape=(num_features,),
+    )
+    offset_mapping_store = np.lib.format.open_memmap(
+        path.join(tmp_path, "offset_mapping.npy"),
+        mode="w+",
+        dtype=np.int32,
+        shape=(num_features, max_length, 2),
+    )
+    context_mask_store = np.lib.format.open_memmap(
+        path.join(tmp_path, "context_mask.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(num_features, max_length),
+    )
+    offset_mapping_store[:] = 0
+    context_mask_store[:] = 0
+    for i, (offset_mapping, context_mask) in enumerate(
+        zip(offset_mappings, args.processed_eval_dataset["context_mask"])
+    ):
+        feature_lengths[i] = len(offset_mapping)
+        offset_mapping_store[i, : len(offset_mapping)] = offset_mapping
+        context_mask_store[i, : len(context_mask)] = context_mask
+    feature_lengths.flush()
+    offset_mapping_store.flush()
+    context_mask_store.flush()
+
+    args.dataset.save_to_disk(path.join(tmp_path, "examples"))
+    with open(path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "model_fingerprint": model_fingerprint,
+                "dataset_fingerprint": dataset_fingerprint,
+                "num_features": num_features,
+                "max_length": args.max_length,
+                "stride": args.stride,
+                "top_k_retrieval": args.top_k_retrieval,
+                "per_passage_reader": args.per_passage_reader,
+            },
+            f,
+            ensure_ascii=False,
+            indent=4,
+        )
+
+    if path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def load_logit_store(store_path):
+    '''
+    저장된 store를 postprocess가 받는 형태(args에 담을 dataset/feature 정보와
+    PredictionOutput)로 불러옵니다. logits는 memory-map으로 읽습니다.
+    '''
+    with open(path.join(store_path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    feature_lengths = np.load(path.join(store_path, "feature_lengths.npy"))
+    offset_mapping = np.load(path.join(store_path, "offset_mapping.npy"), mmap_mode="r")
+    context_mask = np.load(path.join(store_path, "context_mask.npy"), mmap_mode="r")
+
+    return {
+        "meta": meta,
+        "dataset": load_from_disk(path.join(store_path, "examples")),
+        "processed_eval_dataset": {
+            "offset_mapping": [
+                offset_mapping[i, :length].tolist()
+                for i, length in enumerate(feature_lengths)
+            ],
+            "overflow_to_sample_mapping": np.load(
+                path.join(store_path, "overflow_to_sample_mapping.npy")
+            ).tolist(),
+            "context_mask": [
+                context_mask[i, :length].tolist()
+                for i, length in enumerate(feature_lengths)
+            ],
+        },
+        "outputs": PredictionOutput(
+            predictions=(
+                np.load(path.join(store_path, "start_logits.npy"), mmap_mode="r"),
+                np.load(path.join(store_path, "end_logits.npy"), mmap_mode="r"),
+            ),
+            label_ids=None,
+            metrics=None,
+        ),
+    }
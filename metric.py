@@ -1,12 +1,21 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+from multiprocessing import shared_memory
 from os import path
+import gc
+import heapq
 import json
+import multiprocessing
 
 from datasets import load_metric
 from transformers.trainer_utils import EvalPrediction
 
 import numpy as np
 
+from instrumentation import recorder
+
 
 def check_empty(prediction: list = None):
     if prediction:
@@ -23,64 +32,368 @@ def fill_empty_ids(predictions: dict, ids: list):
     return predictions
 
 
-def postprocess(args, outputs: EvalPrediction):
-    max_answer_length = args.max_answer_length
-    num_max_prediction = args.num_max_prediction
-    dataset = args.dataset["validation"]
+def to_padded_feature_arrays(context_masks, offset_mappings, max_length):
+    '''
+    feature마다 길이가 다른 context_mask / offset_mapping을 (num_features, max_length) 배열로 만듭니다.
+    '''
+    feature_lengths = np.array([len(offset_mapping) for offset_mapping in offset_mappings])
+    in_feature = np.arange(max_length)[None, :] < feature_lengths[:, None]
 
-    (
-        logits_of_start_idxs_predictions,
-        logits_of_end_idxs_predictions,
-    ) = outputs.predictions
-    prediction_cadidates_info = defaultdict(list)
-    for (
-        token_type_ids,
-        offset_mapping,
-        overflow_to_sample_mapping,
-        logits_of_start_idxs_prediction,
-        logits_of_end_idxs_prediction,
-    ) in zip(
-        args.token_type_ids,
-        args.processed_eval_dataset["offset_mapping"],
-        args.processed_eval_dataset["overflow_to_sample_mapping"],
-        logits_of_start_idxs_predictions,
-        logits_of_end_idxs_predictions,
+    context_mask = np.zeros((len(feature_lengths), max_length), dtype=bool)
+    context_mask[in_feature] = np.fromiter(
+        chain.from_iterable(context_masks),
+        dtype=np.uint8,
+        count=int(feature_lengths.sum()),
+    )
+    offsets = np.zeros((len(feature_lengths), max_length, 2), dtype=np.int64)
+    offsets[in_feature] = np.fromiter(
+        chain.from_iterable(chain.from_iterable(offset_mappings)),
+        dtype=np.int64,
+        count=2 * int(feature_lengths.sum()),
+    ).reshape(-1, 2)
+    return context_mask, offsets, feature_lengths
+
+
+def get_best_spans(
+    logits_of_start_idxs,
+    logits_of_end_idxs,
+    context_mask,
+    offsets,
+    feature_lengths,
+    max_answer_length,
+    num_max_prediction,
+):
+    '''
+    feature batch 전체에 대해 start/end logits 상위 num_max_prediction개씩의 조합 중
+    올바른 span을 골라, feature마다 점수가 높은 num_max_prediction개까지 돌려줍니다.
+    return: (feature_idxs, start_idxs, end_idxs) 배열, feature 순서 -> 점수 순서로 정렬
+    '''
+    num_features, max_length = logits_of_start_idxs.shape
+    k = min(num_max_prediction, max_length)
+    rows = np.arange(num_features)[:, None]
+
+    start_top_idxs = np.argpartition(-logits_of_start_idxs, k - 1, axis=1)[:, :k]
+    end_top_idxs = np.argpartition(-logits_of_end_idxs, k - 1, axis=1)[:, :k]
+
+    in_feature = np.arange(max_length)[None, :] < feature_lengths[:, None]
+    valid_starts = (in_feature & context_mask)[rows, start_top_idxs]
+    valid_ends = in_feature[rows, end_top_idxs]
+    span_lengths = end_top_idxs[:, None, :] - start_top_idxs[:, :, None]
+    valid_spans = (
+        valid_starts[:, :, None]
+        & valid_ends[:, None, :]
+        & (span_lengths >= 0)
+        & (span_lengths <= max_answer_length)
+        & (
+            offsets[rows, start_top_idxs, 0][:, :, None]
+            < offsets[rows, end_top_idxs, 1][:, None, :]
+        )
+    )
+    scores = np.where(
+        valid_spans,
+        logits_of_start_idxs[rows, start_top_idxs][:, :, None]
+        + logits_of_end_idxs[rows, end_top_idxs][:, None, :],
+        -np.inf,
+    ).reshape(num_features, k * k)
+
+    # 한 example의 최종 n-best에는 각 feature의 n-best만 들어갈 수 있으므로 feature 단위로 먼저 자릅니다.
+    n = min(num_max_prediction, k * k)
+    top_pair_idxs = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = scores[rows, top_pair_idxs]
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top_pair_idxs = top_pair_idxs[rows, order]
+    top_scores = top_scores[rows, order]
+
+    feature_idxs, ranks = np.nonzero(np.isfinite(top_scores))
+    pair_idxs = top_pair_idxs[feature_idxs, ranks]
+    start_idxs = start_top_idxs[feature_idxs, pair_idxs // k]
+    end_idxs = end_top_idxs[feature_idxs, pair_idxs % k]
+    return feature_idxs, start_idxs, end_idxs
+
+
+def decode_feature_batch(
+    logits_of_start_idxs,
+    logits_of_end_idxs,
+    context_mask,
+    offsets,
+    feature_lengths,
+    overflow_to_sample_mappings,
+    ids,
+    contexts,
+    retrieval_scores,
+    max_answer_length,
+    num_max_prediction,
+    retrieval_score_weight,
+):
+    '''
+    feature batch 하나의 n-best 후보를 (batch 안의 feature index, id, prediction_info)로 돌려줍니다.
+    ids, contexts, retrieval_scores는 sample index로 꺼낼 수 있으면 list / dict 모두 됩니다.
+    '''
+    feature_idxs, start_idxs, end_idxs = get_best_spans(
+        logits_of_start_idxs,
+        logits_of_end_idxs,
+        context_mask,
+        offsets,
+        feature_lengths,
+        max_answer_length,
+        num_max_prediction,
+    )
+
+    candidates = []
+    for feature_idx, start_char, end_char, start_logit, end_logit in zip(
+        feature_idxs.tolist(),
+        offsets[feature_idxs, start_idxs, 0].tolist(),
+        offsets[feature_idxs, end_idxs, 1].tolist(),
+        logits_of_start_idxs[feature_idxs, start_idxs].tolist(),
+        logits_of_end_idxs[feature_idxs, end_idxs].tolist(),
     ):
-        id = dataset["id"][overflow_to_sample_mapping]
-        context = dataset["context"][overflow_to_sample_mapping]
-
-        start_offset_idxs = np.argsort(logits_of_start_idxs_prediction)[
-            -1 : -num_max_prediction - 1 : -1
-        ]
-        end_offset_idxs = np.argsort(logits_of_end_idxs_prediction)[
-            -1 : -num_max_prediction - 1 : -1
-        ]
-        for start_offset_idx in start_offset_idxs:
-            for end_offset_idx in end_offset_idxs:
-                if (
-                    start_offset_idx < len(offset_mapping)
-                    and token_type_ids[start_offset_idx] == 1
-                    and start_offset_idx <= end_offset_idx < len(offset_mapping)
-                    and end_offset_idx - start_offset_idx <= max_answer_length
-                    and offset_mapping[start_offset_idx][0]
-                    < offset_mapping[end_offset_idx][1]
+        overflow_to_sample_mapping = overflow_to_sample_mappings[feature_idx]
+        prediction_info = {
+            "text": contexts[overflow_to_sample_mapping][start_char:end_char],
+            "start_logit": start_logit,
+            "end_logit": end_logit,
+            "score": start_logit + end_logit,
+        }
+        if retrieval_scores is not None:
+            retrieval_score = retrieval_scores[overflow_to_sample_mapping]
+            prediction_info["retrieval_score"] = retrieval_score
+            prediction_info["score"] += retrieval_score_weight * retrieval_score
+        candidates.append((feature_idx, ids[overflow_to_sample_mapping], prediction_info))
+    return candidates
+
+
+@contextmanager
+def gc_paused():
+    '''
+    후보 dict 수십만 개를 만드는 동안 순환 참조는 생기지 않으므로 cyclic GC를 잠시 멈춥니다.
+    멈추지 않으면 generation 0이 찰 때마다 GC가 돌아서 decoding 시간의 대부분을 차지합니다.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def to_shared_memory(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def from_shared_memory(spec):
+    name, shape, dtype = spec
+    # unlink는 만든 process(main)가 pool이 끝난 뒤 한번만 합니다.
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def decode_shard(
+    shared_specs,
+    feature_idxs,
+    overflow_to_sample_mappings,
+    ids,
+    contexts,
+    retrieval_scores,
+    max_answer_length,
+    num_max_prediction,
+    retrieval_score_weight,
+    batch_size,
+):
+    shms, arrays = {}, {}
+    for name, spec in shared_specs.items():
+        shms[name], arrays[name] = from_shared_memory(spec)
+    try:
+        with gc_paused():
+            candidates = []
+            for batch_start in range(0, len(feature_idxs), batch_size):
+                batch_feature_idxs = feature_idxs[
+                    batch_start : batch_start + batch_size
+                ]
+                global_feature_idxs = batch_feature_idxs.tolist()
+                for feature_idx, id, prediction_info in decode_feature_batch(
+                    arrays["start_logits"][batch_feature_idxs],
+                    arrays["end_logits"][batch_feature_idxs],
+                    arrays["context_mask"][batch_feature_idxs],
+                    arrays["offsets"][batch_feature_idxs],
+                    arrays["feature_lengths"][batch_feature_idxs],
+                    overflow_to_sample_mappings[batch_start : batch_start + batch_size],
+                    ids,
+                    contexts,
+                    retrieval_scores,
+                    max_answer_length,
+                    num_max_prediction,
+                    retrieval_score_weight,
                 ):
-                    prediction_cadidates_info[id].append(
-                        {
-                            "text": context[
-                                offset_mapping[start_offset_idx][0] : offset_mapping[
-                                    end_offset_idx
-                                ][1]
-                            ],
-                            "start_logit": logits_of_start_idxs_prediction[
-                                start_offset_idx
-                            ],
-                            "end_logit": logits_of_end_idxs_prediction[end_offset_idx],
-                            "score": logits_of_start_idxs_prediction[start_offset_idx]
-                            + logits_of_end_idxs_prediction[end_offset_idx],
-                        }
+                    candidates.append(
+                        (global_feature_idxs[feature_idx], id, prediction_info)
                     )
+            return candidates
+    finally:
+        del arrays
+        for shm in shms.values():
+            shm.close()
 
+
+def get_prediction_candidates_parallel(
+    args,
+    outputs,
+    ids,
+    contexts,
+    retrieval_scores,
+    offset_mappings,
+    overflow_to_sample_mappings,
+    context_masks,
+    num_workers,
+    batch_size,
+):
+    '''
+    같은 example id의 feature들이 같은 shard에 가도록 나누어 process pool에서 decoding 합니다.
+    logits와 padding 된 offset / context mask는 pickle 하지 않고 shared memory로 넘깁니다.
+    결과는 feature 순서대로 합쳐서 한 process에서 돌린 것과 같은 순서가 되도록 합니다.
+    '''
+    logits_of_start_idxs, logits_of_end_idxs = outputs.predictions
+    max_length = logits_of_start_idxs.shape[1]
+    context_mask, offsets, feature_lengths = to_padded_feature_arrays(
+        context_masks, offset_mappings, max_length
+    )
+    arrays = {
+        "start_logits": np.ascontiguousarray(logits_of_start_idxs, dtype=np.float32),
+        "end_logits": np.ascontiguousarray(logits_of_end_idxs, dtype=np.float32),
+        "context_mask": context_mask,
+        "offsets": offsets.astype(np.int32),
+        "feature_lengths": feature_lengths,
+    }
+    shms, shared_specs = {}, {}
+    for name, array in arrays.items():
+        shms[name], shared_specs[name] = to_shared_memory(array)
+    del arrays
+
+    id_to_shard = {
+        id: shard_idx % num_workers
+        for shard_idx, id in enumerate(dict.fromkeys(ids))
+    }
+    overflow_to_sample_mappings = np.asarray(overflow_to_sample_mappings)
+    feature_shards = np.array(
+        [id_to_shard[ids[sample]] for sample in overflow_to_sample_mappings.tolist()],
+        dtype=np.int64,
+    )
+    try:
+        # thread가 도는 Trainer / StreamingPipeline process를 fork 하면 child가 멈출 수 있어
+        # spawn 합니다.
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = []
+            for shard in range(num_workers):
+                feature_idxs = np.nonzero(feature_shards == shard)[0]
+                shard_samples = set(overflow_to_sample_mappings[feature_idxs].tolist())
+                futures.append(
+                    executor.submit(
+                        decode_shard,
+                        shared_specs,
+                        feature_idxs,
+                        overflow_to_sample_mappings[feature_idxs].tolist(),
+                        {sample: ids[sample] for sample in shard_samples},
+                        {sample: contexts[sample] for sample in shard_samples},
+                        {sample: retrieval_scores[sample] for sample in shard_samples}
+                        if retrieval_scores is not None
+                        else None,
+                        args.max_answer_length,
+                        args.num_max_prediction,
+                        getattr(args, "retrieval_score_weight", 0.0),
+                        batch_size,
+                    )
+                )
+            shard_candidates = [future.result() for future in futures]
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    prediction_cadidates_info = defaultdict(list)
+    for _, id, prediction_info in heapq.merge(
+        *shard_candidates, key=lambda candidate: candidate[0]
+    ):
+        prediction_cadidates_info[id].append(prediction_info)
+    return prediction_cadidates_info
+
+
+def get_prediction_candidates(args, outputs: EvalPrediction, batch_size=256):
+    dataset = args.dataset["validation"]
+    # feature마다 dataset[column]을 부르면 column 전체가 매번 python list로 만들어지므로
+    # loop 전에 한번만 꺼내둡니다.
+    ids = dataset["id"]
+    contexts = dataset["context"]
+    # per passage reader mode에서는 row마다 retrieval score가 함께 들어옵니다.
+    retrieval_scores = (
+        dataset["retrieval_score"]
+        if "retrieval_score" in dataset.column_names
+        else None
+    )
+    offset_mappings = args.processed_eval_dataset["offset_mapping"]
+    overflow_to_sample_mappings = args.processed_eval_dataset[
+        "overflow_to_sample_mapping"
+    ]
+    context_masks = args.processed_eval_dataset["context_mask"]
+
+    num_workers = getattr(args, "postprocess_num_workers", 1) or 1
+    # 후보 dict를 모으고 worker 결과를 unpickle 하는 동안 모두 GC를 멈춥니다.
+    with gc_paused():
+        if num_workers > 1 and len(offset_mappings) > batch_size:
+            return get_prediction_candidates_parallel(
+                args,
+                outputs,
+                ids,
+                contexts,
+                retrieval_scores,
+                offset_mappings,
+                overflow_to_sample_mappings,
+                context_masks,
+                num_workers,
+                batch_size,
+            )
+
+        (
+            logits_of_start_idxs_predictions,
+            logits_of_end_idxs_predictions,
+        ) = outputs.predictions
+        prediction_cadidates_info = defaultdict(list)
+        for batch_start in range(0, len(offset_mappings), batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            logits_of_start_idxs = np.asarray(
+                logits_of_start_idxs_predictions[batch], dtype=np.float32
+            )
+            context_mask, offsets, feature_lengths = to_padded_feature_arrays(
+                context_masks[batch],
+                offset_mappings[batch],
+                logits_of_start_idxs.shape[1],
+            )
+            for _, id, prediction_info in decode_feature_batch(
+                logits_of_start_idxs,
+                np.asarray(logits_of_end_idxs_predictions[batch], dtype=np.float32),
+                context_mask,
+                offsets,
+                feature_lengths,
+                overflow_to_sample_mappings[batch],
+                ids,
+                contexts,
+                retrieval_scores,
+                args.max_answer_length,
+                args.num_max_prediction,
+                getattr(args, "retrieval_score_weight", 0.0),
+            ):
+                prediction_cadidates_info[id].append(prediction_info)
+    return prediction_cadidates_info
+
+
+def get_predictions_info_per_id(args, outputs: EvalPrediction):
+    num_max_prediction = args.num_max_prediction
+    dataset = args.dataset["validation"]
+
+    prediction_cadidates_info = get_prediction_candidates(args, outputs)
     predictions_info_per_id = {
         id: sorted(
             check_empty(predictions_info), key=lambda x: x["score"], reverse=True
@@ -99,6 +412,13 @@ def postprocess(args, outputs: EvalPrediction):
         probabilities = scores / scores.sum()
         for probability, prediction_info in zip(probabilities, predictions_info):
             prediction_info["probability"] = probability
+    return predictions_info_per_id
+
+
+def postprocess(args, outputs: EvalPrediction):
+    num_max_prediction = args.num_max_prediction
+    with recorder.span("postprocess", num_features=len(outputs.predictions[0])):
+        predictions_info_per_id = get_predictions_info_per_id(args, outputs)
 
     with open(
         path.join(args.output_dir, "predictions.json"), "w", encoding="utf-8"
@@ -136,9 +456,10 @@ def postprocess(args, outputs: EvalPrediction):
 
 def compute_metrics(args, outputs: EvalPrediction):
     predictions = postprocess(args, outputs)
+    dataset = args.dataset["validation"]
     references = [
-        {"id": example["id"], "answers": example["answers"]}
-        for example in args.dataset["validation"]
+        {"id": id, "answers": answers}
+        for id, answers in zip(dataset["id"], dataset["answers"])
     ]
     metric = load_metric("squad")
     return metric.compute(predictions=predictions, references=references)
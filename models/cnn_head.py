@@ -20,6 +20,8 @@ from transformers.models.roberta.modeling_roberta import (
 )
 from transformers import AutoModel
 
+from models.lstm_roberta import run_packed_lstm
+
 
 @add_start_docstrings(
     """
@@ -109,12 +111,22 @@ class Conv1DRobertaForQuestionAnswering(RobertaPreTrainedModel):
         sequence_output = outputs[0].permute(0, 2, 1)
         # print(f"{sequence_output.shape=}")
 
+        # kernel이 문장 끝을 넘어 padding token의 hidden state를 읽지 않도록 0으로 가립니다.
+        conv_mask = None
+        if attention_mask is not None:
+            conv_mask = attention_mask.unsqueeze(1).to(sequence_output.dtype)
+            sequence_output = sequence_output * conv_mask
+
         cnn_k1_output = self.relu(self.conv1d_k1(sequence_output))
         cnn_k3_output = self.relu(self.conv1d_k3(sequence_output))
         cnn_k5_output = self.relu(self.conv1d_k5(sequence_output))
         concat_cnn_output = torch.cat((cnn_k1_output, cnn_k3_output, cnn_k5_output), 1)
+        if conv_mask is not None:
+            concat_cnn_output = concat_cnn_output * conv_mask.to(concat_cnn_output.dtype)
 
-        lstm_output, (h, c) = self.lstm(concat_cnn_output.permute(0, 2, 1))
+        lstm_output = run_packed_lstm(
+            self.lstm, concat_cnn_output.permute(0, 2, 1), attention_mask
+        )
 
         # logits = self.qa_outputs(concat_cnn_output.permute(0, 2, 1))
         logits = self.qa_outputs(lstm_output)
@@ -39,7 +39,7 @@ class FrozenHeadModel(RobertaPreTrainedModel):
         assert "roberta" in config.model_type.lower(), "Base model does not match with any Roberta variants"
 
         self.roberta = AutoModel.from_pretrained(
-            "/opt/ml/develop/outputs/65_830_2epoch_my_concat_k_5_hb_k_20",
+            pretrained_model_name_or_path,
             config=config,
             add_pooling_layer=False,
         )
@@ -70,6 +70,7 @@ class FrozenHeadModel(RobertaPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        sequence_output=None,
     ):
         r"""
         start_positions (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
@@ -80,22 +81,28 @@ class FrozenHeadModel(RobertaPreTrainedModel):
             Labels for position (index) of the end of the labelled span for computing the token classification loss.
             Positions are clamped to the length of the sequence (:obj:`sequence_length`). Position outside of the
             sequence are not taken into account for computing the loss.
+        sequence_output (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`):
+            Cached last hidden states of the frozen backbone (see :obj:`hidden_state_cache.py`). When given, the
+            backbone forward is skipped and only :obj:`qa_outputs` is run. The cached states are computed with the
+            backbone in eval mode, so unlike the uncached training path the head sees them without dropout.
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
-        outputs = self.roberta(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
-
-        sequence_output = outputs[0]
+        outputs = None
+        if sequence_output is None:
+            outputs = self.roberta(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
+
+            sequence_output = outputs[0]
         # print(f"{sequence_output.shape=}")
 
         logits = self.qa_outputs(sequence_output)
@@ -123,13 +130,13 @@ class FrozenHeadModel(RobertaPreTrainedModel):
             total_loss = (start_loss + end_loss) / 2
 
         if not return_dict:
-            output = (start_logits, end_logits) + outputs[2:]
+            output = (start_logits, end_logits) + (outputs[2:] if outputs is not None else ())
             return ((total_loss,) + output) if total_loss is not None else output
 
         return QuestionAnsweringModelOutput(
             loss=total_loss,
             start_logits=start_logits,
             end_logits=end_logits,
-            hidden_states=outputs.hidden_states,
-            attentions=outputs.attentions,
+            hidden_states=outputs.hidden_states if outputs is not None else None,
+            attentions=outputs.attentions if outputs is not None else None,
         )
@@ -2,6 +2,7 @@ import torch.nn as nn
 from torch.nn import CrossEntropyLoss
 from torch.nn.modules import dropout
 from torch.nn.modules.conv import Conv1d
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from transformers.file_utils import (
     add_code_sample_docstrings,
@@ -20,6 +21,26 @@ from transformers.models.roberta.modeling_roberta import (
 from transformers import AutoModel
 
 
+def run_packed_lstm(lstm, sequence_output, attention_mask=None):
+    '''
+    attention_mask로 구한 실제 길이만큼만 LSTM을 돌립니다.
+    padding token에는 연산을 쓰지 않고, backward 방향 state도 padding에서 시작하지 않습니다.
+    padding 위치의 output은 0 입니다. tokenizer가 오른쪽으로 padding 한다고 가정합니다.
+    '''
+    if attention_mask is None:
+        lstm_output, _ = lstm(sequence_output)
+        return lstm_output
+    lengths = attention_mask.sum(dim=1).cpu()
+    packed_sequence = pack_padded_sequence(
+        sequence_output, lengths, batch_first=True, enforce_sorted=False
+    )
+    packed_output, _ = lstm(packed_sequence)
+    lstm_output, _ = pad_packed_sequence(
+        packed_output, batch_first=True, total_length=sequence_output.size(1)
+    )
+    return lstm_output
+
+
 @add_start_docstrings(
     """
     Roberta Model with a LSTM span classification head on top for extractive question-answering tasks like SQuAD (a linear
@@ -101,7 +122,7 @@ class LSTMRobertaForQuestionAnswering(RobertaPreTrainedModel):
         sequence_output = outputs[0]
         # print(f"{sequence_output.shape=}")
 
-        lstm_output, (h, c) = self.lstm(sequence_output)
+        lstm_output = run_packed_lstm(self.lstm, sequence_output, attention_mask)
 
         logits = self.qa_outputs(lstm_output)
         # print(f"{logits.shape=}")
@@ -0,0 +1,345 @@
+import copy
+import json
+import os
+import queue
+import threading
+from os import path
+
+import numpy as np
+import torch
+from datasets import Dataset, DatasetDict, load_from_disk
+from tqdm import tqdm
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForQuestionAnswering,
+    HfArgumentParser,
+    set_seed,
+)
+
+from arguments import SettingsArguments, Arguments, PipelineArguments
+from inference import (
+    get_testset_preprocess,
+    predict_logits,
+    run_dense_retrival,
+    run_per_passage_retrieval,
+)
+from metric import get_predictions_info_per_id
+from Retrieval.retrieval import HybridRetrieval
+from Retrieval.passage_store import PassageTokenStore
+
+
+def retrieve_chunk(args, retrieval, chunk):
+    '''
+    chunk["ids"], chunk["questions"]에 대해 retrieval을 하고
+    reader에 들어갈 dataset을 chunk 전용 args에 담아둡니다.
+    chunk의 question은 batch API로 한번에 검색하므로 query encoding이 chunk 단위로 묶입니다.
+    '''
+    chunk_args = copy.copy(args)
+    top_k_ids, top_k_scores = retrieval.get_topk_doc_id_and_score_for_querys(
+        chunk["questions"], args.top_k_retrieval, show_progress=False
+    )
+
+    question_dataset = DatasetDict(
+        {
+            "validation": Dataset.from_dict(
+                {"id": chunk["ids"], "question": chunk["questions"]}
+            )
+        }
+    )
+    if args.per_passage_reader:
+        chunk_args.dataset = run_per_passage_retrieval(
+            question_dataset,
+            top_k_ids_dict=top_k_ids,
+            top_k_scores_dict=top_k_scores,
+            wiki_id_context_dict=retrieval.wiki_id_context_dict,
+            top_k=args.top_k_retrieval,
+        )
+    else:
+        chunk_args.dataset = run_dense_retrival(
+            question_dataset,
+            top_k_ids_dict=top_k_ids,
+            wiki_id_context_dict=retrieval.wiki_id_context_dict,
+            top_k=args.top_k_retrieval,
+        )
+    chunk["args"] = chunk_args
+    return chunk
+
+
+thread_local = threading.local()
+
+
+def get_thread_tokenizer(tokenizer):
+    '''
+    fast tokenizer는 thread끼리 공유하면 "Already borrowed" 에러가 나므로
+    tokenization worker thread마다 복사본을 씁니다.
+    '''
+    if getattr(thread_local, "source_tokenizer", None) is not tokenizer:
+        thread_local.source_tokenizer = tokenizer
+        thread_local.tokenizer = copy.deepcopy(tokenizer)
+    return thread_local.tokenizer
+
+
+def tokenize_chunk(chunk):
+    chunk_args = chunk["args"]
+    # 복사본은 이 thread에서만 쓰도록 tokenize 할 때만 넘기고 chunk의 args에는 남기지 않습니다.
+    tokenize_args = copy.copy(chunk_args)
+    tokenize_args.tokenizer = get_thread_tokenizer(chunk_args.tokenizer)
+    chunk_args.processed_eval_dataset = get_testset_preprocess(tokenize_args)(
+        tokenize_args, tokenize_args.dataset["validation"][:]
+    )
+    return chunk
+
+
+def forward_chunk(model, chunk):
+    chunk["outputs"] = predict_logits(
+        chunk["args"], model, chunk["args"].processed_eval_dataset
+    )
+    return chunk
+
+
+def decode_chunk(chunk):
+    predictions_info_per_id = get_predictions_info_per_id(
+        chunk["args"], chunk["outputs"]
+    )
+    # decode가 끝난 chunk는 logits와 feature를 더 이상 들고 있지 않습니다.
+    return {
+        "ids": chunk["ids"],
+        "predictions_info_per_id": {
+            id: [
+                {
+                    k: float(v) if isinstance(v, (np.floating, float)) else v
+                    for k, v in info.items()
+                }
+                for info in predictions_info_per_id[id]
+            ]
+            for id in chunk["ids"]
+        },
+    }
+
+
+class StageFailure:
+    def __init__(self, stage_name, exception):
+        self.stage_name = stage_name
+        self.exception = exception
+
+
+class StreamingPipeline:
+    '''
+    stage 함수들을 worker thread로 띄우고 크기가 제한된 queue로 이어서
+    chunk 단위로 흘려보냅니다. queue가 가득 차면 앞 stage가 기다리므로
+    동시에 메모리에 올라가는 chunk 수는 queue 크기로 제한됩니다.
+    worker가 여럿인 stage에서는 chunk 순서가 섞이지만, 결과는 입력 순서대로 돌려줍니다.
+    한 stage라도 실패하거나 결과를 끝까지 받지 않으면 나머지 thread를 멈추고 join 합니다.
+    '''
+
+    DONE = object()
+
+    def __init__(self, stages, queue_size):
+        # stages: [(name, fn, num_workers), ...]
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.threads = []
+        self.stopped = threading.Event()
+
+    def run_stage(self, name, fn, in_queue, out_queue, remaining_workers, lock):
+        while True:
+            item = in_queue.get()
+            if item is self.DONE or self.stopped.is_set():
+                # 같은 stage의 다른 worker도 끝날 수 있도록 다시 넣어둡니다.
+                in_queue.put(self.DONE)
+                break
+            # item: (입력 순서, chunk)
+            idx, chunk = item
+            if not isinstance(chunk, StageFailure):
+                # 실패한 chunk도 흘려보내야 앞 stage가 가득 찬 queue에서 멈추지 않습니다.
+                try:
+                    chunk = fn(chunk)
+                except Exception as e:
+                    chunk = StageFailure(name, e)
+            out_queue.put((idx, chunk))
+
+        with lock:
+            remaining_workers[0] -= 1
+            if remaining_workers[0] == 0:
+                out_queue.put(self.DONE)
+
+    def __call__(self, items):
+        for i, (name, fn, num_workers) in enumerate(self.stages):
+            remaining_workers = [num_workers]
+            lock = threading.Lock()
+            for _ in range(num_workers):
+                thread = threading.Thread(
+                    target=self.run_stage,
+                    args=(
+                        name,
+                        fn,
+                        self.queues[i],
+                        self.queues[i + 1],
+                        remaining_workers,
+                        lock,
+                    ),
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+        feeder = threading.Thread(target=self.feed, args=(items,), daemon=True)
+        feeder.start()
+        self.threads.append(feeder)
+
+        try:
+            # 먼저 끝난 chunk는 앞 순서의 chunk가 나올 때까지 들고 있습니다.
+            pending = {}
+            next_idx = 0
+            while True:
+                item = self.queues[-1].get()
+                if item is self.DONE:
+                    break
+                idx, chunk = item
+                if isinstance(chunk, StageFailure):
+                    raise RuntimeError(
+                        f"pipeline stage '{chunk.stage_name}' failed"
+                    ) from chunk.exception
+                pending[idx] = chunk
+                while next_idx in pending:
+                    yield pending.pop(next_idx)
+                    next_idx += 1
+        finally:
+            self.stop()
+
+    def feed(self, items):
+        for idx, item in enumerate(items):
+            if self.stopped.is_set():
+                break
+            self.queues[0].put((idx, item))
+        self.queues[0].put(self.DONE)
+
+    def stop(self):
+        '''
+        thread들이 가득 찬 queue의 put이나 빈 queue의 get에서 멈춰 있지 않도록
+        queue를 비우고 DONE을 넣어주면서 모든 thread가 끝날 때까지 join 합니다.
+        실행 중인 stage 함수는 끝까지 돌고 나서 멈춥니다.
+        '''
+        self.stopped.set()
+        while True:
+            # 비운 queue에 바로 DONE을 넣으면 put에서 기다리던 thread가 끼어들 틈이 없으므로
+            # 비우고 나서, 또 DONE을 넣고 나서 thread가 돌 시간을 줍니다.
+            for q in self.queues:
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+            if not self.join_threads(timeout=0.05):
+                return
+            for q in self.queues:
+                try:
+                    q.put_nowait(self.DONE)
+                except queue.Full:
+                    pass
+            if not self.join_threads(timeout=0.05):
+                return
+
+    def join_threads(self, timeout):
+        # 아직 살아있는 thread가 있으면 True를 돌려줍니다.
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+        return any(thread.is_alive() for thread in self.threads)
+
+
+class StreamingJsonWriter:
+    '''
+    json.dump(..., indent=4)와 같은 형식의 dict를 key 하나씩 파일에 이어서 씁니다.
+    '''
+
+    def __init__(self, file_path):
+        self.file = open(file_path, "w", encoding="utf-8")
+        self.file.write("{")
+        self.is_first = True
+
+    def write(self, key, value):
+        value = json.dumps(value, ensure_ascii=False, indent=4).replace("\n", "\n    ")
+        self.file.write(
+            ("\n" if self.is_first else ",\n")
+            + f"    {json.dumps(key, ensure_ascii=False)}: {value}"
+        )
+        self.is_first = False
+
+    def close(self):
+        self.file.write(("" if self.is_first else "\n") + "}")
+        self.file.close()
+
+
+def iter_question_chunks(dataset, chunk_size):
+    for i in range(0, len(dataset), chunk_size):
+        rows = dataset[i : i + chunk_size]
+        yield {"ids": rows["id"], "questions": rows["question"]}
+
+
+def stream_inference(settings, args, pipeline_args):
+    args.config = AutoConfig.from_pretrained(settings.trained_model_path)
+    args.tokenizer = AutoTokenizer.from_pretrained(settings.trained_model_path)
+    model = AutoModelForQuestionAnswering.from_pretrained(settings.trained_model_path)
+    if torch.cuda.is_available():
+        model.cuda()
+    model.eval()
+
+    retrieval = HybridRetrieval(
+        args.tokenizer,
+        "p_encoder/",
+        "q_encoder/",
+        num_threads=settings.retrieval_num_threads,
+    )
+    args.passage_store = (
+        PassageTokenStore.load_or_build(
+            settings.passage_store_path,
+            args.tokenizer,
+            retrieval.wiki_id_context_dict,
+        )
+        if settings.passage_store_path
+        else None
+    )
+    eval_dataset = load_from_disk(settings.testset_path)["validation"]
+
+    pipeline = StreamingPipeline(
+        [
+            (
+                "retrieval",
+                lambda chunk: retrieve_chunk(args, retrieval, chunk),
+                pipeline_args.retrieval_workers,
+            ),
+            ("tokenization", tokenize_chunk, pipeline_args.tokenization_workers),
+            ("reader", lambda chunk: forward_chunk(model, chunk), 1),
+            ("decoding", decode_chunk, pipeline_args.decoding_workers),
+        ],
+        queue_size=pipeline_args.queue_size,
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    best_writer = StreamingJsonWriter(path.join(args.output_dir, "predictions.json"))
+    nbest_writer = StreamingJsonWriter(
+        path.join(args.output_dir, f"top_{args.num_max_prediction}_predictions.json")
+    )
+    try:
+        with tqdm(total=len(eval_dataset), desc="Streaming inference") as progress:
+            for chunk in pipeline(
+                iter_question_chunks(eval_dataset, pipeline_args.chunk_size)
+            ):
+                for id in chunk["ids"]:
+                    predictions_info = chunk["predictions_info_per_id"][id]
+                    best_writer.write(id, predictions_info[0]["text"])
+                    nbest_writer.write(id, predictions_info)
+                progress.update(len(chunk["ids"]))
+    finally:
+        best_writer.close()
+        nbest_writer.close()
+
+
+if __name__ == "__main__":
+    os.environ["WANDB_DISABLED"] = "true"
+    parser = HfArgumentParser((SettingsArguments, Arguments, PipelineArguments))
+    settings, args, pipeline_args = parser.parse_args_into_dataclasses()
+    set_seed(args.seed)
+
+    stream_inference(settings, args, pipeline_args)
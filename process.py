@@ -1,83 +1,87 @@
 from bisect import bisect_left
 
+import numpy as np
 
-def preprocess(args, examples):
-    answers = examples["answers"]
-    # print(examples["question"][0])
-    # print(examples["context"][0])
-    examples = args.tokenizer(
-        examples["question"],
-        examples["context"],
-        truncation="only_second",
-        max_length=args.max_length,
-        stride=args.stride,
-        return_overflowing_tokens=True,
-        return_offsets_mapping=True,
-        # padding="max_length",  #
-    )
-    # print(examples["token_type_ids"][0])
-
-    examples["start_positions"] = []
-    examples["end_positions"] = []
-    for i, (
-        input_ids,
-        token_type_ids,
-        offset_mapping,
-        overflow_to_sample_mapping,
-    ) in enumerate(
-        zip(
-            examples["input_ids"],
-            examples["token_type_ids"],
-            examples["offset_mapping"],
-            examples["overflow_to_sample_mapping"],
-        )
+
+# 만들어지는 feature가 바뀌도록 preprocess를 고치면 올려서 feature cache를 무효화합니다.
+PREPROCESS_VERSION = 2
+
+
+def get_context_mask(sequence_ids):
+    '''
+    feature의 sequence id에서 context(두번째 sequence) token 자리만 1인 uint8 mask를 만듭니다.
+    pair encoding에서 context token은 한 구간에 이어져 있으므로 양 끝만 찾습니다.
+    '''
+    context_mask = np.zeros(len(sequence_ids), dtype=np.uint8)
+    if 1 in sequence_ids:
+        context_start_idx = sequence_ids.index(1)
+        context_end_idx = len(sequence_ids) - sequence_ids[::-1].index(1)
+        context_mask[context_start_idx:context_end_idx] = 1
+    return context_mask
+
+
+def get_answer_token_positions(args, examples, answers):
+    '''
+    tokenize 된 batch의 feature마다 정답 start / end token 위치를 구합니다.
+    offset_mapping의 (start, end) tuple 위에서 lo / hi만 바꿔 bisect 하므로
+    feature마다 zip(*offset_mapping)이나 slice를 만들지 않습니다.
+    정답이 feature의 context 밖에 있으면 cls token 위치를 정답으로 둡니다.
+    '''
+    cls_token_id = args.tokenizer.cls_token_id
+    start_positions, end_positions = [], []
+    for input_ids, offset_mapping, context_mask, overflow_to_sample_mapping in zip(
+        examples["input_ids"],
+        examples["offset_mapping"],
+        examples["context_mask"],
+        examples["overflow_to_sample_mapping"],
     ):
-        cls_token_idx = input_ids.index(args.tokenizer.cls_token_id)
+        cls_token_idx = input_ids.index(cls_token_id)
         answer_token_start_idx = answer_token_end_idx = cls_token_idx
-        # print(examples["token_type_ids"][i])
-        # print(len(examples.sequence_ids(i)))
-        # token_type_ids = examples.sequence_ids(i)
-        token_type_ids = examples.sequence_ids(i)
-        examples["token_type_ids"][i] = token_type_ids
-        # print(token_type_ids)
-        # print(token_type_ids.index(1))
-        # print(examples.sequence_ids(i).index(1))
 
         answer_info = answers[overflow_to_sample_mapping]
-        if answer_info:
+        if answer_info["answer_start"]:
             answer_start_idx = answer_info["answer_start"][0]
             answer_end_idx = answer_start_idx + len(answer_info["text"][0])
 
-            context_token_start_idx = token_type_ids.index(1)
+            context_token_start_idx = int(context_mask.argmax())
             # Additional step forward(last index - 1) to exclude the last special token
-            context_token_end_idx = len(token_type_ids) - 2
+            context_token_end_idx = len(offset_mapping) - 2
 
-            offset_start_idxs, offset_end_idxs = zip(*offset_mapping)
             if (
-                answer_start_idx >= offset_start_idxs[context_token_start_idx]
-                and answer_end_idx <= offset_end_idxs[context_token_end_idx]
+                answer_start_idx >= offset_mapping[context_token_start_idx][0]
+                and answer_end_idx <= offset_mapping[context_token_end_idx][1]
             ):
-                answer_token_start_idx = context_token_start_idx + bisect_left(
-                    offset_start_idxs[context_token_start_idx:context_token_end_idx],
-                    answer_start_idx,
+                # (answer_start_idx,)는 같은 start의 (start, end)보다 앞에 오므로
+                # start offset만 놓고 bisect_left 한 것과 같습니다.
+                answer_token_start_idx = bisect_left(
+                    offset_mapping,
+                    (answer_start_idx,),
+                    context_token_start_idx,
+                    context_token_end_idx,
                 )
-                answer_token_end_idx = context_token_start_idx + bisect_left(
-                    offset_end_idxs[context_token_start_idx:context_token_end_idx],
-                    answer_end_idx,
+                # context token은 겹치지 않고 순서대로 있으므로 end가 answer_end_idx 이상인
+                # 첫 token은 start가 answer_end_idx 이상인 첫 token이거나 그 바로 앞 token입니다.
+                answer_token_end_idx = bisect_left(
+                    offset_mapping,
+                    (answer_end_idx,),
+                    context_token_start_idx,
+                    context_token_end_idx,
                 )
+                if (
+                    answer_token_end_idx > context_token_start_idx
+                    and offset_mapping[answer_token_end_idx - 1][1] >= answer_end_idx
+                ):
+                    answer_token_end_idx -= 1
 
-        examples["start_positions"].append(answer_token_start_idx)
-        examples["end_positions"].append(answer_token_end_idx)
-    # print(examples["start_positions"])
-    # print(examples["end_positions"])
-    args.token_type_ids = examples["token_type_ids"]
-    # print(examples["token_type_ids"])
-    if "roberta" in args.config.model_type.lower():
-        examples.pop("token_type_ids")
-    return examples
+        start_positions.append(answer_token_start_idx)
+        end_positions.append(answer_token_end_idx)
+    return start_positions, end_positions
 
 
-def preprocess_testset(args, examples):
+def preprocess(args, examples):
+    answers = examples["answers"]
+    # print(examples["question"][0])
+    # print(examples["context"][0])
     examples = args.tokenizer(
         examples["question"],
         examples["context"],
@@ -86,16 +90,25 @@ def preprocess_testset(args, examples):
         stride=args.stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
+        # padding="max_length",  #
     )
 
-    args.token_type_ids = examples["token_type_ids"]
+    examples["context_mask"] = [
+        get_context_mask(examples.sequence_ids(i))
+        for i in range(len(examples["input_ids"]))
+    ]
+    (
+        examples["start_positions"],
+        examples["end_positions"],
+    ) = get_answer_token_positions(args, examples, answers)
+    # Trainer의 group_by_length가 feature를 다시 읽지 않고 길이를 쓰도록 column으로 남깁니다.
+    examples["length"] = [len(input_ids) for input_ids in examples["input_ids"]]
     if "roberta" in args.config.model_type.lower():
         examples.pop("token_type_ids")
     return examples
 
 
-def preprocess_temp(args, examples):
-    answers = examples["answers"]
+def preprocess_testset(args, examples):
     examples = args.tokenizer(
         examples["question"],
         examples["context"],
@@ -104,69 +117,144 @@ def preprocess_temp(args, examples):
         stride=args.stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
-        # padding="max_length",  #
     )
-    # print(examples)
-    sample_mapping = examples.pop("overflow_to_sample_mapping")
-    offset_mapping = examples.pop("offset_mapping")
-
-    examples["start_positions"] = []
-    examples["end_positions"] = []
-
-    for i, offsets in enumerate(offset_mapping):
-        input_ids = examples["input_ids"][i]
-        cls_index = input_ids.index(args.tokenizer.cls_token_id)  # cls index
-
-        # sequence id를 설정합니다 (to know what is the context and what is the question).
-        sequence_ids = examples.sequence_ids(i)
-
-        # 하나의 example이 여러개의 span을 가질 수 있습니다.
-        sample_index = sample_mapping[i]
-        # print(examples)
-        answers_info = answers[sample_index]
-
-        # answer가 없을 경우 cls_index를 answer로 설정합니다(== example에서 정답이 없는 경우 존재할 수 있음).
-        if len(answers_info["answer_start"]) == 0:
-            examples["start_positions"].append(cls_index)
-            examples["end_positions"].append(cls_index)
-        else:
-            # text에서 정답의 Start/end character index
-            start_char = answers_info["answer_start"][0]
-            end_char = start_char + len(answers_info["text"][0])
-
-            # text에서 current span의 Start token index
-            token_start_index = 0
-            while sequence_ids[token_start_index] != 1:
-                token_start_index += 1
-
-            # text에서 current span의 End token index
-            token_end_index = len(input_ids) - 1
-            while sequence_ids[token_end_index] != 1:
-                token_end_index -= 1
-
-            # 정답이 span을 벗어났는지 확인합니다(정답이 없는 경우 CLS index로 label되어있음).
-            if not (
-                offsets[token_start_index][0] <= start_char
-                and offsets[token_end_index][1] >= end_char
-            ):
-                examples["start_positions"].append(cls_index)
-                examples["end_positions"].append(cls_index)
-            else:
-                # token_start_index 및 token_end_index를 answer의 끝으로 이동합니다.
-                # Note: answer가 마지막 단어인 경우 last offset을 따라갈 수 있습니다(edge case).
-                while (
-                    token_start_index < len(offsets)
-                    and offsets[token_start_index][0] <= start_char
-                ):
-                    token_start_index += 1
-                examples["start_positions"].append(token_start_index - 1)
-                while offsets[token_end_index][1] >= end_char:
-                    token_end_index -= 1
-                examples["end_positions"].append(token_end_index + 1)
-        args.token_type_ids = examples["token_type_ids"]
-        print(examples["start_positions"])
-        print(examples["end_positions"])
-        if "roberta" in args.config.model_type.lower():
-            examples.pop("token_type_ids")
-
-        return examples
+
+    # context 위치는 args가 아니라 feature column으로 넘겨야 num_proc > 1에서도 섞이지 않습니다.
+    examples["context_mask"] = [
+        get_context_mask(examples.sequence_ids(i))
+        for i in range(len(examples["input_ids"]))
+    ]
+    if "roberta" in args.config.model_type.lower():
+        examples.pop("token_type_ids")
+    return examples
+
+
+def get_pair_template(tokenizer):
+    '''
+    tokenizer가 (question, context) pair에 special token을 붙이는 방식을
+    prefix / middle / suffix 조각과 각 조각의 token_type_id로 나누어 돌려줍니다.
+    '''
+    question_placeholder, context_placeholder = -1, -2
+    input_ids = tokenizer.build_inputs_with_special_tokens(
+        [question_placeholder], [context_placeholder]
+    )
+    token_type_ids = tokenizer.create_token_type_ids_from_sequences(
+        [question_placeholder], [context_placeholder]
+    )
+    question_idx = input_ids.index(question_placeholder)
+    context_idx = input_ids.index(context_placeholder)
+    return {
+        "prefix": np.asarray(input_ids[:question_idx], dtype=np.int64),
+        "middle": np.asarray(input_ids[question_idx + 1 : context_idx], dtype=np.int64),
+        "suffix": np.asarray(input_ids[context_idx + 1 :], dtype=np.int64),
+        "prefix_type": token_type_ids[:question_idx],
+        "question_type": token_type_ids[question_idx],
+        "middle_type": token_type_ids[question_idx + 1 : context_idx],
+        "context_type": token_type_ids[context_idx],
+        "suffix_type": token_type_ids[context_idx + 1 :],
+    }
+
+
+def preprocess_testset_from_store(args, examples):
+    '''
+    preprocess_testset과 같은 feature를 만들되, context는 다시 tokenize 하지 않고
+    args.passage_store에 저장된 문서별 token을 이어 붙여 만듭니다.
+    examples에는 "document_ids"(concat mode) 또는 "document_id"(per passage mode)가 있어야 하며
+    context는 문서들을 " "로 이어 붙인 문자열이라고 가정합니다.
+    '''
+    passage_store = args.passage_store
+    template = get_pair_template(args.tokenizer)
+    num_special_tokens = (
+        len(template["prefix"]) + len(template["middle"]) + len(template["suffix"])
+    )
+    if "document_ids" in examples:
+        document_ids_list = examples["document_ids"]
+    else:
+        document_ids_list = [[doc_id] for doc_id in examples["document_id"]]
+
+    tokenized_questions = args.tokenizer(
+        examples["question"], add_special_tokens=False, return_offsets_mapping=True
+    )
+
+    features = {
+        "input_ids": [],
+        "token_type_ids": [],
+        "attention_mask": [],
+        "offset_mapping": [],
+        "overflow_to_sample_mapping": [],
+        "context_mask": [],
+    }
+    for sample_idx, (question_ids, question_offsets, document_ids) in enumerate(
+        zip(
+            tokenized_questions["input_ids"],
+            tokenized_questions["offset_mapping"],
+            document_ids_list,
+        )
+    ):
+        # 문서 사이에 들어간 공백 한 글자만큼 offset을 밀어줍니다.
+        context_ids = []
+        context_offsets = []
+        char_start = 0
+        for doc_id in document_ids:
+            context_ids.append(passage_store.get_input_ids(doc_id))
+            context_offsets.append(passage_store.get_offset_mapping(doc_id) + char_start)
+            char_start += passage_store.get_char_length(doc_id) + 1
+        context_ids = (
+            np.concatenate(context_ids) if context_ids else np.zeros(0, dtype=np.int64)
+        )
+        context_offsets = (
+            np.concatenate(context_offsets)
+            if context_offsets
+            else np.zeros((0, 2), dtype=np.int64)
+        )
+
+        question_ids = np.asarray(question_ids, dtype=np.int64)
+        question_offsets = np.asarray(question_offsets, dtype=np.int64).reshape(-1, 2)
+        max_context_length = args.max_length - len(question_ids) - num_special_tokens
+        assert max_context_length > args.stride, "question is too long for max_length"
+
+        head_ids = np.concatenate([template["prefix"], question_ids, template["middle"]])
+        head_offsets = np.concatenate(
+            [
+                np.zeros((len(template["prefix"]), 2), dtype=np.int64),
+                question_offsets,
+                np.zeros((len(template["middle"]), 2), dtype=np.int64),
+            ]
+        )
+        head_types = (
+            template["prefix_type"]
+            + [template["question_type"]] * len(question_ids)
+            + template["middle_type"]
+        )
+        tail_offsets = np.zeros((len(template["suffix"]), 2), dtype=np.int64)
+
+        # tokenizer의 return_overflowing_tokens + stride와 같은 방식으로 window를 나눕니다.
+        window_start = 0
+        while True:
+            window_end = min(window_start + max_context_length, len(context_ids))
+            window_length = window_end - window_start
+            input_ids = np.concatenate(
+                [head_ids, context_ids[window_start:window_end], template["suffix"]]
+            )
+            offset_mapping = np.concatenate(
+                [head_offsets, context_offsets[window_start:window_end], tail_offsets]
+            )
+            features["input_ids"].append(input_ids.tolist())
+            features["token_type_ids"].append(
+                head_types
+                + [template["context_type"]] * window_length
+                + template["suffix_type"]
+            )
+            features["attention_mask"].append([1] * len(input_ids))
+            context_mask = np.zeros(len(input_ids), dtype=np.uint8)
+            context_mask[len(head_ids) : len(head_ids) + window_length] = 1
+            features["context_mask"].append(context_mask)
+            features["offset_mapping"].append(offset_mapping.tolist())
+            features["overflow_to_sample_mapping"].append(sample_idx)
+            if window_end >= len(context_ids):
+                break
+            window_start = window_end - args.stride
+
+    if "roberta" in args.config.model_type.lower():
+        features.pop("token_type_ids")
+    return features
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from transformers import HfArgumentParser
+from transformers.trainer_utils import PredictionOutput
+
+from arguments import RedecodeArguments
+from logit_store import load_logit_store
+from metric import postprocess
+
+
+def ensemble_logits(stores, weights=None):
+    '''
+    같은 feature(같은 tokenizer, max_length, stride, retrieval 결과)로 만든
+    여러 store의 logits를 가중 평균합니다.
+    '''
+    base = stores[0]
+    for store in stores[1:]:
+        assert (
+            store["processed_eval_dataset"] == base["processed_eval_dataset"]
+        ), "logit stores were made from different features"
+    if weights is None:
+        weights = [1.0] * len(stores)
+    weights = np.asarray(weights, dtype=np.float32) / np.sum(weights)
+
+    max_length = max(store["outputs"].predictions[0].shape[1] for store in stores)
+    num_features = len(base["processed_eval_dataset"]["overflow_to_sample_mapping"])
+    start_logits = np.zeros((num_features, max_length), np.float32)
+    end_logits = np.zeros_like(start_logits)
+    for weight, store in zip(weights, stores):
+        store_start_logits, store_end_logits = store["outputs"].predictions
+        start_logits[:, : store_start_logits.shape[1]] += weight * store_start_logits
+        end_logits[:, : store_end_logits.shape[1]] += weight * store_end_logits
+    return PredictionOutput(
+        predictions=(start_logits, end_logits), label_ids=None, metrics=None
+    )
+
+
+def redecode(args):
+    stores = [load_logit_store(store_path) for store_path in args.logit_stores]
+    base = stores[0]
+    args.dataset = base["dataset"]
+    args.processed_eval_dataset = base["processed_eval_dataset"]
+
+    if len(stores) == 1:
+        outputs = base["outputs"]
+    else:
+        outputs = ensemble_logits(stores, args.ensemble_weights)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    postprocess(args, outputs)
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(RedecodeArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    redecode(args)
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForQuestionAnswering,
+    HfArgumentParser,
+    set_seed,
+)
+
+from arguments import SettingsArguments, Arguments, ServeArguments
+from pipeline import retrieve_chunk, tokenize_chunk, forward_chunk, decode_chunk
+from Retrieval.retrieval import HybridRetrieval
+from Retrieval.passage_store import PassageTokenStore
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class LatencyTracker:
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_rejected = 0
+
+    def add_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.batch_sizes.append(len(latencies))
+        self.num_requests += len(latencies)
+
+    def summary(self):
+        summary = {
+            "num_requests": self.num_requests,
+            "num_rejected": self.num_rejected,
+            "num_batches": len(self.batch_sizes),
+        }
+        if self.latencies:
+            latencies_ms = np.array(self.latencies) * 1000
+            summary.update(
+                {
+                    "p50_ms": float(np.percentile(latencies_ms, 50)),
+                    "p95_ms": float(np.percentile(latencies_ms, 95)),
+                    "p99_ms": float(np.percentile(latencies_ms, 99)),
+                    "mean_batch_size": float(np.mean(self.batch_sizes)),
+                }
+            )
+        return summary
+
+
+class QAService:
+    '''
+    retriever와 reader를 메모리에 올려둔 채로, 동시에 들어온 질문들을
+    max_wait_ms 동안 모아 하나의 micro-batch로 처리합니다.
+    '''
+
+    def __init__(self, settings, args, serve_args):
+        self.args = args
+        self.serve_args = serve_args
+
+        args.config = AutoConfig.from_pretrained(settings.trained_model_path)
+        args.tokenizer = AutoTokenizer.from_pretrained(settings.trained_model_path)
+        self.model = AutoModelForQuestionAnswering.from_pretrained(
+            settings.trained_model_path
+        )
+        if torch.cuda.is_available():
+            self.model.cuda()
+        self.model.eval()
+
+        self.retrieval = HybridRetrieval(
+            args.tokenizer,
+            "p_encoder/",
+            "q_encoder/",
+            num_threads=settings.retrieval_num_threads,
+        )
+        args.passage_store = (
+            PassageTokenStore.load_or_build(
+                settings.passage_store_path,
+                args.tokenizer,
+                self.retrieval.wiki_id_context_dict,
+            )
+            if settings.passage_store_path
+            else None
+        )
+
+        self.tracker = LatencyTracker(serve_args.latency_window)
+        # 모델은 한번에 한 batch만 처리하도록 worker thread를 하나만 둡니다.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.request_arrived = None
+        self.batch_task = None
+        self.next_id = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.serve_args.max_queue_size)
+        self.request_arrived = asyncio.Event()
+        self.batch_task = asyncio.get_running_loop().create_task(self.batch_loop())
+        self.batch_task.add_done_callback(self.on_batch_loop_done)
+
+    def get_batch_loop_error(self):
+        '''
+        batch_loop가 끝났으면 그 이유를, 돌고 있으면 None을 반환합니다.
+        '''
+        if not self.batch_task.done():
+            return None
+        if self.batch_task.cancelled():
+            return "batch loop was cancelled"
+        return f"batch loop stopped: {self.batch_task.exception()!r}"
+
+    def on_batch_loop_done(self, task):
+        # batch_loop가 죽으면 queue에 남은 요청은 영원히 처리되지 않으므로 바로 실패시킵니다.
+        error = RuntimeError(self.get_batch_loop_error())
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+
+    async def answer(self, question):
+        error = self.get_batch_loop_error()
+        if error is not None:
+            raise RuntimeError(error)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((question, time.perf_counter(), future))
+        except asyncio.QueueFull:
+            self.tracker.num_rejected += 1
+            raise QueueFullError()
+        self.request_arrived.set()
+        return await future
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.collect_requests(loop)
+            try:
+                await self.run_batch(loop, requests)
+            except BaseException as e:
+                # 처리 중이던 요청도 끝나지 않게 되므로 실패시키고 loop를 멈춥니다.
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(RuntimeError(f"batch loop stopped: {e!r}"))
+                raise
+
+    async def collect_requests(self, loop):
+        requests = [await self.queue.get()]
+        deadline = loop.time() + self.serve_args.max_wait_ms / 1000
+        while len(requests) < self.serve_args.max_batch_size:
+            try:
+                requests.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            # queue.get()을 wait_for로 기다리면 timeout과 get이 겹칠 때 꺼낸 요청을 잃을 수 있어
+            # 요청이 들어왔다는 event만 기다리고 꺼내는 것은 get_nowait로 합니다.
+            self.request_arrived.clear()
+            try:
+                await asyncio.wait_for(self.request_arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    async def run_batch(self, loop, requests):
+        questions = [question for question, _, _ in requests]
+        try:
+            answers = await loop.run_in_executor(
+                self.executor, self.answer_batch, questions
+            )
+        except Exception as e:
+            for _, _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finished = time.perf_counter()
+        self.tracker.add_batch([finished - started for _, started, _ in requests])
+        for (_, _, future), answer in zip(requests, answers):
+            if not future.done():
+                future.set_result(answer)
+
+    def answer_batch(self, questions):
+        ids = [str(self.next_id + i) for i in range(len(questions))]
+        self.next_id += len(questions)
+
+        chunk = retrieve_chunk(
+            self.args, self.retrieval, {"ids": ids, "questions": questions}
+        )
+        chunk = decode_chunk(forward_chunk(self.model, tokenize_chunk(chunk)))
+        return [
+            {
+                "answer": chunk["predictions_info_per_id"][id][0]["text"],
+                "nbest": chunk["predictions_info_per_id"][id],
+            }
+            for id in ids
+        ]
+
+
+async def handle_connection(service, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            status, response = await route(service, method, path, body)
+            payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                (
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n"
+                ).encode("latin-1")
+                + payload
+            )
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def route(service, method, path, body):
+    if method == "GET" and path == "/health":
+        error = service.get_batch_loop_error()
+        if error is not None:
+            return "503 Service Unavailable", {"status": "error", "error": error}
+        return "200 OK", {"status": "ok"}
+    if method == "GET" and path == "/stats":
+        stats = service.tracker.summary()
+        stats["queue_size"] = service.queue.qsize()
+        return "200 OK", stats
+    if method == "POST" and path == "/predict":
+        try:
+            question = json.loads(body)["question"]
+        except (ValueError, KeyError, TypeError):
+            return "400 Bad Request", {"error": 'body must be {"question": str}'}
+        try:
+            return "200 OK", await service.answer(question)
+        except QueueFullError:
+            return "503 Service Unavailable", {"error": "queue is full"}
+        except Exception as e:
+            return "500 Internal Server Error", {"error": str(e)}
+    return "404 Not Found", {"error": f"unknown route {method} {path}"}
+
+
+async def serve(settings, args, serve_args):
+    service = QAService(settings, args, serve_args)
+    await service.start()
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(service, reader, writer),
+        serve_args.host,
+        serve_args.port,
+    )
+    print(f"Serving on http://{serve_args.host}:{serve_args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    os.environ["WANDB_DISABLED"] = "true"
+    parser = HfArgumentParser((SettingsArguments, Arguments, ServeArguments))
+    settings, args, serve_args = parser.parse_args_into_dataclasses()
+    set_seed(args.seed)
+
+    asyncio.run(serve(settings, args, serve_args))
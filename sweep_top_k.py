@@ -0,0 +1,278 @@
+import copy
+import json
+import os
+import time
+from os import path
+
+import numpy as np
+from datasets import DatasetDict, load_from_disk, load_metric
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForQuestionAnswering,
+    DataCollatorWithPadding,
+    HfArgumentParser,
+    Trainer,
+    set_seed,
+)
+from transformers.trainer_utils import PredictionOutput
+
+from arguments import SettingsArguments, Arguments, SweepArguments
+from inference import (
+    predict_per_passage,
+    run_per_passage_retrieval,
+    save_logits_if_needed,
+)
+from instrumentation import recorder
+from logit_store import load_logit_store
+from metric import get_predictions_info_per_id
+from Retrieval.retrieval import HybridRetrieval, SparseRetrieval
+from Retrieval.passage_store import PassageTokenStore
+
+DECODE_COLUMNS = ("offset_mapping", "overflow_to_sample_mapping", "context_mask")
+
+
+def run_reader_once(settings, args, max_top_k):
+    '''
+    validation question마다 max_top_k개 passage를 한번만 retrieve 하고
+    per passage reader로 모든 passage의 feature와 logits를 구합니다.
+    '''
+    args.config = AutoConfig.from_pretrained(settings.trained_model_path)
+    args.tokenizer = AutoTokenizer.from_pretrained(settings.trained_model_path)
+    model = AutoModelForQuestionAnswering.from_pretrained(settings.trained_model_path)
+    data_collator = DataCollatorWithPadding(
+        tokenizer=args.tokenizer,
+        pad_to_multiple_of=args.pad_to_multiple_of if args.fp16 else None,
+    )
+    # passage마다 따로 windowing 해야 작은 k의 feature가 큰 k의 feature에 그대로 포함됩니다.
+    args.per_passage_reader = True
+    args.top_k_retrieval = max_top_k
+    # 모든 passage의 logits가 있어야 k 마다 passage를 골라낼 수 있으므로 pruning 하지 않습니다.
+    args.passage_prune_threshold = None
+
+    hybrid_retrieval = HybridRetrieval(
+        args.tokenizer,
+        "p_encoder/",
+        "q_encoder/",
+        num_threads=settings.retrieval_num_threads,
+    )
+    questions = args.dataset["validation"]["question"]
+    with recorder.span("retrieval", num_questions=len(questions)):
+        (
+            top_k_passage_ids,
+            top_k_passage_scores,
+        ) = hybrid_retrieval.get_topk_doc_id_and_score_for_querys(questions, max_top_k)
+    with recorder.span("passage_store"):
+        args.passage_store = (
+            PassageTokenStore.load_or_build(
+                settings.passage_store_path,
+                args.tokenizer,
+                hybrid_retrieval.wiki_id_context_dict,
+            )
+            if settings.passage_store_path
+            else None
+        )
+
+    args.dataset = run_per_passage_retrieval(
+        args.dataset,
+        top_k_ids_dict=top_k_passage_ids,
+        top_k_scores_dict=top_k_passage_scores,
+        wiki_id_context_dict=hybrid_retrieval.wiki_id_context_dict,
+        top_k=max_top_k,
+    )
+    trainer = Trainer(
+        model=model,
+        args=args,
+        tokenizer=args.tokenizer,
+        data_collator=data_collator,
+    )
+    started = time.perf_counter()
+    outputs = predict_per_passage(settings, args, trainer)
+    reader_seconds = time.perf_counter() - started
+    save_logits_if_needed(settings, args, outputs)
+    return outputs, reader_seconds, hybrid_retrieval.sparse_retrieval
+
+
+def load_reader_outputs(args, store_path, max_top_k):
+    '''
+    inference.py가 per passage reader mode로 저장한 logit store의 feature와 logits를 다시 씁니다.
+    '''
+    store = load_logit_store(store_path)
+    meta = store["meta"]
+    if not meta["per_passage_reader"] or meta["top_k_retrieval"] < max_top_k:
+        raise ValueError(
+            f"{store_path} was saved with "
+            f"per_passage_reader={meta['per_passage_reader']} and "
+            f"top_k_retrieval={meta['top_k_retrieval']}, but the sweep needs a "
+            f"per passage store with top_k_retrieval >= {max_top_k}"
+        )
+    args.dataset = store["dataset"]
+    args.processed_eval_dataset = store["processed_eval_dataset"]
+    return store["outputs"]
+
+
+def get_candidate_ranks(sparse_retrieval, passage_dataset, max_top_k):
+    '''
+    HybridRetrieval은 sparse top k 후보를 dense 점수로 다시 정렬하므로 top_k_retrieval=k의
+    passage는 hybrid rank가 아니라 sparse rank가 k보다 작은 passage 입니다.
+    passage_dataset의 row마다 sparse rank를 구합니다. hybrid 점수는 k와 상관없이 같습니다.
+    '''
+    questions = list(dict.fromkeys(passage_dataset["question"]))
+    sparse_ids, _ = sparse_retrieval.get_topk_doc_id_and_score_for_querys(
+        questions, max_top_k
+    )
+    sparse_ranks = {
+        question: {int(doc_id): rank for rank, doc_id in enumerate(doc_ids)}
+        for question, doc_ids in sparse_ids.items()
+    }
+    candidate_ranks = []
+    for question, doc_id in zip(
+        passage_dataset["question"], passage_dataset["document_id"]
+    ):
+        if doc_id not in sparse_ranks[question]:
+            raise ValueError(
+                f"document {doc_id} retrieved for {question!r} is not in the sparse "
+                f"top {max_top_k}; the sparse index changed since the reader run"
+            )
+        candidate_ranks.append(sparse_ranks[question][doc_id])
+    return np.asarray(candidate_ranks, dtype=np.int64)
+
+
+def get_retrieval_recall(passage_dataset, candidate_ranks, gold_contexts, top_ks):
+    '''
+    정답 context가 top_k_retrieval=k의 passage 안에 retrieve 된 question의 비율입니다.
+    '''
+    best_ranks = {id: np.inf for id in gold_contexts}
+    for id, context, rank in zip(
+        passage_dataset["id"], passage_dataset["context"], candidate_ranks.tolist()
+    ):
+        if context == gold_contexts[id]:
+            best_ranks[id] = min(best_ranks[id], rank)
+    best_ranks = np.fromiter(best_ranks.values(), np.float64, len(best_ranks))
+    return {top_k: float(np.mean(best_ranks < top_k)) for top_k in top_ks}
+
+
+def predict_top_k(args, features, outputs, feature_candidate_ranks, ids, top_k):
+    '''
+    sparse rank < top_k인 passage의 feature만 골라 top_k로 retrieve 했을 때의 예측을 만듭니다.
+    사용한 feature 수를 같이 반환합니다.
+    '''
+    feature_idxs = np.nonzero(feature_candidate_ranks < top_k)[0]
+    top_k_args = copy.copy(args)
+    top_k_args.processed_eval_dataset = {
+        column: [values[i] for i in feature_idxs.tolist()]
+        for column, values in features.items()
+    }
+    top_k_outputs = PredictionOutput(
+        predictions=tuple(
+            np.asarray(prediction[feature_idxs]) for prediction in outputs.predictions
+        ),
+        label_ids=None,
+        metrics=None,
+    )
+    predictions_info_per_id = get_predictions_info_per_id(top_k_args, top_k_outputs)
+    predictions = [
+        {"id": id, "prediction_text": predictions_info_per_id[id][0]["text"]}
+        for id in ids
+    ]
+    return predictions, len(feature_idxs)
+
+
+def sweep_top_k(settings, args, sweep_args):
+    top_ks = sorted(set(sweep_args.sweep_top_ks))
+    max_top_k = top_ks[-1]
+    validation = load_from_disk(settings.trainset_path)["validation"]
+    references = [
+        {"id": id, "answers": answers}
+        for id, answers in zip(validation["id"], validation["answers"])
+    ]
+
+    if sweep_args.sweep_logit_store:
+        outputs = load_reader_outputs(args, sweep_args.sweep_logit_store, max_top_k)
+        reader_seconds = None
+        # inference.py의 HybridRetrieval과 같은 설정의 sparse retriever 입니다.
+        sparse_retrieval = SparseRetrieval(
+            AutoTokenizer.from_pretrained(settings.trained_model_path),
+            num_threads=settings.retrieval_num_threads,
+        )
+    else:
+        args.dataset = DatasetDict({"validation": validation})
+        outputs, reader_seconds, sparse_retrieval = run_reader_once(
+            settings, args, max_top_k
+        )
+
+    passage_dataset = args.dataset["validation"]
+    if not set(validation["id"]) <= set(passage_dataset["id"]):
+        raise ValueError(
+            "the logit store was not made from the validation questions of "
+            f"{settings.trainset_path}"
+        )
+    # 모든 k에서 같은 feature column을 잘라 쓰도록 한번만 python list로 꺼냅니다.
+    features = {
+        column: list(args.processed_eval_dataset[column]) for column in DECODE_COLUMNS
+    }
+    feature_samples = np.asarray(features["overflow_to_sample_mapping"], np.int64)
+    if len(np.unique(feature_samples)) != len(passage_dataset):
+        raise ValueError(
+            "some retrieved passages have no reader features; the sweep needs a "
+            "run without passage_prune_threshold"
+        )
+    candidate_ranks = get_candidate_ranks(sparse_retrieval, passage_dataset, max_top_k)
+    feature_candidate_ranks = candidate_ranks[feature_samples]
+    retrieval_recall = get_retrieval_recall(
+        passage_dataset,
+        candidate_ranks,
+        dict(zip(validation["id"], validation["context"])),
+        top_ks,
+    )
+
+    metric = load_metric("squad")
+    results = []
+    for top_k in top_ks:
+        predictions, num_features = predict_top_k(
+            args, features, outputs, feature_candidate_ranks, validation["id"], top_k
+        )
+        metrics = metric.compute(predictions=predictions, references=references)
+        result = {
+            "top_k_retrieval": top_k,
+            "exact_match": metrics["exact_match"],
+            "f1": metrics["f1"],
+            "retrieval_recall": retrieval_recall[top_k],
+            "num_features": num_features,
+            # reader 시간은 feature 수에 비례한다고 보고 max_top_k에서 잰 시간으로 추정합니다.
+            "estimated_reader_seconds": (
+                reader_seconds * num_features / len(feature_candidate_ranks)
+                if reader_seconds is not None
+                else None
+            ),
+        }
+        print(json.dumps(result))
+        results.append(result)
+
+    if sweep_args.sweep_target_score is not None:
+        passing = [
+            result
+            for result in results
+            if result[sweep_args.sweep_target_metric] >= sweep_args.sweep_target_score
+        ]
+        print(
+            f"cheapest top_k_retrieval with {sweep_args.sweep_target_metric} >= "
+            f"{sweep_args.sweep_target_score}: "
+            + (str(passing[0]["top_k_retrieval"]) if passing else "none")
+        )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(
+        path.join(args.output_dir, "top_k_sweep.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser((SettingsArguments, Arguments, SweepArguments))
+    settings, args, sweep_args = parser.parse_args_into_dataclasses()
+    set_seed(args.seed)
+    recorder.configure(settings.metrics_log_path, settings.prometheus_port)
+
+    sweep_top_k(settings, args, sweep_args)
@@ -5,7 +5,6 @@ from transformers import (
     AutoConfig,
     AutoTokenizer,
     AutoModelForQuestionAnswering,
-    DataCollatorWithPadding,
     HfArgumentParser,
     Trainer,
     set_seed,
@@ -14,6 +13,15 @@ from transformers import (
 import wandb
 
 from arguments import SettingsArguments, Arguments
+from callbacks import PaddingStatsCollator, PaddingWasteCallback, ThroughputCallback
+from feature_cache import get_feature_cache_key, map_with_feature_cache
+from hidden_state_cache import (
+    HiddenStateCollator,
+    attach_hidden_state_store,
+    get_backbone_fingerprint,
+    load_or_build_hidden_state_store,
+)
+from instrumentation import recorder
 from process import preprocess
 from metric import compute_metrics
 from utils import send_along
@@ -22,40 +30,89 @@ from models.cnn_head import Conv1DRobertaForQuestionAnswering
 from models.frozen_head import FrozenHeadModel
 
 
+def get_features(settings, args, dataset):
+    with recorder.span("tokenization", num_examples=len(dataset)):
+        if settings.feature_cache_dir:
+            return map_with_feature_cache(
+                settings.feature_cache_dir,
+                dataset,
+                preprocess,
+                args,
+                num_proc=settings.num_proc,
+            )
+        return dataset.map(
+            send_along(preprocess, sent_along=args),
+            batched=True,
+            num_proc=settings.num_proc,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=settings.load_from_cache_file,
+        )
+
+
+MODEL_CLASSES = {
+    "lstm": LSTMRobertaForQuestionAnswering,
+    "cnn": Conv1DRobertaForQuestionAnswering,
+    "frozen_head": FrozenHeadModel,
+}
+
+
+def get_model(settings, args):
+    if settings.model_type == "auto":
+        return AutoModelForQuestionAnswering.from_pretrained(
+            settings.pretrained_model_name_or_path, config=args.config
+        )
+    return MODEL_CLASSES[settings.model_type](
+        settings.pretrained_model_name_or_path, config=args.config
+    )
+
+
 def train(settings, args):
     args.config = AutoConfig.from_pretrained(settings.pretrained_model_name_or_path)
     args.tokenizer = AutoTokenizer.from_pretrained(
         settings.pretrained_model_name_or_path
     )
-    model = AutoModelForQuestionAnswering.from_pretrained(
-        settings.pretrained_model_name_or_path, config=args.config
-    )
-
-    data_collator = DataCollatorWithPadding(
-        tokenizer=args.tokenizer,
-        pad_to_multiple_of=args.pad_to_multiple_of if args.fp16 else None,
-    )
     args.dataset = load_from_disk(settings.trainset_path)
-    train_dataset = args.dataset["train_concat_dataset"]
-
-    column_names = train_dataset.column_names
-    train_dataset = train_dataset.map(
-        send_along(preprocess, sent_along=args),
-        batched=True,
-        num_proc=settings.num_proc,
-        remove_columns=column_names,
-        load_from_cache_file=settings.load_from_cache_file,
-    )
+    train_dataset = get_features(settings, args, args.dataset["train_concat_dataset"])
+    eval_dataset = get_features(settings, args, args.dataset["validation"])
 
-    eval_dataset = args.dataset["validation"]
-    column_names = eval_dataset.column_names
-    eval_dataset = eval_dataset.map(
-        send_along(preprocess, sent_along=args),
-        batched=True,
-        num_proc=settings.num_proc,
-        remove_columns=column_names,
-        load_from_cache_file=settings.load_from_cache_file,
-    )
+    model = get_model(settings, args)
+    if settings.hidden_state_cache_dir:
+        if settings.model_type != "frozen_head":
+            raise ValueError("hidden_state_cache_dir requires --model_type frozen_head")
+        # backbone은 학습하지 않으므로 한번 계산한 hidden state로 head만 학습합니다.
+        backbone_fingerprint = get_backbone_fingerprint(
+            settings.pretrained_model_name_or_path
+        )
+        stores = []
+        with recorder.span("hidden_state_cache"):
+            for features, dataset in (
+                (train_dataset, args.dataset["train_concat_dataset"]),
+                (eval_dataset, args.dataset["validation"]),
+            ):
+                stores.append(
+                    load_or_build_hidden_state_store(
+                        settings.hidden_state_cache_dir,
+                        backbone_fingerprint,
+                        model.roberta,
+                        features,
+                        get_feature_cache_key(args, dataset, preprocess),
+                        args,
+                        dtype=settings.hidden_state_dtype,
+                    )
+                )
+        train_dataset = attach_hidden_state_store(train_dataset, 0)
+        eval_dataset = attach_hidden_state_store(eval_dataset, 1)
+        args.remove_unused_columns = False
+        data_collator = HiddenStateCollator(
+            tokenizer=args.tokenizer,
+            pad_to_multiple_of=args.pad_to_multiple_of if args.fp16 else None,
+            stores=stores,
+        )
+    else:
+        data_collator = PaddingStatsCollator(
+            tokenizer=args.tokenizer,
+            pad_to_multiple_of=args.pad_to_multiple_of if args.fp16 else None,
+        )
     args.processed_eval_dataset = eval_dataset
 
     trainer = Trainer(
@@ -66,11 +123,16 @@ def train(settings, args):
         tokenizer=args.tokenizer,
         data_collator=data_collator,
         compute_metrics=send_along(compute_metrics, sent_along=args),
+        callbacks=[
+            PaddingWasteCallback(data_collator),
+            ThroughputCallback(data_collator, recorder),
+        ],
     )
-    if args.resume_from_checkpoint:
-        trainer.train(resume_from_checkpoint=args.resume_from_checkpoint)
-    else:
-        trainer.train()
+    with recorder.span("train"):
+        if args.resume_from_checkpoint:
+            trainer.train(resume_from_checkpoint=args.resume_from_checkpoint)
+        else:
+            trainer.train()
     trainer.save_model()
 
 
@@ -81,5 +143,6 @@ if __name__ == "__main__":
     settings, args = parser.parse_args_into_dataclasses()
     set_seed(args.seed)
     set_caching_enabled(False)
+    recorder.configure(settings.metrics_log_path, settings.prometheus_port)
 
     train(settings, args)